@@ -140,3 +140,45 @@ def get_active_transfers(whatsapp_account=None, agent=None):
     )
 
     return transfers
+
+
+@frappe.whitelist()
+def get_pipeline_stats():
+    """Get chatbot pipeline load: queue depths, rate limit rejections and AI circuits.
+
+    Returns:
+        dict with "queues" (jobs waiting per stage queue and conversations
+        with queued messages), "rate_limit_rejections" (per limit) and
+        "ai_circuits" (open or closed per AI provider)
+    """
+    frappe.only_for("System Manager")
+
+    from frappe_whatsapp_chatbot.chatbot.ai_failover import get_circuit_states
+    from frappe_whatsapp_chatbot.chatbot.conversation_queue import get_queue_depths
+    from frappe_whatsapp_chatbot.chatbot.gating import get_rate_limit_stats
+
+    return {
+        "queues": get_queue_depths(),
+        "rate_limit_rejections": get_rate_limit_stats(),
+        "ai_circuits": get_circuit_states(["OpenAI", "Anthropic", "Google", "Custom"])
+    }
+
+
+@frappe.whitelist()
+def get_session_messages(session, start=0, page_length=20):
+    """Get a page of a chatbot session's message history, newest first.
+
+    Args:
+        session: WhatsApp Chatbot Session name (required)
+        start: Offset of the first message
+        page_length: Number of messages to return
+
+    Returns:
+        list of messages with direction, message, timestamp and step_name
+    """
+    frappe.has_permission("WhatsApp Chatbot Session", doc=session, throw=True)
+
+    from frappe.utils import cint
+    from frappe_whatsapp_chatbot.chatbot.session_manager import get_session_messages as get_messages
+
+    return get_messages(session, start=cint(start), page_length=cint(page_length) or 20)
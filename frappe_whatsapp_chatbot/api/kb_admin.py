@@ -4,6 +4,10 @@ from frappe import _
 import csv
 from io import StringIO
 
+from frappe_whatsapp_chatbot.chatbot.kb_index import update_kb_entry
+from frappe_whatsapp_chatbot.chatbot.kb_vectors import enqueue_kb_vector_update
+from frappe_whatsapp_chatbot.chatbot.response_cache import clear_response_cache
+
 
 @frappe.whitelist()
 def export_knowledge_base():
@@ -122,7 +126,12 @@ def bulk_update_keywords(entries):
         
         if name and keywords is not None:
             frappe.db.set_value("WhatsApp Knowledge Base", name, "keywords", keywords)
+            # set_value skips the controller, update the search index here
+            update_kb_entry(frappe.get_doc("WhatsApp Knowledge Base", name))
+            enqueue_kb_vector_update(name)
             updated += 1
-    
+
+    if updated:
+        clear_response_cache()
     frappe.db.commit()
     return {"updated": updated}
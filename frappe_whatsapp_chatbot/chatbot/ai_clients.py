@@ -0,0 +1,97 @@
+"""
+AI provider clients, created once per process and reused.
+
+SDK clients hold HTTP connection pools, so reusing them keeps connections
+(and TLS sessions) alive between the calls a process makes: retries and
+failover within one job, and, with a worker that runs jobs in its own
+process, between jobs. The default RQ worker forks a fresh work horse for
+every job, so there each job starts with a new client and connection.
+
+A client is keyed by provider and credentials: a changed API key or
+endpoint replaces (and closes) the provider's previous client. Clients are
+never shared with forked children, whose inherited sockets would be shared
+with the parent.
+"""
+import os
+import threading
+
+import frappe
+
+# Seconds to establish a connection, and to wait for a response; calls
+# pass a shorter timeout when less is left of the reply's deadline
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+_lock = threading.Lock()
+_clients = {}  # provider: (pid, credentials, client)
+
+
+def get_client(provider, credentials, factory):
+    """Get the provider's client for these credentials, creating it if needed.
+
+    Args:
+        provider: Client registry name, e.g. "OpenAI"
+        credentials: Hashable identity of the client (API key, endpoint)
+        factory: Callable creating the client
+    """
+    pid = os.getpid()
+    with _lock:
+        cached = _clients.get(provider)
+        if cached and cached[0] == pid and cached[1] == credentials:
+            return cached[2]
+
+        client = factory()
+        _clients[provider] = (pid, credentials, client)
+
+    if cached and cached[0] == pid:
+        _close(cached[2])  # Rotated credentials
+    return client
+
+
+def _close(client):
+    try:
+        close = getattr(client, "close", None)
+        if close:
+            close()
+    except Exception as e:
+        frappe.log_error(f"AI client close error: {str(e)}")
+
+
+def _timeout():
+    import httpx
+    return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+# SDK clients don't retry themselves: ai_failover retries with backoff and
+# fails over to the next provider
+def get_openai_client(api_key):
+    import openai
+    return get_client(
+        "OpenAI", api_key,
+        lambda: openai.OpenAI(api_key=api_key, timeout=_timeout(), max_retries=0)
+    )
+
+
+def get_anthropic_client(api_key):
+    import anthropic
+    return get_client(
+        "Anthropic", api_key,
+        lambda: anthropic.Anthropic(api_key=api_key, timeout=_timeout(), max_retries=0)
+    )
+
+
+def configure_google(api_key):
+    """Configure the (process-wide) Google AI SDK once per API key."""
+    import google.generativeai as genai
+
+    def configure():
+        genai.configure(api_key=api_key)
+        return genai
+
+    return get_client("Google", api_key, configure)
+
+
+def get_http_session():
+    """Get the requests session used for custom AI endpoints."""
+    import requests
+    return get_client("Custom", None, requests.Session)
@@ -0,0 +1,180 @@
+"""
+Failover across AI providers with circuit breakers and backoff.
+
+An AI reply tries the primary provider, then each fallback provider in order.
+A provider is retried with exponential backoff and jitter on transient
+errors, and every attempt is bounded by the reply's overall deadline.
+
+Each provider has a circuit breaker shared by all workers through Redis:
+after FAILURE_THRESHOLD failures within FAILURE_WINDOW seconds its circuit
+opens and it is skipped for OPEN_SECONDS. After that a single failure opens
+it again, a success closes it.
+"""
+import random
+import time
+
+import frappe
+
+from frappe_whatsapp_chatbot.chatbot.cache import run_script
+
+FAILURE_THRESHOLD = 5
+FAILURE_WINDOW = 60
+OPEN_SECONDS = 30
+
+# Attempts per provider before moving on to the next one
+MAX_ATTEMPTS = 2
+
+# Backoff before retry n (from 0): BACKOFF_BASE * 2^n, plus up to as much jitter
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 4
+
+# A provider is not started with less time than this left before the deadline
+MIN_ATTEMPT_SECONDS = 1
+
+# KEYS: failure counter, open flag
+# ARGV: threshold, window, open seconds
+# Returns 1 if this failure opened the circuit
+FAILURE_SCRIPT = """
+local failures = redis.call('INCR', KEYS[1])
+if failures == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if failures >= tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[2], 1, 'EX', ARGV[3])
+    -- Half-open once the circuit closes: the next failure opens it again
+    redis.call('SET', KEYS[1], tonumber(ARGV[1]) - 1, 'EX', tonumber(ARGV[2]) + tonumber(ARGV[3]))
+    return 1
+end
+return 0
+"""
+
+
+class ProviderError(Exception):
+    """An AI provider call failed; retryable unless the request itself was rejected."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _names(provider):
+    return [
+        f"wa_chatbot_ai_circuit_failures:{provider}",
+        f"wa_chatbot_ai_circuit_open:{provider}"
+    ]
+
+
+def _keys(provider):
+    """Prefixed keys, for scripts, pipelines and raw commands."""
+    return [frappe.cache.make_key(name) for name in _names(provider)]
+
+
+def is_circuit_open(provider):
+    # exists prefixes the key itself
+    return bool(frappe.cache.exists(_names(provider)[1]))
+
+
+def record_failure(provider):
+    if run_script(
+        FAILURE_SCRIPT,
+        keys=_keys(provider),
+        args=[FAILURE_THRESHOLD, FAILURE_WINDOW, OPEN_SECONDS]
+    ):
+        frappe.log_error(
+            f"AI provider {provider} failed {FAILURE_THRESHOLD} times, "
+            f"skipping it for {OPEN_SECONDS} seconds",
+            "WhatsApp Chatbot AI Circuit Open"
+        )
+
+
+def record_success(provider):
+    # Raw DEL, the keys are already prefixed
+    frappe.cache.delete(_keys(provider)[0])
+
+
+def get_circuit_states(providers):
+    """Get "open" or "closed" per provider, for monitoring."""
+    pipeline = frappe.cache.pipeline()
+    for provider in providers:
+        pipeline.exists(_keys(provider)[1])
+    return {
+        provider: "open" if is_open else "closed"
+        for provider, is_open in zip(providers, pipeline.execute())
+    }
+
+
+def is_retryable(error):
+    """Check if an error is transient (timeouts, rate limits, server errors)."""
+    if isinstance(error, ProviderError):
+        return error.retryable
+    if isinstance(error, ImportError):
+        return False
+
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        return True  # Connection errors and timeouts
+    return status in (408, 409, 429) or status >= 500
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number attempt (0-based), with jitter."""
+    delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+    return delay + random.uniform(0, delay)
+
+
+def call_with_failover(candidates, call, deadline_seconds):
+    """Call providers in order until one returns a response.
+
+    Args:
+        candidates: list of (provider name, context) tuples, in order
+        call: Callable(context, timeout) returning the response, or None for
+            no answer; raises on failure
+        deadline_seconds: Time budget for the whole reply
+
+    Returns:
+        The first response, or None if every provider failed, was skipped or
+        the deadline passed
+    """
+    deadline = time.monotonic() + deadline_seconds
+
+    for provider, context in candidates:
+        if is_circuit_open(provider):
+            continue
+
+        for attempt in range(MAX_ATTEMPTS):
+            remaining = deadline - time.monotonic()
+            if remaining < MIN_ATTEMPT_SECONDS:
+                frappe.log_error(
+                    f"AI reply deadline of {deadline_seconds}s exceeded",
+                    "WhatsApp Chatbot AI Error"
+                )
+                return None
+
+            try:
+                response = call(context, remaining)
+            except Exception as e:
+                frappe.log_error(
+                    f"AI provider {provider} error (attempt {attempt + 1}): {str(e)}",
+                    "WhatsApp Chatbot AI Error"
+                )
+                # A rejected request says nothing about the provider's health
+                if not is_retryable(e):
+                    break
+                record_failure(provider)
+                if attempt + 1 == MAX_ATTEMPTS:
+                    break
+
+                delay = backoff_delay(attempt)
+                if time.monotonic() + delay + MIN_ATTEMPT_SECONDS > deadline:
+                    break  # No time for a retry, try the next provider
+                time.sleep(delay)
+                continue
+
+            record_success(provider)
+            if response:
+                return response
+            break  # No answer from this provider, try the next one
+
+    return None
@@ -1,6 +1,36 @@
 import frappe
 import json
-import hashlib
+import time
+
+from frappe_whatsapp_chatbot.chatbot.ai_clients import READ_TIMEOUT
+from frappe_whatsapp_chatbot.chatbot.ai_failover import ProviderError, call_with_failover
+from frappe_whatsapp_chatbot.chatbot.cache import bump_version, get_cached
+from frappe_whatsapp_chatbot.chatbot.context_resolver import resolve_queries
+from frappe_whatsapp_chatbot.chatbot.prompt_budget import Tokenizer, assemble_prompt
+from frappe_whatsapp_chatbot.chatbot.response_cache import USER_CACHE_TTL, CachedQuestion, clear_response_cache
+
+# Cache namespace for the enabled WhatsApp AI Context documents
+AI_CONTEXT_CACHE = "ai_context"
+
+
+def get_ai_contexts():
+    """Get the enabled AI Context documents, highest priority first."""
+    return get_cached(
+        AI_CONTEXT_CACHE,
+        "",
+        loader=lambda: frappe.get_all(
+            "WhatsApp AI Context",
+            filters={"enabled": 1},
+            fields=["*"],
+            order_by="priority desc"
+        )
+    )
+
+
+def clear_ai_context_cache():
+    """Invalidate the cached AI Contexts, and the replies built from them."""
+    bump_version(AI_CONTEXT_CACHE)
+    clear_response_cache()
 
 
 class AIResponder:
@@ -17,122 +47,185 @@ class AIResponder:
         self.temperature = settings.ai_temperature or 0.7
         self.include_history = settings.ai_include_history or False
         self.history_limit = settings.ai_history_limit or 4
-        self.cache_ttl = 300  # 5 minutes cache for identical queries
-        self.retry_count = 0
-        self.max_retries = 3
+        # None: not saved since the field was added (0 turns the cache off)
+        self.cache_ttl = 3600 if settings.ai_cache_ttl is None else settings.ai_cache_ttl
+        self.cache_similarity = settings.ai_cache_similarity or 0
+        self.reply_deadline = settings.ai_reply_deadline or 30
+        # None: not saved since the field was added (0 turns the budget off)
+        self.prompt_budget = 3000 if settings.ai_prompt_budget is None else settings.ai_prompt_budget
+        self.prompt_tokens = None
+        self.timeout = READ_TIMEOUT
+
+    def get_cached_question(self, message, conversation_history):
+        """Get the message's reply cache entry, shared unless the reply is customer-specific.
+
+        Returns:
+            CachedQuestion, or None if the reply must not be cached
+        """
+        if self.uses_customer_data(conversation_history):
+            if not self.phone_number:
+                return None
+            return CachedQuestion(message, phone_number=self.phone_number)
+        return CachedQuestion(message, similarity=self.cache_similarity)
 
-    def _get_cache_key(self, message):
-        """Generate cache key for response caching."""
-        # Hash the message + phone for uniqueness
-        key_data = f"{self.phone_number}:{message.lower().strip()}"
-        return f"wa_ai_response:{hashlib.md5(key_data.encode()).hexdigest()}"
+    def uses_customer_data(self, conversation_history):
+        """Check if the reply depends on the conversation or the customer's records."""
+        if self.include_history and conversation_history:
+            return True
+        return any(ctx.user_specific and ctx.phone_field for ctx in self.get_matching_contexts())
 
     def generate_response(self, message, conversation_history=None):
-        """Generate AI response for message with caching."""
-        if not self.api_key:
+        """Generate AI response for message with caching.
+
+        Providers are tried in order (primary, then the fallback chain) with
+        retries, circuit breakers and an overall deadline, see ai_failover.
+        """
+        candidates = self.get_candidates()
+        if not candidates:
             frappe.log_error("AI API key not configured")
             return None
 
         self.current_message = message  # Store for context filtering
+        self._context = None
+
+        started = time.monotonic()
 
         # Check cache first
-        cache_key = self._get_cache_key(message)
-        cached_response = frappe.cache.get(cache_key)
-        if cached_response:
-            return cached_response
+        cached_question = None
+        if self.cache_ttl:
+            try:
+                cached_question = self.get_cached_question(message, conversation_history)
+                cached_response = cached_question.get() if cached_question else None
+                if cached_response:
+                    return cached_response
+
+                # Only one caller asks the provider for the same question at a time
+                if cached_question:
+                    cached_response = cached_question.lead_or_wait(self.reply_deadline)
+                    if cached_response:
+                        return cached_response
+            except Exception as e:
+                frappe.log_error(f"AI response cache error: {str(e)}")
 
-        response = None
         try:
-            if self.provider == "OpenAI":
-                response = self.openai_response(message, conversation_history)
-            elif self.provider == "Anthropic":
-                response = self.anthropic_response(message, conversation_history)
-            elif self.provider == "Google":
-                response = self.google_response(message, conversation_history)
-            elif self.provider == "Custom":
-                response = self.custom_response(message, conversation_history)
-            
-            # Cache successful response
-            if response:
-                frappe.cache.set(cache_key, response, expires_in_sec=self.cache_ttl)
-                return response
-                
-        except Exception as e:
-            self.retry_count += 1
-            frappe.log_error(f"AIResponder generate_response error (attempt {self.retry_count}): {str(e)}")
-            
-            # Retry logic
-            if self.retry_count < self.max_retries:
-                return self.generate_response(message, conversation_history)
-            else:
-                frappe.log_error(f"AIResponder max retries exceeded for: {message[:50]}")
-
-        return None
+            response = call_with_failover(
+                candidates,
+                lambda candidate, timeout: self.call_provider(candidate, timeout, message, conversation_history),
+                self.reply_deadline - (time.monotonic() - started)
+            )
 
+            # Cache successful response
+            if response and cached_question:
+                ttl = self.cache_ttl
+                if cached_question.phone_number is not None:
+                    ttl = min(ttl, USER_CACHE_TTL)
+                cached_question.set(response, ttl)
+            return response
+
+        finally:
+            if cached_question:
+                cached_question.release()
+
+    def get_candidates(self):
+        """Get the providers to try, in order, as (provider, (provider, model, api key))."""
+        chain = [(self.provider, self.model, self.api_key)] + [
+            (row.provider, row.model or self.model, row.api_key)
+            for row in self.settings.ai_fallback_chain or ()
+        ]
+        return [
+            (provider, (provider, model, api_key))
+            for provider, model, api_key in chain
+            if provider and (api_key or provider == "Custom")
+        ]
+
+    def call_provider(self, candidate, timeout, message, conversation_history):
+        """Call one provider, waiting at most timeout seconds for its response."""
+        self.provider, self.model, self.api_key = candidate
+        self.timeout = min(timeout, READ_TIMEOUT)
+        if self.provider == "OpenAI":
+            return self.openai_response(message, conversation_history)
+        elif self.provider == "Anthropic":
+            return self.anthropic_response(message, conversation_history)
+        elif self.provider == "Google":
+            return self.google_response(message, conversation_history)
+        elif self.provider == "Custom":
+            return self.custom_response(message, conversation_history)
+
+    def get_context(self):
+        """Build the context parts once per reply, however many providers are tried."""
+        if getattr(self, "_context", None) is None:
+            self._context = self.build_context()
+        return self._context
+
+    def get_matching_contexts(self):
+        """Get the AI Contexts whose trigger keywords (if any) match the message."""
+        message_lower = (getattr(self, 'current_message', '') or '').lower()
+        matching = []
+        for ctx in get_ai_contexts():
+            # Check trigger keywords - skip if message doesn't match
+            if ctx.trigger_keywords:
+                keywords = [k.strip().lower() for k in ctx.trigger_keywords.split(",") if k.strip()]
+                if keywords and not any(kw in message_lower for kw in keywords):
+                    continue  # Skip this context - no matching keywords
+            matching.append(ctx)
+        return matching
 
     def build_context(self):
-        """Build context from AI Context documents."""
-        try:
-            contexts = frappe.get_all(
-                "WhatsApp AI Context",
-                filters={"enabled": 1},
-                fields=["*"],
-                order_by="priority desc"
-            )
+        """Build context from AI Context documents and the Knowledge Base.
 
+        Returns:
+            list of (title, text), most relevant first
+        """
+        try:
             context_parts = []
             message_lower = (getattr(self, 'current_message', '') or '').lower()
 
+            contexts = self.get_matching_contexts()
+            # Cached or run concurrently, see context_resolver
+            query_results = resolve_queries(
+                [ctx for ctx in contexts if ctx.context_type == "DocType Query"],
+                self.phone_number,
+                self.query_doctype
+            )
+
             for ctx in contexts:
                 try:
-                    # Check trigger keywords - skip if message doesn't match
-                    if ctx.trigger_keywords:
-                        keywords = [k.strip().lower() for k in ctx.trigger_keywords.split(",") if k.strip()]
-                        if keywords and not any(kw in message_lower for kw in keywords):
-                            continue  # Skip this context - no matching keywords
-
                     if ctx.context_type == "Static Text" and ctx.static_content:
-                        context_parts.append(f"[{ctx.title}]\n{ctx.static_content}")
+                        context_parts.append((ctx.title, ctx.static_content))
                     elif ctx.context_type == "DocType Query":
-                        data = self.query_doctype(ctx)
+                        data = query_results.get(ctx.name)
                         if data:
                             # Compact JSON to save tokens
-                            context_parts.append(f"[{ctx.title}]\n{json.dumps(data, separators=(',', ':'), default=str)}")
+                            context_parts.append((ctx.title, json.dumps(data, separators=(',', ':'), default=str)))
                 except Exception as e:
                     frappe.log_error(f"AIResponder context '{ctx.title}' error: {str(e)}")
                     continue
             
-            # --- Knowledge Base Integration (RAG Lite) ---
+            # --- Knowledge Base Integration (BM25 search) ---
             try:
-                # Simple keyword search in Knowledge Base
-                # In production, this should be Vector Search
-                kb_items = frappe.get_all("WhatsApp Knowledge Base", 
-                                       filters={"is_active": 1},
-                                       fields=["topic", "content", "keywords"])
-                
-                relevant_kb = []
-                for kb in kb_items:
-                    # Check if keywords match message
-                    if kb.keywords:
-                        kb_kws = [k.strip().lower() for k in kb.keywords.split(",") if k.strip()]
-                        if any(kw in message_lower for kw in kb_kws):
-                            relevant_kb.append(f"Q: {kb.topic}\nA: {kb.content}")
-                    # Also check topic string match (simple)
-                    elif kb.topic.lower() in message_lower:
-                        relevant_kb.append(f"Q: {kb.topic}\nA: {kb.content}")
-                
-                if relevant_kb:
-                    context_parts.append("[Knowledge Base]\n" + "\n---\n".join(relevant_kb))
-                    
+                from frappe_whatsapp_chatbot.chatbot.kb_index import search_knowledge_base
+                max_chars = self.settings.kb_max_chars
+                relevant_kb = search_knowledge_base(
+                    message_lower,
+                    limit=self.settings.kb_max_results or 3,
+                    # None: not saved since the field was added (0 is no cap)
+                    max_chars=2000 if max_chars is None else max_chars,
+                    semantic=self.settings.kb_semantic_search
+                )
+                # One part per entry, so the least relevant are left out first
+                context_parts.extend(
+                    ("Knowledge Base", f"Q: {kb['topic']}\nA: {kb['content']}") for kb in relevant_kb
+                )
+
             except Exception as e:
                 frappe.log_error(f"Knowledge Base Search Error: {e}")
             # ---------------------------------------------
 
-            return "\n\n".join(context_parts) if context_parts else ""
+            return context_parts
 
         except Exception as e:
             frappe.log_error(f"AIResponder build_context error: {str(e)}")
-            return ""
+            return []
 
     def query_doctype(self, ctx):
         """Query DocType for context."""
@@ -146,6 +239,8 @@ class AIResponder:
             filters = ctx.filters or {}
             if isinstance(filters, str):
                 filters = json.loads(filters) if filters else {}
+            else:
+                filters = dict(filters)  # The context is cached, don't modify it
 
             # Add user-specific filter if enabled
             if ctx.user_specific and ctx.phone_field and self.phone_number:
@@ -192,16 +287,50 @@ class AIResponder:
 
         return list(set(variants))
 
+    def split_history(self, conversation_history):
+        """Split history into the rolling summary text and the recent messages."""
+        if not (self.include_history and conversation_history):
+            return "", []
+
+        summary = "\n".join(m["message"] for m in conversation_history if m["direction"] == "System")
+        recent = [m for m in conversation_history if m["direction"] != "System"]
+        return summary, recent[-self.history_limit:]
+
+    def assemble_prompt(self, message, conversation_history):
+        """Pack the prompt for the current provider and model into the token budget."""
+        summary, recent = self.split_history(conversation_history)
+        prompt = assemble_prompt(
+            Tokenizer(self.provider, self.model),
+            self.prompt_budget,
+            self.system_prompt,
+            message,
+            context_parts=self.get_context(),
+            summary=summary,
+            history=recent
+        )
+
+        self.prompt_tokens = prompt.tokens
+        logger = frappe.logger("frappe_whatsapp_chatbot")
+        if prompt.dropped or prompt.cut:
+            logger.info(
+                f"AI prompt over budget for {self.provider}: {prompt.tokens}, "
+                f"{prompt.dropped} parts left out, {prompt.cut} shortened"
+            )
+        else:
+            logger.debug(f"AI prompt tokens for {self.provider}: {prompt.tokens}")
+        return prompt
+
     def openai_response(self, message, conversation_history):
         """Generate response using OpenAI."""
         try:
-            import openai
-            client = openai.OpenAI(api_key=self.api_key)
+            from frappe_whatsapp_chatbot.chatbot.ai_clients import get_openai_client
+            client = get_openai_client(self.api_key)
 
-            messages = [{"role": "system", "content": self.system_prompt}]
+            prompt = self.assemble_prompt(message, conversation_history)
+            messages = [{"role": "system", "content": prompt.system}]
 
             # Add context
-            context = self.build_context()
+            context = prompt.context
             if context:
                 messages.append({
                     "role": "system",
@@ -209,17 +338,16 @@ class AIResponder:
                 })
 
             # Add conversation history if enabled
-            if self.include_history and conversation_history:
-                for msg in conversation_history[-self.history_limit:]:
-                    role = "user" if msg["direction"] == "Incoming" else "assistant"
-                    # Truncate long messages
-                    msg_text = msg["message"][:200] if len(msg["message"]) > 200 else msg["message"]
-                    messages.append({"role": role, "content": msg_text})
+            if prompt.summary:
+                messages.append({"role": "system", "content": prompt.summary})
+            for msg in prompt.history:
+                role = "user" if msg["direction"] == "Incoming" else "assistant"
+                messages.append({"role": role, "content": msg["message"]})
 
             # Add current message
             messages.append({"role": "user", "content": message})
 
-            response = client.chat.completions.create(
+            response = client.with_options(timeout=self.timeout).chat.completions.create(
                 model=self.model,
                 messages=messages,
                 max_tokens=self.max_tokens,
@@ -230,37 +358,35 @@ class AIResponder:
 
         except ImportError:
             frappe.log_error("OpenAI library not installed. Run: pip install openai")
-            return None
-        except Exception as e:
-            frappe.log_error(f"OpenAI API error: {str(e)}")
-            return None
+            raise
 
     def anthropic_response(self, message, conversation_history):
         """Generate response using Anthropic Claude."""
         try:
-            import anthropic
-            client = anthropic.Anthropic(api_key=self.api_key)
+            from frappe_whatsapp_chatbot.chatbot.ai_clients import get_anthropic_client
+            client = get_anthropic_client(self.api_key)
+
+            prompt = self.assemble_prompt(message, conversation_history)
 
             # Build messages
             messages = []
 
             # Add conversation history if enabled
-            if self.include_history and conversation_history:
-                for msg in conversation_history[-self.history_limit:]:
-                    role = "user" if msg["direction"] == "Incoming" else "assistant"
-                    # Truncate long messages
-                    msg_text = msg["message"][:200] if len(msg["message"]) > 200 else msg["message"]
-                    messages.append({"role": role, "content": msg_text})
+            for msg in prompt.history:
+                role = "user" if msg["direction"] == "Incoming" else "assistant"
+                messages.append({"role": role, "content": msg["message"]})
 
             messages.append({"role": "user", "content": message})
 
             # Build system prompt with context
-            system = self.system_prompt
-            context = self.build_context()
+            system = prompt.system
+            if prompt.summary:
+                system += f"\n\n{prompt.summary}"
+            context = prompt.context
             if context:
                 system += f"\n\nHere is relevant information you can use to answer questions:\n{context}"
 
-            response = client.messages.create(
+            response = client.with_options(timeout=self.timeout).messages.create(
                 model=self.model,
                 max_tokens=self.max_tokens,
                 system=system,
@@ -271,33 +397,28 @@ class AIResponder:
 
         except ImportError:
             frappe.log_error("Anthropic library not installed. Run: pip install anthropic")
-            return None
-        except Exception as e:
-            frappe.log_error(f"Anthropic API error: {str(e)}")
-            return None
+            raise
 
     def google_response(self, message, conversation_history):
         """Generate response using Google AI (Gemini)."""
         try:
-            import google.generativeai as genai
-            genai.configure(api_key=self.api_key)
+            from frappe_whatsapp_chatbot.chatbot.ai_clients import configure_google
+            genai = configure_google(self.api_key)
 
+            prompt = self.assemble_prompt(message, conversation_history)
             model = genai.GenerativeModel(
                 model_name=self.model or "gemini-2.0-flash",
-                system_instruction=self.system_prompt
+                system_instruction=prompt.system
             )
 
             # Build conversation history if enabled
             history = []
-            if self.include_history and conversation_history:
-                for msg in conversation_history[-self.history_limit:]:
-                    role = "user" if msg["direction"] == "Incoming" else "model"
-                    # Truncate long messages to save tokens
-                    msg_text = msg["message"][:200] if len(msg["message"]) > 200 else msg["message"]
-                    history.append({"role": role, "parts": [msg_text]})
+            for msg in prompt.history:
+                role = "user" if msg["direction"] == "Incoming" else "model"
+                history.append({"role": role, "parts": [msg["message"]]})
 
             # Add context to the message
-            context = self.build_context()
+            context = "\n\n".join(filter(None, [prompt.summary, prompt.context]))
             full_message = message
             if context:
                 full_message = f"Context:\n{context}\n\nQuestion: {message}"
@@ -308,7 +429,8 @@ class AIResponder:
                 generation_config=genai.types.GenerationConfig(
                     max_output_tokens=self.max_tokens,
                     temperature=self.temperature
-                )
+                ),
+                request_options={"timeout": self.timeout}
             )
 
             # Handle empty response
@@ -322,25 +444,22 @@ class AIResponder:
                     generation_config=genai.types.GenerationConfig(
                         max_output_tokens=self.max_tokens,
                         temperature=self.temperature
-                    )
+                    ),
+                    request_options={"timeout": self.timeout}
                 )
                 return response.text
 
         except ImportError:
             frappe.log_error("Google AI library not installed. Run: pip install google-generativeai")
-            return None
-        except Exception as e:
-            frappe.log_error(f"Google AI API error: {str(e)}")
-            return None
+            raise
 
     def custom_response(self, message, conversation_history):
         """Generate response using custom endpoint."""
         try:
-            import requests
+            from frappe_whatsapp_chatbot.chatbot.ai_clients import CONNECT_TIMEOUT, get_http_session
             endpoint = self.settings.ai_custom_endpoint
             if not endpoint:
-                frappe.log_error("Custom AI endpoint not configured")
-                return None
+                raise ProviderError("Custom AI endpoint not configured", retryable=False)
 
             headers = {
                 "Content-Type": "application/json",
@@ -351,15 +470,17 @@ class AIResponder:
                 "message": message,
                 "history": conversation_history,
                 "phone_number": self.phone_number,
-                "context": self.build_context()
+                "context": self.assemble_prompt(message, conversation_history).context
             }
 
-            response = requests.post(endpoint, json=payload, headers=headers, timeout=30)
+            response = get_http_session().post(
+                endpoint, json=payload, headers=headers, timeout=(CONNECT_TIMEOUT, self.timeout)
+            )
             response.raise_for_status()
             
             data = response.json()
             return data.get("response") or data.get("message") or str(data)
 
-        except Exception as e:
-            frappe.log_error(f"Custom AI provider error: {str(e)}")
-            return None
+        except ImportError:
+            frappe.log_error("Requests library not installed. Run: pip install requests")
+            raise
@@ -0,0 +1,121 @@
+"""
+Two-level cache for compiled chatbot data.
+
+Compiled structures (keyword indexes, flow graphs, settings) are kept in
+worker memory and validated against a version stamp stored in Redis, so each
+worker rebuilds them only after the source documents have changed.
+"""
+import frappe
+from types import MappingProxyType
+
+# Worker-local store: {(site, namespace, key): (version, value)}
+_local_cache = {}
+
+# Registered Lua scripts: {source: redis Script}
+_scripts = {}
+
+# Shared source data is keyed by version, so stale entries simply expire
+SHARED_TTL = 24 * 60 * 60
+
+
+def _version_key(namespace):
+    return f"wa_chatbot_version:{namespace}"
+
+
+def redis_version_key(namespace):
+    """Get the raw Redis key of a namespace's version stamp (for scripts)."""
+    return frappe.cache.make_key(_version_key(namespace))
+
+
+def get_version(namespace):
+    """Get the current version stamp of a cache namespace."""
+    version = frappe.cache.get_value(_version_key(namespace))
+    if not version:
+        version = bump_version(namespace)
+    return version
+
+
+def bump_version(namespace, version=None):
+    """Invalidate every entry of a namespace in all workers.
+
+    Args:
+        namespace: Cache namespace
+        version: Optional explicit version stamp (e.g. the document's
+            modified timestamp), a random one is generated by default
+    """
+    version = version or frappe.generate_hash(length=12)
+    frappe.cache.set_value(_version_key(namespace), version)
+    return version
+
+
+def get_cached(namespace, key, loader, compiler=None, version=None):
+    """Get a compiled value from worker memory, Redis or the loader.
+
+    Args:
+        namespace: Cache namespace, invalidated as a whole by bump_version
+        key: Entry key within the namespace (e.g. the WhatsApp account)
+        loader: Callable returning picklable source data, shared through Redis
+        compiler: Optional callable that turns the source data into the value
+            kept in worker memory (defaults to the source data itself)
+        version: Version stamp already read by the caller (e.g. in a pipeline
+            or script), saves a Redis round trip
+
+    Returns:
+        The cached value
+    """
+    version = version or get_version(namespace)
+    local_key = (getattr(frappe.local, "site", None), namespace, key)
+
+    entry = _local_cache.get(local_key)
+    if entry and entry[0] == version:
+        return entry[1]
+
+    shared_key = f"wa_chatbot:{namespace}:{version}:{key}"
+    data = frappe.cache.get_value(shared_key)
+    if data is None:
+        data = loader()
+        frappe.cache.set_value(shared_key, data, expires_in_sec=SHARED_TTL)
+
+    value = compiler(data) if compiler else data
+    _local_cache[local_key] = (version, value)
+    return value
+
+
+def peek_cached(namespace, key):
+    """Get a value from worker memory without validating its version.
+
+    For callers that validate the version themselves later in the same Redis
+    round trip. Returns None if this worker has no entry yet.
+    """
+    entry = _local_cache.get((getattr(frappe.local, "site", None), namespace, key))
+    return entry[1] if entry else None
+
+
+def run_script(script, keys, args):
+    """Run a Lua script on the cache Redis, loading it by SHA once per worker."""
+    registered = _scripts.get(script)
+    if registered is None:
+        registered = _scripts[script] = frappe.cache.register_script(script)
+    return registered(keys=keys, args=args, client=frappe.cache)
+
+
+class ReadOnlyDoc:
+    """Attribute access over a document (or row) dict that cannot be modified."""
+
+    def __init__(self, row):
+        object.__setattr__(self, "_row", MappingProxyType(dict(row)))
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self._row.get(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def get(self, name, default=None):
+        value = getattr(self, name)
+        return default if value is None else value
@@ -0,0 +1,133 @@
+"""
+Resolution of DocType Query AI contexts.
+
+Query results are cached in Redis per context (and per customer, for user
+specific contexts) for the context's Cache TTL. Saving or deleting a document
+of a queried DocType invalidates that DocType's cached results in all
+workers, through a version stamp per DocType.
+
+Queries that miss the cache run concurrently, each in a thread with its own
+database connection, so a reply waits for the slowest query instead of the
+sum of all of them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+
+from frappe_whatsapp_chatbot.chatbot.cache import bump_version, get_cached, get_version
+
+# Concurrent queries per reply
+MAX_WORKERS = 4
+
+# Cache key of the queried DocTypes within the AI Context namespace
+QUERIED_DOCTYPES_KEY = "queried_doctypes"
+
+# Log DocTypes written on every request or error, never worth a Redis lookup
+# (an Error Log written by a failing lookup would fire the lookup again)
+IGNORED_DOCTYPES = frozenset((
+    "Error Log", "Version", "Activity Log", "Access Log", "Comment",
+    "Scheduled Job Log", "Route History", "View Log", "Deleted Document"
+))
+
+
+def _version_namespace(doctype):
+    return f"ai_context_query:{doctype}"
+
+
+def _result_name(ctx, phone_number):
+    version = get_version(_version_namespace(ctx.query_doctype))
+    # Edited contexts are new entries, the old ones expire
+    customer = phone_number if ctx.user_specific and ctx.phone_field else ""
+    return f"wa_chatbot_ai_context_query:{version}:{ctx.name}:{ctx.modified}:{customer}"
+
+
+def resolve_queries(contexts, phone_number, query):
+    """Get the results of DocType Query contexts, from the cache or the database.
+
+    Args:
+        contexts: DocType Query AI Contexts
+        phone_number: Customer, for user specific contexts
+        query: Callable(ctx) running a context's query, returning the rows or
+            None on error
+
+    Returns:
+        dict of context name -> rows (None if the query failed)
+    """
+    results = {}
+    misses = []
+    for ctx in contexts:
+        if not ctx.query_doctype:
+            continue
+
+        name = _result_name(ctx, phone_number) if ctx.cache_ttl else None
+        cached = frappe.cache.get_value(name) if name else None
+        if cached is None:
+            misses.append((ctx, name))
+        else:
+            results[ctx.name] = cached
+
+    if len(misses) > 1 and not frappe.flags.in_test:
+        # Test data is only visible to the test's own connection
+        site, sites_path = frappe.local.site, frappe.local.sites_path
+        with ThreadPoolExecutor(max_workers=min(len(misses), MAX_WORKERS)) as pool:
+            futures = [
+                pool.submit(_query_in_thread, site, sites_path, query, ctx)
+                for ctx, _ in misses
+            ]
+        rows = []
+        for (ctx, _), future in zip(misses, futures):
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                frappe.log_error(f"AI context '{ctx.title}' query thread error: {str(e)}")
+                rows.append(None)
+    else:
+        rows = [query(ctx) for ctx, _ in misses]
+
+    for (ctx, name), ctx_rows in zip(misses, rows):
+        results[ctx.name] = ctx_rows
+        if name and ctx_rows is not None:
+            frappe.cache.set_value(name, ctx_rows, expires_in_sec=ctx.cache_ttl)
+
+    return results
+
+
+def _query_in_thread(site, sites_path, query, ctx):
+    frappe.init(site=site, sites_path=sites_path)
+    try:
+        frappe.connect()
+        return query(ctx)
+    finally:
+        try:
+            frappe.db.commit()  # Error Logs of a failed query
+        finally:
+            frappe.destroy()
+
+
+def get_queried_doctypes():
+    """Get the DocTypes queried by enabled AI Contexts."""
+    from frappe_whatsapp_chatbot.chatbot.ai_responder import AI_CONTEXT_CACHE, get_ai_contexts
+
+    return get_cached(
+        AI_CONTEXT_CACHE,
+        QUERIED_DOCTYPES_KEY,
+        loader=lambda: sorted({
+            ctx.query_doctype for ctx in get_ai_contexts()
+            if ctx.context_type == "DocType Query" and ctx.query_doctype
+        }),
+        compiler=frozenset
+    )
+
+
+def invalidate_queried_doctype(doc, method=None):
+    """Doc event (any DocType): drop cached query results of a changed document's DocType."""
+    if doc.doctype in IGNORED_DOCTYPES:
+        return
+
+    try:
+        if doc.doctype in get_queried_doctypes():
+            bump_version(_version_namespace(doc.doctype))
+    except Exception:
+        # Not logged: this runs for every write, logging included. Cached
+        # results still expire after their context's Cache TTL
+        pass
@@ -0,0 +1,161 @@
+"""
+Recent text messages per conversation, for AI context.
+
+Every text WhatsApp Message, incoming or outgoing, is appended to a bounded
+Redis list per (account, phone number) once it is committed. AI history is
+read from that list instead of an OR query over the whole WhatsApp Message
+table; only a cold list (first use or after a Redis flush) is loaded from the
+database, merged with whatever was appended meanwhile.
+"""
+import frappe
+import json
+
+from frappe_whatsapp_chatbot.chatbot.cache import run_script
+from frappe_whatsapp_chatbot.chatbot.conversation_queue import get_conversation_id
+
+# Messages kept per conversation, enough for the history and its summary
+HISTORY_SIZE = 50
+
+# Idle conversations drop out of Redis, and are loaded again when needed
+HISTORY_TTL = 7 * 24 * 60 * 60
+
+# KEYS: history list, loaded flag
+# ARGV: size, ttl, message
+APPEND_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[3])
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+"""
+
+# KEYS: history list, loaded flag
+# ARGV: size, ttl, messages from the database (oldest first)...
+# Messages appended while the database was read are kept after the loaded
+# ones, unless the database rows already contain them
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local loaded = {}
+for i = 3, #ARGV do
+    loaded[cjson.decode(ARGV[i]).name] = true
+end
+local appended = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+for _, message in ipairs(appended) do
+    if not loaded[cjson.decode(message).name] then
+        redis.call('RPUSH', KEYS[1], message)
+    end
+end
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[1]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+return 1
+"""
+
+
+def _names(whatsapp_account, phone_number):
+    conversation_id = get_conversation_id(whatsapp_account, phone_number)
+    return [
+        f"wa_chatbot_history:{conversation_id}",
+        f"wa_chatbot_history_loaded:{conversation_id}"
+    ]
+
+
+def _keys(whatsapp_account, phone_number):
+    """Prefixed keys, for scripts and pipelines."""
+    return [frappe.cache.make_key(name) for name in _names(whatsapp_account, phone_number)]
+
+
+def _entry(name, message_type, message, creation):
+    return json.dumps({
+        "name": name,
+        "direction": "Incoming" if message_type == "Incoming" else "Outgoing",
+        "message": message,
+        "timestamp": str(creation) if creation else None
+    })
+
+
+def record_message(doc, method=None):
+    """Hook: append a text WhatsApp Message to its conversation's history."""
+    try:
+        if getattr(doc, "content_type", None) != "text":
+            return
+
+        if doc.type == "Incoming":
+            phone_number = getattr(doc, "from", None) or getattr(doc, "from_", None)
+        else:
+            phone_number = getattr(doc, "to", None)
+        if not phone_number:
+            return
+
+        keys = _keys(doc.whatsapp_account, phone_number)
+        entry = _entry(doc.name, doc.type, doc.message, doc.creation)
+
+        # Rolled back messages never reach the history
+        frappe.db.after_commit.add(
+            lambda: run_script(APPEND_SCRIPT, keys=keys, args=[HISTORY_SIZE, HISTORY_TTL, entry])
+        )
+
+    except Exception as e:
+        frappe.log_error(f"Chatbot record_message error: {str(e)}")
+
+
+def get_history(whatsapp_account, phone_number, limit=20, include_name=False):
+    """Get a conversation's recent text messages, oldest first.
+
+    Returns:
+        list of dicts with direction, message and timestamp (and the
+        WhatsApp Message name, with include_name)
+    """
+    history_key, loaded_key = _keys(whatsapp_account, phone_number)
+    limit = min(limit, HISTORY_SIZE)
+
+    pipeline = frappe.cache.pipeline()
+    pipeline.exists(loaded_key)
+    pipeline.lrange(history_key, -limit, -1)
+    loaded, entries = pipeline.execute()
+
+    if not loaded:
+        _load_history(whatsapp_account, phone_number)
+        # lrange prefixes the key itself
+        entries = frappe.cache.lrange(_names(whatsapp_account, phone_number)[0], -limit, -1)
+
+    history = []
+    for entry in entries:
+        entry = json.loads(entry)
+        if not include_name:
+            entry.pop("name", None)
+        history.append(entry)
+    return history
+
+
+def _load_history(whatsapp_account, phone_number):
+    """Fill a cold history list from the database."""
+    messages = frappe.get_all(
+        "WhatsApp Message",
+        filters={
+            "whatsapp_account": whatsapp_account,
+            "content_type": "text"
+        },
+        or_filters=[
+            ["from", "=", phone_number],
+            ["to", "=", phone_number]
+        ],
+        fields=["name", "type", "message", "creation"],
+        order_by="creation desc",
+        limit=HISTORY_SIZE
+    )
+
+    run_script(
+        LOAD_SCRIPT,
+        keys=_keys(whatsapp_account, phone_number),
+        args=[
+            HISTORY_SIZE,
+            HISTORY_TTL,
+            *[_entry(m.name, m.type, m.message, m.creation) for m in reversed(messages)]
+        ]
+    )
@@ -0,0 +1,400 @@
+"""
+Ordered processing of incoming messages per conversation.
+
+Messages are appended to a Redis list per (account, phone number). Only the
+worker holding the conversation's lease lock drains that list, one message at
+a time in arrival order, so messages from one user are never processed
+concurrently while different conversations still run in parallel.
+
+A message stays at the head of the list until it has been processed, so a
+lost lease or a dead worker never loses it: the conversation's next lease
+holder processes it (again).
+
+Gating, session, keyword and flow stages run on a short queue. Messages that
+fall through to the AI fallback are handed, together with the conversation's
+lease, to a separate AI queue, so slow LLM calls never delay keyword replies
+of other conversations. The lease is kept alive while the AI job waits in its
+queue, however long that takes.
+
+With a message debounce configured, the drain job waits until the user has
+stopped typing and processes the burst of text messages as one.
+"""
+import frappe
+import json
+import time
+from frappe.utils import cint
+
+from frappe_whatsapp_chatbot.chatbot.cache import run_script
+from frappe_whatsapp_chatbot.chatbot.settings import get_settings
+
+# Queue for the gating, session, keyword and flow stages
+FAST_QUEUE = "short"
+
+# Queue for the AI fallback stage, when not overridden in site config
+# (whatsapp_chatbot_ai_queue); a dedicated queue gets its own worker pool
+DEFAULT_AI_QUEUE = "long"
+
+# Conversations that have queued messages, used to recover from dead workers
+PENDING_CONVERSATIONS_KEY = "wa_chatbot_pending_conversations"
+
+# Hash of conversation id -> AI job holding its lease (json token and job id)
+AI_HANDOFFS_KEY = "wa_chatbot_ai_handoffs"
+
+# Lease duration, renewed before each message; must exceed the slowest
+# message (AI calls included), a dead worker's lease is taken over after it
+LEASE_TTL_MS = 10 * 60 * 1000
+
+# A drain job hands the lease to a fresh job after this many messages, so a
+# chatty conversation cannot hold a worker past the job timeout
+MESSAGES_PER_JOB = 20
+
+# Upper bound on how long a burst of messages can delay its reply
+MAX_DEBOUNCE_WAIT = 10
+
+# Queued messages older than this are dropped with the list
+QUEUE_TTL = 24 * 60 * 60
+
+# KEYS: lock, queue, pending set
+# ARGV: message, token, conversation id, lease ms, queue ttl
+# Returns 1 if the caller acquired the lease and must start a drain job
+PUSH_SCRIPT = """
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('SADD', KEYS[3], ARGV[3])
+if redis.call('SET', KEYS[1], ARGV[2], 'NX', 'PX', ARGV[4]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: lock
+# ARGV: token, lease ms
+# Returns 1 if the lease is still held by the token (and has been extended)
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: lock, queue, pending set
+# ARGV: token, lease ms, conversation id, max messages
+# Returns the next messages, left in the queue until acknowledged, or nil once
+# the queue is empty (the lease is then released in the same step, so a
+# message pushed meanwhile starts a new drain) or the lease has been lost
+NEXT_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return nil
+end
+local messages = redis.call('LRANGE', KEYS[2], 0, tonumber(ARGV[4]) - 1)
+if #messages > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return messages
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[3], ARGV[3])
+return nil
+"""
+
+# KEYS: lock, queue
+# ARGV: token, number of processed messages, lease ms
+# Removes processed messages from the head of the queue; returns 1 if the
+# lease is still held by the token (and has been extended)
+ACK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('LTRIM', KEYS[2], ARGV[2], -1)
+return redis.call('PEXPIRE', KEYS[1], ARGV[3])
+"""
+
+# KEYS: handoffs hash
+# ARGV: conversation id, token
+# Removes the conversation's handoff if it is still the token's
+CLEAR_HANDOFF_SCRIPT = """
+local handoff = redis.call('HGET', KEYS[1], ARGV[1])
+if handoff and cjson.decode(handoff)['token'] == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+def get_conversation_id(whatsapp_account, phone_number):
+    return f"{whatsapp_account or ''}|{phone_number}"
+
+
+def _keys(conversation_id):
+    return [
+        frappe.cache.make_key(f"wa_chatbot_conversation_lock:{conversation_id}"),
+        frappe.cache.make_key(f"wa_chatbot_conversation_queue:{conversation_id}"),
+        frappe.cache.make_key(PENDING_CONVERSATIONS_KEY)
+    ]
+
+
+def enqueue_message(message_data):
+    """Queue an incoming message behind earlier messages of the same conversation.
+
+    Args:
+        message_data: dict as built by process_incoming_message
+    """
+    whatsapp_account = message_data.get("whatsapp_account")
+    phone_number = message_data.get("from")
+    conversation_id = get_conversation_id(whatsapp_account, phone_number)
+    token = frappe.generate_hash(length=12)
+    message_data = dict(message_data, received_at=time.time())
+
+    acquired = run_script(
+        PUSH_SCRIPT,
+        keys=_keys(conversation_id),
+        args=[
+            json.dumps(message_data, default=str),
+            token,
+            conversation_id,
+            LEASE_TTL_MS,
+            QUEUE_TTL
+        ]
+    )
+    if acquired:
+        _enqueue_drain(whatsapp_account, phone_number, token)
+
+
+def get_ai_queue():
+    """Get the name of the queue that runs the AI fallback stage."""
+    return frappe.conf.get("whatsapp_chatbot_ai_queue") or DEFAULT_AI_QUEUE
+
+
+def _enqueue_drain(whatsapp_account, phone_number, token):
+    frappe.enqueue(
+        "frappe_whatsapp_chatbot.chatbot.conversation_queue.process_conversation",
+        queue=FAST_QUEUE,
+        whatsapp_account=whatsapp_account,
+        phone_number=phone_number,
+        token=token,
+        now=frappe.flags.in_test
+    )
+
+
+def _ack(keys, token, count):
+    """Remove processed messages from the queue; False if the lease was lost."""
+    return bool(run_script(ACK_SCRIPT, keys=keys[:2], args=[token, count, LEASE_TTL_MS]))
+
+
+def process_conversation(whatsapp_account, phone_number, token):
+    """Background job: process a conversation's queued messages in order.
+
+    Args:
+        whatsapp_account: WhatsApp account of the conversation
+        phone_number: The customer's phone number
+        token: Lease token held by this job
+    """
+    from frappe_whatsapp_chatbot.chatbot.processor import run_fast_path
+
+    conversation_id = get_conversation_id(whatsapp_account, phone_number)
+    keys = _keys(conversation_id)
+    debounce_ms = cint(get_settings().message_debounce_ms)
+
+    processed = 0
+    while processed < MESSAGES_PER_JOB:
+        if debounce_ms:
+            _wait_for_burst_end(keys[1], debounce_ms)
+
+        messages = run_script(
+            NEXT_SCRIPT,
+            keys=keys,
+            args=[token, LEASE_TTL_MS, conversation_id, MESSAGES_PER_JOB if debounce_ms else 1]
+        )
+        if not messages:
+            return
+
+        messages = [json.loads(message) for message in messages]
+        # (message, number of queued messages it consumes)
+        batch = group_messages(messages) if debounce_ms else [(message, 1) for message in messages]
+
+        # Each message's writes are committed by its processing stage, before
+        # the next message reads the session
+        for message_data, count in batch:
+            if run_fast_path(message_data):
+                # The AI job holds the lease until it has replied, then
+                # continues with the rest of the conversation
+                _hand_off_to_ai(conversation_id, message_data, token, count)
+                return
+
+            if not _ack(keys, token, count):
+                return  # Lease lost, its new holder continues from the queue
+
+        processed += len(batch)
+
+    # Still holding the lease, continue in a new job at the back of the queue
+    _enqueue_drain(whatsapp_account, phone_number, token)
+
+
+def _hand_off_to_ai(conversation_id, message_data, token, count):
+    job_id = f"wa_chatbot_ai_fallback:{frappe.generate_hash(length=12)}"
+
+    # Lets recover_conversations keep the lease alive while the job waits.
+    # Raw HSET, the handoff is json read by scripts, not pickled
+    pipeline = frappe.cache.pipeline()
+    pipeline.hset(
+        frappe.cache.make_key(AI_HANDOFFS_KEY),
+        conversation_id,
+        json.dumps({"token": token, "job_id": job_id})
+    )
+    pipeline.execute()
+
+    frappe.enqueue(
+        "frappe_whatsapp_chatbot.chatbot.conversation_queue.process_ai_fallback",
+        queue=get_ai_queue(),
+        job_id=job_id,
+        message_data=message_data,
+        token=token,
+        count=count,
+        now=frappe.flags.in_test
+    )
+
+
+def _clear_handoff(conversation_id, token):
+    run_script(
+        CLEAR_HANDOFF_SCRIPT,
+        keys=[frappe.cache.make_key(AI_HANDOFFS_KEY)],
+        args=[conversation_id, token]
+    )
+
+
+def process_ai_fallback(message_data, token, count):
+    """Background job (AI queue): reply to one message with the AI fallback.
+
+    Args:
+        message_data: The message, still at the head of the conversation's queue
+        token: Lease token handed over by the drain job
+        count: Number of queued messages the message consumes
+    """
+    from frappe_whatsapp_chatbot.chatbot.processor import run_fallback
+
+    whatsapp_account = message_data.get("whatsapp_account")
+    phone_number = message_data.get("from")
+    conversation_id = get_conversation_id(whatsapp_account, phone_number)
+    keys = _keys(conversation_id)
+
+    if not run_script(RENEW_SCRIPT, keys=[keys[0]], args=[token, LEASE_TTL_MS]):
+        # Lease lost: the message is still queued and the new lease holder
+        # replies to it, in order
+        _clear_handoff(conversation_id, token)
+        return
+
+    try:
+        run_fallback(message_data)
+    finally:
+        _clear_handoff(conversation_id, token)
+        # Consumed even if the reply failed, so it is not retried forever;
+        # a killed worker leaves it queued for the next lease holder
+        if _ack(keys, token, count):
+            _enqueue_drain(whatsapp_account, phone_number, token)
+
+
+def get_queue_depths():
+    """Get the backlog of each chatbot pipeline stage.
+
+    Returns:
+        dict with the number of jobs waiting on the fast and AI queues and
+        the number of conversations with queued messages
+    """
+    from frappe.utils.background_jobs import get_queue
+
+    ai_queue = get_ai_queue()
+    return {
+        FAST_QUEUE: get_queue(FAST_QUEUE).count,
+        ai_queue: get_queue(ai_queue).count,
+        "pending_conversations": frappe.cache.scard(frappe.cache.make_key(PENDING_CONVERSATIONS_KEY))
+    }
+
+
+def _wait_for_burst_end(queue_key, debounce_ms):
+    """Sleep until the newest queued message is debounce_ms old."""
+    deadline = time.monotonic() + MAX_DEBOUNCE_WAIT
+    while True:
+        newest = frappe.cache.lindex(queue_key, -1)
+        if not newest:
+            return
+
+        wait = json.loads(newest).get("received_at", 0) + debounce_ms / 1000 - time.time()
+        wait = min(wait, deadline - time.monotonic())
+        if wait <= 0:
+            return
+        time.sleep(wait)
+
+
+def group_messages(messages):
+    """Merge consecutive text messages of a burst into one message.
+
+    Button and flow responses are kept as they are. A merged message takes
+    the name of its last part, so scripts see the latest WhatsApp Message.
+
+    Returns:
+        list of (message, number of messages merged into it)
+    """
+    merged = []
+    for message in messages:
+        previous = merged[-1][0] if merged else None
+        if previous and previous.get("content_type") == "text" and message.get("content_type") == "text":
+            merged[-1] = (
+                dict(
+                    previous,
+                    name=message.get("name"),
+                    message="\n".join(filter(None, [previous.get("message"), message.get("message")]))
+                ),
+                merged[-1][1] + 1
+            )
+        else:
+            merged.append((message, 1))
+    return merged
+
+
+def recover_conversations():
+    """Restart draining of conversations whose lease holder has died.
+
+    Runs every minute. Leases handed to AI jobs are extended while the job
+    is queued or running. A conversation with queued messages but no lease
+    (expired after a worker crash) gets a new lease and drain job.
+    """
+    renew_ai_handoffs()
+
+    # smembers prefixes the key itself
+    for conversation_id in frappe.cache.smembers(PENDING_CONVERSATIONS_KEY) or []:
+        conversation_id = frappe.safe_decode(conversation_id)
+        lock_key = _keys(conversation_id)[0]
+
+        token = frappe.generate_hash(length=12)
+        if not frappe.cache.set(lock_key, token, nx=True, px=LEASE_TTL_MS):
+            continue  # Still being drained
+
+        # An empty queue is released by the drain job itself, atomically
+        whatsapp_account, _, phone_number = conversation_id.rpartition("|")
+        _enqueue_drain(whatsapp_account or None, phone_number, token)
+
+
+def renew_ai_handoffs():
+    """Extend the leases held by AI jobs that are still queued or running.
+
+    A job that no longer exists (its worker was killed) lets the lease
+    expire, and the conversation is then recovered with its message still
+    queued.
+    """
+    from frappe.utils.background_jobs import is_job_enqueued
+
+    handoffs_key = frappe.cache.make_key(AI_HANDOFFS_KEY)
+    # Raw HGETALL, the handoffs are json written by scripts, not pickled
+    pipeline = frappe.cache.pipeline()
+    pipeline.hgetall(handoffs_key)
+
+    for conversation_id, handoff in pipeline.execute()[0].items():
+        conversation_id = frappe.safe_decode(conversation_id)
+        handoff = json.loads(handoff)
+        if is_job_enqueued(handoff["job_id"]):
+            run_script(
+                RENEW_SCRIPT,
+                keys=[_keys(conversation_id)[0]],
+                args=[handoff["token"], LEASE_TTL_MS]
+            )
+        else:
+            run_script(CLEAR_HANDOFF_SCRIPT, keys=[handoffs_key], args=[conversation_id, handoff["token"]])
@@ -0,0 +1,236 @@
+"""
+Rolling summaries of long conversations, for compact AI prompts.
+
+The AI gets the last few messages of a conversation verbatim and everything
+before them as a running summary. The summary state (text, and the last
+message folded into it) is kept per conversation in Redis, and only messages
+that have left the verbatim window since the last fold are folded in, so a
+turn never re-reads or re-summarizes the whole history.
+
+Summarizers are pluggable: the extractive one runs inline, the AI one folds
+in a background job, batching whatever arrived while it was queued.
+"""
+import abc
+import re
+
+import frappe
+
+from frappe_whatsapp_chatbot.chatbot.cache import run_script
+from frappe_whatsapp_chatbot.chatbot.conversation_history import HISTORY_SIZE, HISTORY_TTL, get_history
+from frappe_whatsapp_chatbot.chatbot.conversation_queue import get_conversation_id
+from frappe_whatsapp_chatbot.chatbot.settings import get_settings
+
+# Background folds of a conversation are not queued more often than this
+FOLD_JOB_TTL = 5 * 60
+
+# KEYS: summary hash
+# ARGV: expected last folded message, summary, last folded message, ttl
+# Returns 1 if saved, 0 if another fold got there first
+SAVE_SCRIPT = """
+if (redis.call('HGET', KEYS[1], 'through') or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'summary', ARGV[2], 'through', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class Summarizer(abc.ABC):
+    """
+    Folds messages into a running summary.
+
+    Subclasses implement fold(); background summarizers are run from a job
+    instead of the AI turn that needs the summary.
+    """
+
+    background = False
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    @abc.abstractmethod
+    def fold(self, summary, messages):
+        """Fold messages (oldest first) into the summary.
+
+        Args:
+            summary: Current summary text ("" if none)
+            messages: list of dicts with direction and message
+
+        Returns:
+            The new summary, or None if it could not be built
+        """
+
+
+class ExtractiveSummarizer(Summarizer):
+    """Keep the first sentence of the customer's latest messages."""
+
+    max_lines = 10
+    max_line_length = 120
+
+    def fold(self, summary, messages):
+        lines = [line for line in (summary or "").split("\n") if line]
+        for msg in messages:
+            if msg.get("direction") != "Incoming":
+                continue
+            text = re.split(r"(?<=[.!?])\s|\n", (msg.get("message") or "").strip(), maxsplit=1)[0]
+            line = f"- {text[:self.max_line_length]}"
+            if text and line not in lines:
+                lines.append(line)
+        return "\n".join(lines[-self.max_lines:])
+
+
+class AISummarizer(Summarizer):
+    """Update the summary with the configured AI provider."""
+
+    background = True
+
+    system_prompt = (
+        "You maintain a running summary of a customer conversation. Update the "
+        "summary with the new messages. Keep names, order or reference numbers, "
+        "requests and open questions; drop greetings and small talk. Reply with "
+        "the updated summary only, at most 100 words."
+    )
+
+    def fold(self, summary, messages):
+        from frappe_whatsapp_chatbot.chatbot.ai_responder import AIResponder
+
+        responder = AIResponder(self.settings)
+        responder.system_prompt = self.system_prompt
+        responder.include_history = False
+        responder.cache_ttl = 0  # Transcripts never repeat
+        responder.build_context = lambda: []
+
+        transcript = "\n".join(
+            f"{'Customer' if msg.get('direction') == 'Incoming' else 'Assistant'}: {msg.get('message')}"
+            for msg in messages
+        )
+        return responder.generate_response(
+            f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+        )
+
+
+SUMMARIZERS = {
+    "Extractive": ExtractiveSummarizer,
+    "AI": AISummarizer
+}
+
+
+def get_summarizer(settings):
+    return SUMMARIZERS.get(settings.ai_summarizer or "Extractive", ExtractiveSummarizer)(settings)
+
+
+def _names(whatsapp_account, phone_number):
+    conversation_id = get_conversation_id(whatsapp_account, phone_number)
+    return [
+        f"wa_chatbot_summary:{conversation_id}",
+        f"wa_chatbot_summary_job:{conversation_id}"
+    ]
+
+
+def get_summarized_history(whatsapp_account, phone_number, recent=4):
+    """Get the last messages of a conversation, preceded by a summary of the rest.
+
+    Args:
+        recent: Number of messages kept verbatim
+
+    Returns:
+        list of dicts with direction, message and timestamp, oldest first;
+        the summary (if any) is the first item, with direction "System"
+    """
+    summarizer = get_summarizer(get_settings())
+    if summarizer.background:
+        summary, _, messages, pending = _load(whatsapp_account, phone_number, recent)
+        if pending:
+            # The current summary is used until the job has folded them in
+            _enqueue_fold(whatsapp_account, phone_number, recent)
+    else:
+        summary, messages = _fold(summarizer, whatsapp_account, phone_number, recent)
+
+    history = []
+    if summary:
+        history.append({
+            "direction": "System",
+            "message": f"Summary of the earlier conversation:\n{summary}",
+            "timestamp": None
+        })
+    for msg in messages:
+        msg.pop("name", None)
+        history.append(msg)
+    return history
+
+
+def _load(whatsapp_account, phone_number, recent):
+    """Get the summary state, the verbatim messages and the messages not folded yet.
+
+    Returns:
+        (summary, last folded message, verbatim messages, pending messages)
+    """
+    messages = get_history(whatsapp_account, phone_number, HISTORY_SIZE, include_name=True)
+    split = max(len(messages) - recent, 0)
+    older, messages = messages[:split], messages[split:]
+
+    summary_key = frappe.cache.make_key(_names(whatsapp_account, phone_number)[0])
+    summary, through = [
+        frappe.safe_decode(value) if value else ""
+        for value in frappe.cache.hmget(summary_key, ["summary", "through"])
+    ]
+
+    names = [msg.get("name") for msg in older]
+    if through in names:
+        pending = older[names.index(through) + 1:]
+    elif through and through in [msg.get("name") for msg in messages]:
+        pending = []  # The verbatim window has grown past the summary
+    else:
+        pending = older  # New summary, or its last message rotated out
+
+    return summary, through, messages, pending
+
+
+def _fold(summarizer, whatsapp_account, phone_number, recent):
+    """Fold the pending messages into the summary and save it.
+
+    Returns:
+        (summary, verbatim messages)
+    """
+    summary, through, messages, pending = _load(whatsapp_account, phone_number, recent)
+    if not pending:
+        return summary, messages
+
+    folded = summarizer.fold(summary, pending)
+    if folded is None:
+        return summary, messages  # Tried again with the next turn
+
+    # Not saved if another fold has moved the summary on meanwhile
+    run_script(
+        SAVE_SCRIPT,
+        keys=[frappe.cache.make_key(_names(whatsapp_account, phone_number)[0])],
+        args=[through, folded, pending[-1]["name"], HISTORY_TTL]
+    )
+    return folded, messages
+
+
+def _enqueue_fold(whatsapp_account, phone_number, recent):
+    job_key = frappe.cache.make_key(_names(whatsapp_account, phone_number)[1])
+    if not frappe.cache.set(job_key, 1, nx=True, ex=FOLD_JOB_TTL):
+        return  # Already queued, it folds these messages as well
+
+    frappe.enqueue(
+        "frappe_whatsapp_chatbot.chatbot.conversation_summary.fold_summary",
+        queue="long",
+        whatsapp_account=whatsapp_account,
+        phone_number=phone_number,
+        recent=recent,
+        now=frappe.flags.in_test
+    )
+
+
+def fold_summary(whatsapp_account, phone_number, recent=4):
+    """Background job: fold a conversation's pending messages into its summary."""
+    try:
+        _fold(get_summarizer(get_settings()), whatsapp_account, phone_number, recent)
+    except Exception as e:
+        frappe.log_error(f"Chatbot fold_summary error: {str(e)}")
+    finally:
+        # delete_value prefixes the key itself
+        frappe.cache.delete_value(_names(whatsapp_account, phone_number)[1])
@@ -0,0 +1,125 @@
+"""
+Composite indexes for the chatbot's hot-path queries.
+
+The indexes are created by a patch (and on install). check_indexes reports
+missing indexes and the EXPLAIN plan of each hot query, see the
+`bench --site <site> chatbot-check-indexes` command.
+"""
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+# (doctype, index name, columns)
+HOT_PATH_INDEXES = [
+    # SessionManager.get_active_session / session_store.get_session_state
+    ("WhatsApp Chatbot Session", "phone_number_whatsapp_account_status_index",
+        ["phone_number", "whatsapp_account", "status"]),
+    # cleanup_expired_sessions
+    ("WhatsApp Chatbot Session", "status_last_activity_index", ["status", "last_activity"]),
+    # Agent transfer lookups and the transferred numbers set
+    ("WhatsApp Agent Transfer", "phone_number_status_index", ["phone_number", "status"]),
+    # get_conversation_history: one index per side of the from/to OR
+    ("WhatsApp Message", "from_whatsapp_account_content_type_creation_index",
+        ["`from`", "whatsapp_account", "content_type", "creation"]),
+    ("WhatsApp Message", "to_whatsapp_account_content_type_creation_index",
+        ["`to`", "whatsapp_account", "content_type", "creation"]),
+    # get_session_messages
+    ("WhatsApp Session Message", "session_creation_index", ["session", "creation"]),
+]
+
+# (label, query) mirroring the queries the indexes are meant for
+HOT_QUERIES = [
+    (
+        "Active session lookup",
+        """SELECT `name` FROM `tabWhatsApp Chatbot Session`
+        WHERE `phone_number` = %(phone)s AND `whatsapp_account` = %(account)s
+            AND `status` = 'Active'"""
+    ),
+    (
+        "Expired sessions",
+        """SELECT `name` FROM `tabWhatsApp Chatbot Session`
+        WHERE `status` = 'Active' AND `last_activity` < %(threshold)s
+        ORDER BY `name` LIMIT 500"""
+    ),
+    (
+        "Active agent transfer",
+        """SELECT `name` FROM `tabWhatsApp Agent Transfer`
+        WHERE `phone_number` = %(phone)s AND `status` = 'Active'"""
+    ),
+    (
+        "Conversation history",
+        """SELECT `type`, `message`, `creation` FROM `tabWhatsApp Message`
+        WHERE `whatsapp_account` = %(account)s AND `content_type` = 'text'
+            AND (`from` = %(phone)s OR `to` = %(phone)s)
+        ORDER BY `creation` DESC LIMIT 20"""
+    ),
+    (
+        "Session message history",
+        """SELECT `direction`, `message` FROM `tabWhatsApp Session Message`
+        WHERE `session` = %(session)s
+        ORDER BY `creation` DESC LIMIT 20"""
+    ),
+]
+
+
+def ensure_indexes():
+    """Create any missing hot-path index (idempotent)."""
+    for doctype, index_name, columns in HOT_PATH_INDEXES:
+        if not frappe.db.table_exists(doctype):
+            continue  # e.g. frappe_whatsapp not migrated yet
+        frappe.db.add_index(doctype, columns, index_name=index_name)
+
+
+def get_missing_indexes():
+    """Get the hot-path indexes that don't exist in the database."""
+    return [
+        (doctype, index_name, columns)
+        for doctype, index_name, columns in HOT_PATH_INDEXES
+        if frappe.db.table_exists(doctype)
+        and not frappe.db.has_index(f"tab{doctype}", index_name)
+    ]
+
+
+def explain_hot_queries():
+    """Get the EXPLAIN plan of each hot query.
+
+    Returns:
+        list of (label, plan rows) tuples
+    """
+    values = {
+        "phone": "0000000000",
+        "account": "",
+        "session": "",
+        "threshold": add_to_date(now_datetime(), hours=-1)
+    }
+
+    plans = []
+    for label, query in HOT_QUERIES:
+        try:
+            plans.append((label, frappe.db.sql(f"EXPLAIN {query}", values, as_dict=True)))
+        except Exception as e:
+            # Table missing (e.g. frappe_whatsapp not installed)
+            plans.append((label, [{"error": str(e)}]))
+    return plans
+
+
+def check_indexes():
+    """Report missing hot-path indexes and full scans in the hot query plans.
+
+    Returns:
+        dict with "missing" indexes and "plans" per hot query, where each
+        plan row notes if it is a full table scan
+    """
+    plans = []
+    for label, rows in explain_hot_queries():
+        for row in rows:
+            # MariaDB reports a full scan as access type ALL
+            row["full_scan"] = row.get("type") == "ALL"
+        plans.append({"query": label, "plan": rows})
+
+    return {
+        "missing": [
+            {"doctype": doctype, "index": index_name, "columns": columns}
+            for doctype, index_name, columns in get_missing_indexes()
+        ],
+        "plans": plans
+    }
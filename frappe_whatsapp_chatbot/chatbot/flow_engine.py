@@ -3,52 +3,43 @@ import json
 import re
 from datetime import datetime
 
-
-def parse_json(value, default=None):
-    """Safely parse JSON - handles both string and already-parsed dict/list."""
-    if value is None:
-        return default if default is not None else {}
-    if isinstance(value, (dict, list)):
-        return value
-    if isinstance(value, str):
-        try:
-            return json.loads(value)
-        except (json.JSONDecodeError, TypeError):
-            return default if default is not None else {}
-    return default if default is not None else {}
+from frappe_whatsapp_chatbot.chatbot.flow_graph import (
+    get_compiled_flow,
+    get_flow_triggers,
+    normalize_trigger,
+    parse_json
+)
+from frappe_whatsapp_chatbot.chatbot.session_store import SessionState
+from frappe_whatsapp_chatbot.chatbot.unit_of_work import UnitOfWork
 
 
 class FlowEngine:
     """Execute conversation flows."""
 
-    def __init__(self, phone_number, whatsapp_account):
+    def __init__(self, phone_number, whatsapp_account, unit_of_work=None):
+        """
+        Args:
+            phone_number: The customer's phone number
+            whatsapp_account: WhatsApp account of the conversation
+            unit_of_work: UnitOfWork collecting this message's writes; without
+                one, every change is committed right away
+        """
         self.phone_number = phone_number
         self.account = whatsapp_account
+        self.uow = unit_of_work or UnitOfWork(immediate=True)
 
     def check_flow_trigger(self, message_text, button_payload=None):
         """Check if message triggers any flow."""
         try:
-            flows = frappe.get_all(
-                "WhatsApp Chatbot Flow",
-                filters={"enabled": 1},
-                fields=["name", "trigger_keywords", "trigger_on_button", "whatsapp_account"]
-            )
-
-            for flow in flows:
-                # Check account filter
-                if flow.whatsapp_account and flow.whatsapp_account != self.account:
-                    continue
+            triggers = get_flow_triggers(self.account)
 
-                # Check button trigger
-                if button_payload and flow.trigger_on_button:
-                    if button_payload == flow.trigger_on_button:
-                        return flow.name
+            # Check button trigger
+            if button_payload and button_payload in triggers["buttons"]:
+                return triggers["buttons"][button_payload]
 
-                # Check keyword trigger
-                if flow.trigger_keywords and message_text:
-                    keywords = [k.strip().lower() for k in flow.trigger_keywords.split(",") if k.strip()]
-                    if message_text.lower() in keywords:
-                        return flow.name
+            # Check keyword trigger
+            if message_text:
+                return triggers["keywords"].get(normalize_trigger(message_text))
 
             return None
 
@@ -59,18 +50,17 @@ class FlowEngine:
     def start_flow(self, flow_name):
         """Start a new conversation flow."""
         try:
-            flow = frappe.get_doc("WhatsApp Chatbot Flow", flow_name)
+            flow = get_compiled_flow(flow_name)
 
             if not flow.steps:
                 frappe.log_error(f"Flow '{flow_name}' has no steps")
                 return None
 
             # Get first step
-            first_step = sorted(flow.steps, key=lambda x: x.idx)[0]
+            first_step = flow.first_step
 
             # Create session
-            session = frappe.get_doc({
-                "doctype": "WhatsApp Chatbot Session",
+            session = SessionState({
                 "phone_number": self.phone_number,
                 "whatsapp_account": self.account,
                 "status": "Active",
@@ -80,8 +70,7 @@ class FlowEngine:
                 "started_at": datetime.now(),
                 "last_activity": datetime.now()
             })
-            session.insert(ignore_permissions=True)
-            frappe.db.commit()
+            self.uow.save(session)
 
             # Build and return initial message
             if flow.initial_message_type == "Template" and flow.initial_template:
@@ -114,24 +103,18 @@ class FlowEngine:
     def process_input(self, session, user_input, button_payload=None):
         """Process user input in active flow."""
         try:
-            flow = frappe.get_doc("WhatsApp Chatbot Flow", session.current_flow)
+            flow = get_compiled_flow(session.current_flow)
 
             # Check for cancel keywords
-            if flow.cancel_keywords:
-                cancel_words = [w.strip().lower() for w in flow.cancel_keywords.split(",") if w.strip()]
-                if user_input.lower() in cancel_words:
+            if flow.cancel_words:
+                if user_input.lower() in flow.cancel_words:
                     session.status = "Cancelled"
                     session.completed_at = datetime.now()
-                    session.save(ignore_permissions=True)
-                    frappe.db.commit()
+                    self.uow.save(session)
                     return "Your request has been cancelled."
 
             # Find current step
-            current_step = None
-            for step in flow.steps:
-                if step.step_name == session.current_step:
-                    current_step = step
-                    break
+            current_step = flow.get_step(session.current_step)
 
             if not current_step:
                 return self.complete_flow(session, flow)
@@ -148,8 +131,7 @@ class FlowEngine:
                     max_retries = current_step.max_retries or 3
 
                     if current_step.retry_on_invalid and session.step_retries < max_retries:
-                        session.save(ignore_permissions=True)
-                        frappe.db.commit()
+                        self.uow.save(session)
                         return error or current_step.validation_error or "Invalid input. Please try again."
                     else:
                         # Max retries reached, transfer to agent
@@ -165,20 +147,15 @@ class FlowEngine:
             session.add_message("Incoming", user_input, current_step.step_name)
 
             # Determine next step
-            next_step_name = self.get_next_step(current_step, flow.steps, user_input, button_payload)
+            next_step_name = self.get_next_step(current_step, flow, user_input, button_payload)
 
             if not next_step_name:
                 # No next step, complete flow
-                session.save(ignore_permissions=True)
-                frappe.db.commit()
+                self.uow.save(session)
                 return self.complete_flow(session, flow)
 
             # Find next step
-            next_step = None
-            for step in flow.steps:
-                if step.step_name == next_step_name:
-                    next_step = step
-                    break
+            next_step = flow.get_step(next_step_name)
 
             if not next_step:
                 return self.complete_flow(session, flow)
@@ -188,21 +165,17 @@ class FlowEngine:
             if next_step.skip_condition:
                 if self.evaluate_skip_condition(next_step.skip_condition, session_data):
                     # Skip this step, find the one after
-                    next_step_name = self.get_next_step(next_step, flow.steps, None, None)
+                    next_step_name = self.get_next_step(next_step, flow, None, None)
                     if not next_step_name:
                         return self.complete_flow(session, flow)
 
-                    for step in flow.steps:
-                        if step.step_name == next_step_name:
-                            next_step = step
-                            break
+                    next_step = flow.get_step(next_step_name) or next_step
 
             # Update session
             session.current_step = next_step.step_name
             session.step_retries = 0
             session.last_activity = datetime.now()
-            session.save(ignore_permissions=True)
-            frappe.db.commit()
+            self.uow.save(session)
 
             # Determine next step
             if next_step.input_type == "Transfer to Agent":
@@ -214,8 +187,7 @@ class FlowEngine:
             # Log outgoing message
             if isinstance(response, str):
                 session.add_message("Outgoing", response, next_step.step_name)
-            session.save(ignore_permissions=True)
-            frappe.db.commit()
+            self.uow.save(session)
 
             return response
 
@@ -247,9 +219,8 @@ class FlowEngine:
             return False, "Please provide a response."
 
         if input_type == "Select":
-            if step.options:
-                options = [o.strip().lower() for o in step.options.split("|") if o.strip()]
-                if user_input.lower() not in options:
+            if step.option_values:
+                if user_input.lower() not in step.option_values:
                     return False, f"Please choose one of: {step.options.replace('|', ', ')}"
 
         elif input_type == "Number":
@@ -281,45 +252,31 @@ class FlowEngine:
             if not valid_date:
                 return False, "Please enter a valid date (e.g., DD-MM-YYYY)."
 
-        # Custom regex validation
-        if step.validation_regex:
-            try:
-                if not re.match(step.validation_regex, user_input):
-                    return False, step.validation_error or "Invalid format."
-            except re.error:
-                pass  # Invalid regex, skip validation
+        # Custom regex validation (invalid patterns are skipped at compile time)
+        if step.validation_pattern:
+            if not step.validation_pattern.match(user_input):
+                return False, step.validation_error or "Invalid format."
 
         return True, None
 
-    def get_next_step(self, current_step, all_steps, user_input, button_payload):
+    def get_next_step(self, current_step, flow, user_input, button_payload):
         """Determine the next step based on input."""
         # Check conditional next
-        if current_step.conditional_next:
-            conditions = parse_json(current_step.conditional_next, {})
-            if conditions:
-                response_key = button_payload or (user_input.lower() if user_input else "")
+        conditions = current_step.conditions
+        if conditions:
+            response_key = button_payload or (user_input.lower() if user_input else "")
 
-                if response_key in conditions:
-                    return conditions[response_key]
-                if "default" in conditions:
-                    return conditions["default"]
+            if response_key in conditions:
+                return conditions[response_key]
+            if "default" in conditions:
+                return conditions["default"]
 
         # Use explicit next step
         if current_step.next_step:
             return current_step.next_step
 
         # Find next step by order
-        sorted_steps = sorted(all_steps, key=lambda x: x.idx)
-        current_idx = None
-        for i, step in enumerate(sorted_steps):
-            if step.step_name == current_step.step_name:
-                current_idx = i
-                break
-
-        if current_idx is not None and current_idx < len(sorted_steps) - 1:
-            return sorted_steps[current_idx + 1].step_name
-
-        return None
+        return flow.successors.get(current_step.step_name)
 
     def build_step_message(self, step, session):
         """Build message for a step with variable substitution."""
@@ -345,14 +302,12 @@ class FlowEngine:
             return message
 
         # Add buttons if defined
-        if step.input_type == "Button" and step.buttons:
-            buttons = parse_json(step.buttons, [])
-            if buttons:
-                return {
-                    "message": message,
-                    "content_type": "interactive",
-                    "buttons": json.dumps(buttons) if isinstance(buttons, list) else buttons
-                }
+        if step.input_type == "Button" and step.buttons_payload:
+            return {
+                "message": message,
+                "content_type": "interactive",
+                "buttons": step.buttons_payload
+            }
 
         # Handle WhatsApp Flow
         if step.input_type == "WhatsApp Flow" and step.whatsapp_flow:
@@ -391,20 +346,20 @@ class FlowEngine:
         try:
             session.status = "Completed"
             session.completed_at = datetime.now()
-            session.save(ignore_permissions=True)
 
             # Get session data
             session_data = parse_json(session.session_data, {})
 
-            # Execute completion action
+            # Execute completion action (the created document is committed
+            # together with the session, the API is only called afterwards)
             if flow.on_complete_action == "Create Document":
                 self.create_document(flow, session_data)
             elif flow.on_complete_action == "Call API":
-                self.call_api(flow.api_endpoint, session_data)
+                self.uow.after_commit(lambda: self.call_api(flow.api_endpoint, session_data))
             elif flow.on_complete_action == "Run Script":
                 self.run_script(flow.custom_script, session_data)
 
-            frappe.db.commit()
+            self.uow.save(session)
 
             # Build completion message with variable substitution
             completion_msg = flow.completion_message or "Thank you! Your request has been submitted."
@@ -458,7 +413,6 @@ class FlowEngine:
 
             doc = frappe.get_doc(doc_data)
             doc.insert(ignore_permissions=True)
-            frappe.db.commit()
 
             frappe.log_error(
                 f"create_document: Successfully created {flow.create_doctype} with data: {doc_data}",
@@ -513,8 +467,8 @@ class FlowEngine:
         if not flow_response:
             return session_data
 
-        # Get field mapping from step
-        field_mapping = parse_json(step.flow_field_mapping, {})
+        # Field mapping is parsed when the flow is compiled
+        field_mapping = step.flow_field_map
 
         if field_mapping:
             # Map flow fields to session variables based on mapping
@@ -561,14 +515,12 @@ class FlowEngine:
                 "status": "Active",
                 "notes": reason or "Transferred from AI Chatbot"
             })
-            transfer.insert(ignore_permissions=True)
+            self.uow.save(transfer)
             
             # Update session
             session.status = "Handed Over"
             session.completed_at = datetime.now()
-            session.save(ignore_permissions=True)
-            
-            frappe.db.commit()
+            self.uow.save(session)
             
             return "Saya akan menghubungkan Anda dengan agen kami. Mohon tunggu sebentar..."
         except Exception as e:
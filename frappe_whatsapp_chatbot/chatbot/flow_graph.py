@@ -0,0 +1,153 @@
+import frappe
+import json
+import re
+from types import MappingProxyType
+
+from frappe_whatsapp_chatbot.chatbot.cache import ReadOnlyDoc, bump_version, get_cached
+
+# Cache namespace prefix for compiled flows, one namespace per flow
+FLOW_GRAPH_CACHE = "flow_graph"
+
+# Cache namespace for per-account flow trigger indexes
+FLOW_TRIGGER_CACHE = "flow_triggers"
+
+
+def parse_json(value, default=None):
+    """Safely parse JSON - handles both string and already-parsed dict/list."""
+    if value is None:
+        return default if default is not None else {}
+    if isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except (json.JSONDecodeError, TypeError):
+            return default if default is not None else {}
+    return default if default is not None else {}
+
+
+class CompiledStep(ReadOnlyDoc):
+    """A flow step with its JSON fields parsed and its patterns compiled."""
+
+    def __init__(self, row):
+        super().__init__(row)
+
+        conditions = parse_json(self._row.get("conditional_next"), {})
+        self._set("conditions", MappingProxyType(conditions if isinstance(conditions, dict) else {}))
+
+        # Buttons are kept in the form sent with the interactive message
+        buttons = parse_json(self._row.get("buttons"), [])
+        if buttons and isinstance(buttons, list):
+            buttons = json.dumps(buttons)
+        self._set("buttons_payload", buttons or None)
+
+        mapping = parse_json(self._row.get("flow_field_mapping"), {})
+        self._set("flow_field_map", MappingProxyType(mapping if isinstance(mapping, dict) else {}))
+
+        options = self._row.get("options")
+        self._set("option_values", frozenset(
+            o.strip().lower() for o in options.split("|") if o.strip()
+        ) if options else frozenset())
+
+        pattern = None
+        if self._row.get("validation_regex"):
+            try:
+                pattern = re.compile(self._row.get("validation_regex"))
+            except re.error:
+                pass  # Invalid regex, skip validation
+        self._set("validation_pattern", pattern)
+
+
+class CompiledFlow(ReadOnlyDoc):
+    """
+    Immutable representation of a WhatsApp Chatbot Flow.
+
+    Steps are indexed by name and ordered by idx once, so step lookups and
+    "next step by order" resolution are dict lookups instead of scans.
+    """
+
+    def __init__(self, data):
+        steps = sorted(data.get("steps") or [], key=lambda x: x.get("idx") or 0)
+        super().__init__({k: v for k, v in data.items() if k != "steps"})
+
+        compiled_steps = tuple(CompiledStep(step) for step in steps)
+        self._set("steps", compiled_steps)
+        self._set("step_map", MappingProxyType({s.step_name: s for s in compiled_steps}))
+        self._set("successors", MappingProxyType({
+            step.step_name: compiled_steps[i + 1].step_name
+            for i, step in enumerate(compiled_steps[:-1])
+        }))
+        self._set("first_step", compiled_steps[0] if compiled_steps else None)
+
+        cancel_keywords = data.get("cancel_keywords")
+        self._set("cancel_words", frozenset(
+            w.strip().lower() for w in cancel_keywords.split(",") if w.strip()
+        ) if cancel_keywords else frozenset())
+
+    def get_step(self, step_name):
+        """Get a step by name."""
+        return self.step_map.get(step_name)
+
+
+def get_compiled_flow(flow_name):
+    """Get the compiled flow, cached per worker until the flow is modified."""
+    return get_cached(
+        f"{FLOW_GRAPH_CACHE}:{flow_name}",
+        "",
+        loader=lambda: frappe.get_doc("WhatsApp Chatbot Flow", flow_name).as_dict(),
+        compiler=CompiledFlow
+    )
+
+
+def get_flow_triggers(whatsapp_account=None):
+    """Get the flow trigger index for an account.
+
+    Returns:
+        dict with "keywords" (normalized keyword -> flow name) and
+        "buttons" (button payload -> flow name) maps
+    """
+    return get_cached(
+        FLOW_TRIGGER_CACHE,
+        whatsapp_account or "",
+        loader=lambda: build_flow_triggers(whatsapp_account)
+    )
+
+
+def build_flow_triggers(whatsapp_account=None):
+    """Build the keyword and button trigger maps of enabled flows."""
+    flows = frappe.get_all(
+        "WhatsApp Chatbot Flow",
+        filters={"enabled": 1},
+        fields=["name", "trigger_keywords", "trigger_on_button", "whatsapp_account"],
+        order_by="creation asc"
+    )
+
+    keywords = {}
+    buttons = {}
+    for flow in flows:
+        # Check account filter
+        if flow.whatsapp_account and flow.whatsapp_account != whatsapp_account:
+            continue
+
+        # The oldest flow wins when several share a trigger
+        if flow.trigger_on_button:
+            buttons.setdefault(flow.trigger_on_button, flow.name)
+
+        if flow.trigger_keywords:
+            for keyword in flow.trigger_keywords.split(","):
+                keyword = normalize_trigger(keyword)
+                if keyword:
+                    keywords.setdefault(keyword, flow.name)
+
+    return {"keywords": keywords, "buttons": buttons}
+
+
+def normalize_trigger(text):
+    """Normalize a trigger keyword or message for lookup."""
+    return (text or "").strip().lower()
+
+
+def clear_flow_cache(flow_name, modified=None):
+    """Invalidate a compiled flow and the flow trigger indexes in all workers."""
+    bump_version(f"{FLOW_GRAPH_CACHE}:{flow_name}", version=str(modified) if modified else None)
+    bump_version(FLOW_TRIGGER_CACHE)
@@ -0,0 +1,241 @@
+"""
+Gating stage for incoming messages.
+
+Decides whether the chatbot should handle a message before any job is
+enqueued. Excluded and transferred phone numbers are mirrored into Redis sets,
+so the settings version, exclusion, agent transfer and rate limit state are
+all resolved in a single Redis round trip, without touching the database.
+"""
+import frappe
+import pickle
+from frappe.utils import cint
+
+from frappe_whatsapp_chatbot.chatbot.cache import peek_cached, redis_version_key, run_script
+from frappe_whatsapp_chatbot.chatbot.settings import SETTINGS_CACHE, get_settings
+
+EXCLUDED_NUMBERS_KEY = "wa_chatbot_excluded_numbers"
+TRANSFERRED_NUMBERS_KEY = "wa_chatbot_transferred_numbers"
+
+# Both sets always contain this member, so a missing key means "not built"
+SET_SENTINEL = ""
+
+# Rejections are counted per scope in this hash
+RATE_LIMIT_STATS_KEY = "wa_chatbot_rate_limit_stats"
+
+# At most one Error Log per window summarizes rejections
+RATE_LIMIT_LOG_KEY = "wa_chatbot_rate_limit_logged"
+
+RATE_LIMIT_SCOPES = ("phone", "account", "global")
+
+# KEYS: settings version, excluded set, transferred set, stats hash,
+#       log sample flag, then one limiter hash per scope
+# ARGV: phone number, window in seconds, then one limit per scope (0 = off)
+# Returns: {settings version, excluded, transferred, sets built,
+#           rejecting scope (0 = allowed), log sample}
+#
+# Each limiter is a sliding window counter: a hash of per-window counts where
+# the previous window's count is weighted by how much of it still overlaps.
+# Limits are checked before anything is counted, so rejected messages never
+# extend a lockout.
+GATE_SCRIPT = """
+local version = redis.call('GET', KEYS[1])
+local built = redis.call('EXISTS', KEYS[2]) + redis.call('EXISTS', KEYS[3])
+local excluded = redis.call('SISMEMBER', KEYS[2], ARGV[1])
+local transferred = redis.call('SISMEMBER', KEYS[3], ARGV[1])
+local rejected = 0
+local sample = 0
+if built == 2 and excluded == 0 and transferred == 0 then
+    local now = redis.call('TIME')
+    local t = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local window = tonumber(ARGV[2])
+    local current = math.floor(t / window)
+    local weight = 1 - (t - current * window) / window
+
+    for i = 6, #KEYS do
+        local limit = tonumber(ARGV[i - 3])
+        if limit > 0 then
+            local curr = tonumber(redis.call('HGET', KEYS[i], current) or 0)
+            local prev = tonumber(redis.call('HGET', KEYS[i], current - 1) or 0)
+            if prev * weight + curr >= limit then
+                rejected = i - 5
+                break
+            end
+        end
+    end
+
+    if rejected == 0 then
+        for i = 6, #KEYS do
+            if tonumber(ARGV[i - 3]) > 0 then
+                redis.call('HINCRBY', KEYS[i], current, 1)
+                redis.call('HDEL', KEYS[i], current - 2)
+                redis.call('EXPIRE', KEYS[i], window * 2)
+            end
+        end
+    else
+        redis.call('HINCRBY', KEYS[4], rejected, 1)
+        if redis.call('SET', KEYS[5], 1, 'NX', 'EX', window) then
+            sample = 1
+        end
+    end
+end
+return {version, excluded, transferred, built, rejected, sample}
+"""
+
+
+def should_handle(phone_number, whatsapp_account):
+    """Check if the chatbot should handle a message from this number.
+
+    Resolves enabled, account match, excluded numbers, agent transfer and
+    rate limit state with one Redis script call. Only messages the chatbot
+    handles count towards the rate limits.
+
+    Returns:
+        True if the message should be processed, False if it is dropped
+    """
+    # Limits come from this worker's snapshot; the script returns the current
+    # version stamp, so a stale snapshot is refreshed right after
+    snapshot = peek_cached(SETTINGS_CACHE, "") or get_settings()
+
+    result = _run_gate(phone_number, whatsapp_account, snapshot)
+    version = result[0]
+    settings = get_settings(version=pickle.loads(version) if version else None)
+    if not _handles_account(settings, whatsapp_account):
+        return False
+
+    if not _handles_account(snapshot, whatsapp_account):
+        # The stale snapshot skipped the limits, check them now
+        result = _run_gate(phone_number, whatsapp_account, settings)
+
+    version, excluded, transferred, built, rejected, sample = result
+
+    if excluded or transferred:
+        return False
+
+    if rejected:
+        if sample:
+            _log_rate_limit_sample(phone_number, RATE_LIMIT_SCOPES[rejected - 1])
+        return False
+
+    return True
+
+
+def _handles_account(settings, whatsapp_account):
+    """Check if the chatbot is enabled for messages to this account."""
+    if not settings.enabled:
+        return False
+    return settings.process_all_accounts or whatsapp_account == settings.whatsapp_account
+
+
+def _run_gate(phone_number, whatsapp_account, settings):
+    result = _run_gate_script(phone_number, whatsapp_account, settings)
+    if result[3] != 2:
+        # Cold cache (first run or Redis flush), rebuild the sets once
+        sync_excluded_numbers()
+        sync_transferred_numbers()
+        result = _run_gate_script(phone_number, whatsapp_account, settings)
+    return result
+
+
+def _run_gate_script(phone_number, whatsapp_account, settings):
+    if _handles_account(settings, whatsapp_account):
+        limits = [
+            cint(settings.rate_limit_per_phone),
+            cint(settings.rate_limit_per_account) if whatsapp_account else 0,
+            cint(settings.rate_limit_global)
+        ]
+    else:
+        # Messages the chatbot ignores don't use up its limits
+        limits = [0, 0, 0]
+
+    return run_script(
+        GATE_SCRIPT,
+        keys=[
+            redis_version_key(SETTINGS_CACHE),
+            frappe.cache.make_key(EXCLUDED_NUMBERS_KEY),
+            frappe.cache.make_key(TRANSFERRED_NUMBERS_KEY),
+            frappe.cache.make_key(RATE_LIMIT_STATS_KEY),
+            frappe.cache.make_key(RATE_LIMIT_LOG_KEY),
+            frappe.cache.make_key(f"wa_chatbot_rate_limit:phone:{phone_number}"),
+            frappe.cache.make_key(f"wa_chatbot_rate_limit:account:{whatsapp_account}"),
+            frappe.cache.make_key("wa_chatbot_rate_limit:global")
+        ],
+        args=[phone_number, cint(settings.rate_limit_window) or 60, *limits]
+    )
+
+
+def _log_rate_limit_sample(phone_number, scope):
+    """Log one sampled rejection together with the running counters."""
+    frappe.log_error(
+        f"Chatbot {scope} rate limit exceeded for phone: {phone_number}. "
+        f"Rejections per limit so far: {get_rate_limit_stats()}",
+        "Chatbot Rate Limit"
+    )
+
+
+def get_rate_limit_stats():
+    """Get the number of rejected messages per rate limit scope."""
+    # Raw HMGET: the counters are written by the script, not pickled
+    counts = frappe.cache.hmget(
+        frappe.cache.make_key(RATE_LIMIT_STATS_KEY),
+        [str(i) for i in range(1, len(RATE_LIMIT_SCOPES) + 1)]
+    )
+    return {scope: cint(count) for scope, count in zip(RATE_LIMIT_SCOPES, counts)}
+
+
+def is_transferred(phone_number):
+    """Check if a phone number has an active agent transfer."""
+    # The cache's set helpers prefix keys themselves, unlike scripts and pipelines
+    if not frappe.cache.exists(TRANSFERRED_NUMBERS_KEY):
+        sync_transferred_numbers()
+    return bool(frappe.cache.sismember(TRANSFERRED_NUMBERS_KEY, phone_number))
+
+
+def _replace_set(key, members):
+    pipeline = frappe.cache.pipeline()
+    pipeline.delete(key)
+    pipeline.sadd(key, SET_SENTINEL, *members)
+    pipeline.execute()
+
+
+def sync_excluded_numbers():
+    """Rebuild the excluded numbers set from the chatbot settings."""
+    settings = frappe.get_single("WhatsApp Chatbot")
+    _replace_set(
+        frappe.cache.make_key(EXCLUDED_NUMBERS_KEY),
+        {row.phone_number for row in settings.excluded_numbers if row.phone_number}
+    )
+
+
+def sync_transferred_numbers():
+    """Rebuild the transferred numbers set from active agent transfers."""
+    phone_numbers = frappe.get_all(
+        "WhatsApp Agent Transfer",
+        filters={"status": "Active"},
+        pluck="phone_number"
+    )
+    _replace_set(
+        frappe.cache.make_key(TRANSFERRED_NUMBERS_KEY),
+        {phone for phone in phone_numbers if phone}
+    )
+
+
+def update_transferred_number(phone_number, ignore_transfer=None):
+    """Sync one phone number's membership in the transferred set.
+
+    Args:
+        phone_number: The customer's phone number
+        ignore_transfer: Transfer being deleted, not counted as active
+    """
+    if not phone_number:
+        return
+
+    filters = {"phone_number": phone_number, "status": "Active"}
+    if ignore_transfer:
+        filters["name"] = ["!=", ignore_transfer]
+
+    if not frappe.cache.exists(TRANSFERRED_NUMBERS_KEY):
+        sync_transferred_numbers()
+    elif frappe.db.exists("WhatsApp Agent Transfer", filters):
+        frappe.cache.sadd(TRANSFERRED_NUMBERS_KEY, phone_number)
+    else:
+        frappe.cache.srem(TRANSFERRED_NUMBERS_KEY, phone_number)
@@ -0,0 +1,307 @@
+"""
+BM25 search over the WhatsApp Knowledge Base, for AI context.
+
+Active entries (topic, keywords and content, HTML stripped) are mirrored in a
+Redis hash, and each worker keeps a BM25 inverted index of them in memory.
+Saving or deleting an entry updates the hash and records the change with a
+sequence number, so workers apply just the changed entries to their index
+instead of rebuilding it. A query costs one Redis round trip (the sequence
+check) and no database access.
+"""
+import json
+import math
+import re
+from collections import Counter, defaultdict
+
+import frappe
+
+from frappe_whatsapp_chatbot.chatbot.cache import run_script
+
+KB_DOCTYPE = "WhatsApp Knowledge Base"
+
+# Hash of index metadata: epoch (changes when the mirror is rebuilt) and seq
+KB_META_KEY = "wa_chatbot_kb_meta"
+
+# Hash of entry name -> indexed fields (json)
+KB_ENTRIES_KEY = "wa_chatbot_kb_entries"
+
+# Sorted set of entry names, scored by the seq of their last change
+KB_CHANGES_KEY = "wa_chatbot_kb_changes"
+
+# Field weights: a term in the topic or keywords counts as much as this many
+# occurrences in the content
+FIELD_WEIGHTS = {"topic": 3, "keywords": 2, "content": 1}
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from how i if in is it me my "
+    "of on or our please so that the this to was we what when where which who "
+    "why will with you your".split()
+)
+
+# Worker-local index: {site: (epoch, seq, BM25Index)}
+_local_index = {}
+
+# KEYS: meta hash, entries hash, changes zset
+# ARGV: entry name, entry json ("" to remove it)
+# Returns the new seq, or 0 if the mirror has not been built yet (the next
+# build reads the change from the database)
+CHANGE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'epoch') == 0 then
+    return 0
+end
+local seq = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+redis.call('ZADD', KEYS[3], seq, ARGV[1])
+return seq
+"""
+
+# KEYS: meta hash, entries hash, changes zset
+# ARGV: epoch, then name, entry json pairs
+# Only the first builder after a Redis flush writes the mirror
+BUILD_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'epoch') == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], 'epoch', ARGV[1], 'seq', 0)
+return 1
+"""
+
+
+def tokenize(text):
+    """Split text into lowercase search terms, without stopwords."""
+    return [
+        token for token in re.findall(r"\w+", (text or "").lower())
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+
+class BM25Index:
+    """In-memory BM25 inverted index with incremental updates."""
+
+    def __init__(self, entries=None):
+        """
+        Args:
+            entries: dict of name -> {"topic", "keywords", "content"}
+        """
+        self.entries = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)  # term -> {name: weighted tf}
+        self.total_length = 0
+
+        for name, entry in (entries or {}).items():
+            self.add(name, entry)
+
+    def add(self, name, entry):
+        if name in self.entries:
+            self.remove(name)
+
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(entry.get(field)):
+                terms[token] += weight
+
+        for term, frequency in terms.items():
+            self.postings[term][name] = frequency
+
+        self.entries[name] = entry
+        self.lengths[name] = sum(terms.values())
+        self.total_length += self.lengths[name]
+
+    def remove(self, name):
+        if name not in self.entries:
+            return
+
+        entry = self.entries.pop(name)
+        for field in FIELD_WEIGHTS:
+            for token in set(tokenize(entry.get(field))):
+                postings = self.postings.get(token)
+                if postings is not None:
+                    postings.pop(name, None)
+                    if not postings:
+                        del self.postings[token]
+
+        self.total_length -= self.lengths.pop(name)
+
+    def search(self, query, limit=3):
+        """Get the best matching entries for a query.
+
+        Returns:
+            list of (score, name, entry), best first
+        """
+        count = len(self.entries)
+        if not count:
+            return []
+
+        average_length = self.total_length / count or 1
+        scores = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for name, frequency in postings.items():
+                norm = K1 * (1 - B + B * self.lengths[name] / average_length)
+                scores[name] += idf * frequency * (K1 + 1) / (frequency + norm)
+
+        return [(score, name, self.entries[name]) for name, score in scores.most_common(limit)]
+
+
+def _keys():
+    return [frappe.cache.make_key(key) for key in (KB_META_KEY, KB_ENTRIES_KEY, KB_CHANGES_KEY)]
+
+
+def _index_fields(doc):
+    """The indexed fields of a Knowledge Base entry, as stored in Redis."""
+    from frappe.utils import strip_html_tags
+
+    return json.dumps({
+        "topic": doc.get("topic") or "",
+        "keywords": doc.get("keywords") or "",
+        "content": strip_html_tags(doc.get("content") or "").strip()
+    })
+
+
+def get_kb_index():
+    """Get this worker's BM25 index, brought up to date with Redis."""
+    meta_key, entries_key, changes_key = _keys()
+    site = getattr(frappe.local, "site", None)
+
+    epoch, seq = frappe.cache.hmget(meta_key, ["epoch", "seq"])
+    if not epoch:
+        _build_mirror()
+        epoch, seq = frappe.cache.hmget(meta_key, ["epoch", "seq"])
+    seq = int(seq or 0)
+
+    local = _local_index.get(site)
+    if local and local[0] == epoch:
+        local_seq, index = local[1], local[2]
+        if local_seq == seq:
+            return index
+
+        # Apply the entries changed since this worker's last look
+        names = frappe.cache.zrangebyscore(changes_key, f"({local_seq}", "+inf")
+        if names:
+            for name, entry in zip(names, frappe.cache.hmget(entries_key, names)):
+                name = frappe.safe_decode(name)
+                if entry:
+                    index.add(name, json.loads(entry))
+                else:
+                    index.remove(name)
+    else:
+        index = BM25Index(_load_entries(entries_key))
+
+    _local_index[site] = (epoch, seq, index)
+    return index
+
+
+def _load_entries(entries_key):
+    # Raw HGETALL, the entries are json written by scripts, not pickled
+    pipeline = frappe.cache.pipeline()
+    pipeline.hgetall(entries_key)
+    return {
+        frappe.safe_decode(name): json.loads(entry)
+        for name, entry in pipeline.execute()[0].items()
+    }
+
+
+def _build_mirror():
+    """Fill the Redis mirror from the database (first use or after a flush)."""
+    entries = frappe.get_all(
+        KB_DOCTYPE,
+        filters={"is_active": 1},
+        fields=["name", "topic", "keywords", "content"]
+    )
+
+    args = [frappe.generate_hash(length=12)]
+    for entry in entries:
+        args.extend([entry.name, _index_fields(entry)])
+    run_script(BUILD_SCRIPT, keys=_keys(), args=args)
+
+
+def update_kb_entry(doc):
+    """Apply a saved Knowledge Base entry to the index, once committed."""
+    name = doc.name
+    fields = _index_fields(doc) if doc.get("is_active") else ""
+    frappe.db.after_commit.add(
+        lambda: run_script(CHANGE_SCRIPT, keys=_keys(), args=[name, fields])
+    )
+
+
+def remove_kb_entry(name):
+    """Remove a deleted Knowledge Base entry from the index, once committed."""
+    frappe.db.after_commit.add(
+        lambda: run_script(CHANGE_SCRIPT, keys=_keys(), args=[name, ""])
+    )
+
+
+def search_knowledge_base(query, limit=3, max_chars=2000, semantic=False):
+    """Get the Knowledge Base entries most relevant to a query.
+
+    Args:
+        query: The customer's message
+        limit: Maximum number of entries
+        max_chars: Maximum total length of the returned content; entries
+            that don't fit are skipped
+        semantic: Also rank by embedding similarity (see kb_vectors) and
+            merge both rankings
+
+    Returns:
+        list of dicts with name, topic, content and score, best first
+    """
+    index = get_kb_index()
+    ranked = [(score, name) for score, name, _ in index.search(query, limit)]
+    if semantic:
+        try:
+            from frappe_whatsapp_chatbot.chatbot.kb_vectors import search_kb_vectors
+            ranked = fuse_rankings(ranked, search_kb_vectors(query, limit))
+        except Exception as e:
+            # Lexical results are still good context
+            frappe.log_error(f"Knowledge Base vector search error: {str(e)}")
+
+    results = []
+    used = 0
+    for score, name in ranked[:limit]:
+        entry = index.entries.get(name)
+        if not entry:
+            continue  # Deactivated since the vectors were built
+
+        size = len(entry["topic"]) + len(entry["content"])
+        if max_chars and used + size > max_chars:
+            continue
+        used += size
+        results.append({
+            "name": name,
+            "topic": entry["topic"],
+            "content": entry["content"],
+            "score": round(score, 3)
+        })
+    return results
+
+
+def fuse_rankings(*rankings, k=60):
+    """Merge rankings of (score, name) by reciprocal rank fusion.
+
+    Scores of different searches aren't comparable, ranks are: an entry
+    scores 1 / (k + rank) in each ranking it appears in.
+
+    Returns:
+        list of (fused score, name), best first
+    """
+    fused = Counter()
+    for ranking in rankings:
+        for rank, (_, name) in enumerate(ranking, 1):
+            fused[name] += 1 / (k + rank)
+    return [(score, name) for name, score in fused.most_common()]
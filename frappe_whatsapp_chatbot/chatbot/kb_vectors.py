@@ -0,0 +1,343 @@
+"""
+Semantic search over the WhatsApp Knowledge Base with local embeddings.
+
+Entries are embedded locally (no external service) and their vectors kept in
+a NumPy matrix on disk, memory-mapped by every worker of the bench so the
+page cache holds one copy. A row per entry is rewritten in place when the
+entry is saved; the matrix is only copied when it has to grow. Queries are
+one matrix-vector product over the mapped rows.
+
+A rebuilt or grown matrix is written to a new file, named in the metadata
+file (entry names per row, embedder). Replacing the metadata file switches
+workers to it, so they never map a matrix with another matrix's names.
+
+The embedder is pluggable through the whatsapp_chatbot_embedder site config
+(dotted path of an Embedder class). NumPy is optional: without it, semantic
+search is skipped and the Knowledge Base is searched with BM25 only.
+"""
+import abc
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import frappe
+from frappe.utils import strip_html_tags
+
+from frappe_whatsapp_chatbot.chatbot.kb_index import STOPWORDS
+
+KB_DOCTYPE = "WhatsApp Knowledge Base"
+
+# Rows allocated when the matrix is created, it doubles when full
+INITIAL_CAPACITY = 256
+
+# Matches below this cosine similarity are not considered relevant
+MIN_SIMILARITY = 0.15
+
+# Serializes writers across processes of the bench
+LOCK_KEY = "wa_chatbot_kb_vectors_lock"
+
+# Worker-local mapping: {site: (meta mtime, meta, matrix)}
+_local = {}
+
+
+class Embedder(abc.ABC):
+    """
+    Turns texts into L2-normalized float32 vectors of a fixed dimension.
+
+    Subclasses set a unique id (stored with the matrix, a changed id
+    rebuilds it) and dim, and implement embed().
+    """
+
+    id = None
+    dim = None
+
+    @abc.abstractmethod
+    def embed(self, texts):
+        """Embed texts into a (len(texts), dim) float32 array with unit rows."""
+
+
+class HashingEmbedder(Embedder):
+    """
+    TF vectors of words and character trigrams via the hashing trick.
+
+    Trigrams make paraphrases with shared word stems ("refunds", "refunded")
+    land near each other; no vocabulary or model files are needed.
+    """
+
+    id = "hashing-v1-1024"
+    dim = 1024
+
+    def features(self, text):
+        words = [word for word in re.findall(r"\w+", (text or "").lower()) if word not in STOPWORDS]
+        features = Counter(words)
+        for word in words:
+            padded = f"#{word}#"
+            features.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, texts):
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self.features(text).items():
+                digest = hashlib.md5(feature.encode()).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                sign = 1 if digest[4] & 1 else -1
+                vectors[row, bucket] += sign * (1 + math.log(count))
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+def get_embedder():
+    """Get the configured embedder (site config whatsapp_chatbot_embedder)."""
+    path = frappe.conf.get("whatsapp_chatbot_embedder")
+    return frappe.get_attr(path)() if path else HashingEmbedder()
+
+
+def is_available():
+    try:
+        import numpy  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _paths():
+    """Get the folder of the vector files and the metadata file's path."""
+    folder = frappe.get_site_path("private", "whatsapp_chatbot")
+    return folder, os.path.join(folder, "kb_vectors.json")
+
+
+def _matrix_path(folder, meta):
+    return os.path.join(folder, meta["matrix"])
+
+
+def _save_matrix(folder, matrix):
+    """Write a matrix to a new file, returning its name for the metadata."""
+    import numpy as np
+
+    filename = f"kb_vectors.{frappe.generate_hash(length=10)}.npy"
+    np.save(os.path.join(folder, filename), matrix)
+    return filename
+
+
+def _remove_old_matrices(folder, current):
+    """Delete the matrices replaced by current (and ones left by failed writes).
+
+    Workers still mapping a deleted file keep reading it until they remap.
+    """
+    for filename in os.listdir(folder):
+        if filename.startswith("kb_vectors.") and filename.endswith(".npy") and filename != current:
+            try:
+                os.remove(os.path.join(folder, filename))
+            except FileNotFoundError:
+                pass
+
+
+def _entry_text(entry):
+    return "\n".join([
+        entry.get("topic") or "",
+        entry.get("keywords") or "",
+        strip_html_tags(entry.get("content") or "")
+    ])
+
+
+def _write_meta(meta_path, meta):
+    tmp_path = f"{meta_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _read_meta(meta_path):
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _lock():
+    return frappe.cache.lock(frappe.cache.make_key(LOCK_KEY), timeout=600, blocking_timeout=60)
+
+
+def rebuild_kb_vectors():
+    """Embed all active Knowledge Base entries into a new matrix."""
+    import numpy as np
+
+    embedder = get_embedder()
+    entries = frappe.get_all(
+        KB_DOCTYPE,
+        filters={"is_active": 1},
+        fields=["name", "topic", "keywords", "content"]
+    )
+
+    folder, meta_path = _paths()
+    os.makedirs(folder, exist_ok=True)
+
+    with _lock():
+        capacity = max(INITIAL_CAPACITY, 2 ** math.ceil(math.log2(len(entries) or 1)))
+        matrix = np.zeros((capacity, embedder.dim), dtype=np.float32)
+        if entries:
+            matrix[:len(entries)] = embedder.embed([_entry_text(entry) for entry in entries])
+
+        # The metadata is replaced last, switching workers to the new matrix
+        filename = _save_matrix(folder, matrix)
+        _write_meta(meta_path, {
+            "embedder": embedder.id,
+            "matrix": filename,
+            "names": [entry.name for entry in entries]
+        })
+        _remove_old_matrices(folder, filename)
+
+
+def update_kb_vector(entry_name):
+    """Background job: re-embed one Knowledge Base entry (or drop a deleted one)."""
+    import numpy as np
+
+    try:
+        embedder = get_embedder()
+        folder, meta_path = _paths()
+        if not os.path.exists(meta_path) or _read_meta(meta_path).get("embedder") != embedder.id:
+            rebuild_kb_vectors()
+            return
+
+        entry = frappe.db.get_value(
+            KB_DOCTYPE,
+            {"name": entry_name, "is_active": 1},
+            ["topic", "keywords", "content"],
+            as_dict=True
+        )
+        vector = embedder.embed([_entry_text(entry)])[0] if entry else None
+
+        with _lock():
+            meta = _read_meta(meta_path)
+            names = meta["names"]
+            matrix = np.load(_matrix_path(folder, meta), mmap_mode="r+")
+
+            if entry_name in names:
+                row = names.index(entry_name)
+            elif vector is None:
+                return  # Inactive and not indexed
+            elif None in names:
+                row = names.index(None)  # Reuse a deleted entry's row
+            else:
+                row = len(names)
+                names.append(None)
+
+            if row >= matrix.shape[0]:
+                # Full: copy into a new matrix of twice the size, which the
+                # metadata written below switches to
+                grown = np.zeros((matrix.shape[0] * 2, matrix.shape[1]), dtype=np.float32)
+                grown[:matrix.shape[0]] = matrix
+                del matrix
+                meta["matrix"] = _save_matrix(folder, grown)
+                matrix = np.load(_matrix_path(folder, meta), mmap_mode="r+")
+
+            if vector is None:
+                matrix[row] = 0
+                names[row] = None
+            else:
+                matrix[row] = vector
+                names[row] = entry_name
+            matrix.flush()
+            del matrix
+
+            # Written last: readers pick up the new names with the new rows
+            _write_meta(meta_path, meta)
+            _remove_old_matrices(folder, meta["matrix"])
+
+    except Exception as e:
+        frappe.log_error(f"update_kb_vector error: {str(e)}")
+
+
+def enqueue_kb_vector_update(entry_name):
+    """Re-embed a Knowledge Base entry in the background once it is committed."""
+    from frappe_whatsapp_chatbot.chatbot.settings import get_settings
+
+    if not (get_settings().kb_semantic_search and is_available()):
+        return
+
+    frappe.enqueue(
+        "frappe_whatsapp_chatbot.chatbot.kb_vectors.update_kb_vector",
+        queue="short",
+        entry_name=entry_name,
+        enqueue_after_commit=True,
+        now=frappe.flags.in_test
+    )
+
+
+def _get_matrix():
+    """Get this worker's mapping of the matrix, reopened after it changed.
+
+    Returns:
+        (meta, matrix), or (None, None) while the matrix is being built
+    """
+    import numpy as np
+
+    folder, meta_path = _paths()
+    site = getattr(frappe.local, "site", None)
+    try:
+        mtime = os.stat(meta_path).st_mtime_ns
+    except FileNotFoundError:
+        enqueue_rebuild()
+        return None, None
+
+    local = _local.get(site)
+    if local and local[0] == mtime:
+        return local[1], local[2]
+
+    meta = _read_meta(meta_path)
+    try:
+        matrix = np.load(_matrix_path(folder, meta), mmap_mode="r")
+    except FileNotFoundError:
+        # Replaced since the metadata was read, the next query maps the new one
+        return None, None
+    _local[site] = (mtime, meta, matrix)
+    return meta, matrix
+
+
+def search_kb_vectors(query, limit=3):
+    """Get the Knowledge Base entries closest in meaning to a query.
+
+    Returns:
+        list of (similarity, entry name), best first
+    """
+    import numpy as np
+
+    meta, matrix = _get_matrix()
+    if meta is None:
+        return []
+
+    embedder = get_embedder()
+    if meta.get("embedder") != embedder.id:
+        enqueue_rebuild()  # Embedder changed, lexical search only meanwhile
+        return []
+
+    names = meta["names"]
+    if not names:
+        return []
+
+    # Rows are unit vectors, so the dot product is the cosine similarity
+    scores = np.asarray(matrix[:len(names)]) @ embedder.embed([query])[0]
+    limit = min(limit, len(names))
+    top = np.argpartition(-scores, limit - 1)[:limit]
+
+    return [
+        (float(scores[row]), names[row])
+        for row in top[np.argsort(-scores[top])]
+        if names[row] and scores[row] >= MIN_SIMILARITY
+    ]
+
+
+def enqueue_rebuild():
+    """Rebuild the matrix in the background (once, however often requested)."""
+    frappe.enqueue(
+        "frappe_whatsapp_chatbot.chatbot.kb_vectors.rebuild_kb_vectors",
+        queue="long",
+        job_id="wa_chatbot_kb_vectors_rebuild",
+        deduplicate=True
+    )
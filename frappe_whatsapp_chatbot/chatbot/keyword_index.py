@@ -0,0 +1,171 @@
+import frappe
+import re
+from collections import deque
+
+# Trie node key holding the rule positions that end at that node
+_END = None
+
+
+class PrefixTrie:
+    """Character trie answering "which keywords is this text prefixed by"."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, word, value):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        node.setdefault(_END, []).append(value)
+
+    def collect(self, text, matched):
+        """Add values of all keywords that prefix text to matched."""
+        node = self.root
+        if _END in node:
+            matched.update(node[_END])
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return
+            if _END in node:
+                matched.update(node[_END])
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton finding all keywords contained in a text in one pass."""
+
+    def __init__(self, words):
+        """
+        Args:
+            words: Iterable of (keyword, value) pairs
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+        for word, value in words:
+            state = 0
+            for char in word:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = next_state
+            self.out[state].append(value)
+
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def collect(self, text, matched):
+        """Add values of all keywords contained in text to matched."""
+        if len(self.goto) == 1:
+            return
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.out[state]:
+                matched.update(self.out[state])
+
+
+class _MatchTables:
+    """Exact, prefix and substring tables for rules sharing one case mode."""
+
+    def __init__(self):
+        self.exact = {}
+        self.prefix = PrefixTrie()
+        self.contains_words = []
+        self.contains = None
+
+    def compile(self):
+        self.contains = AhoCorasick(self.contains_words)
+        self.contains_words = []
+
+    def collect(self, text, matched):
+        matched.update(self.exact.get(text, ()))
+        self.prefix.collect(text, matched)
+        self.contains.collect(text, matched)
+
+
+class KeywordIndex:
+    """
+    Compiled, immutable index over keyword rules.
+
+    Rules are kept in the order they were given (priority desc), and every
+    lookup returns candidate rules in that order, so the first candidate that
+    passes its runtime checks is the same rule a linear scan would pick.
+    """
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules: List of WhatsApp Keyword Reply rows sorted by priority
+        """
+        self.rules = rules
+        self.sensitive = _MatchTables()
+        self.insensitive = _MatchTables()
+        self.patterns = []
+
+        for position, rule in enumerate(rules):
+            self.add_rule(position, rule)
+
+        self.sensitive.compile()
+        self.insensitive.compile()
+
+    def add_rule(self, position, rule):
+        if not rule.get("keywords"):
+            return
+
+        keywords = [k.strip() for k in rule.keywords.split(",") if k.strip()]
+        case_sensitive = rule.get("case_sensitive")
+        tables = self.sensitive if case_sensitive else self.insensitive
+
+        for keyword in keywords:
+            if rule.match_type == "Regex":
+                try:
+                    flags = 0 if case_sensitive else re.IGNORECASE
+                    self.patterns.append((position, re.compile(keyword, flags)))
+                except re.error as e:
+                    frappe.log_error(
+                        f"Invalid regex in keyword rule '{rule.name}': {str(e)}"
+                    )
+                continue
+
+            kw = keyword if case_sensitive else keyword.lower()
+
+            if rule.match_type == "Exact":
+                tables.exact.setdefault(kw, []).append(position)
+            elif rule.match_type == "Contains":
+                tables.contains_words.append((kw, position))
+            elif rule.match_type == "Starts With":
+                tables.prefix.add(kw, position)
+
+    def candidates(self, message_text):
+        """Get rules whose keywords match the message, in priority order."""
+        if not message_text:
+            return []
+
+        matched = set()
+        self.sensitive.collect(message_text, matched)
+        self.insensitive.collect(message_text.lower(), matched)
+
+        for position, pattern in self.patterns:
+            if position not in matched and pattern.search(message_text):
+                matched.add(position)
+
+        return [self.rules[position] for position in sorted(matched)]
@@ -1,98 +1,50 @@
 import frappe
-import re
 from datetime import datetime
 
+from frappe_whatsapp_chatbot.chatbot.cache import bump_version, get_cached
+from frappe_whatsapp_chatbot.chatbot.keyword_index import KeywordIndex
+
+
+# Cache namespace for compiled keyword indexes
+KEYWORD_INDEX_CACHE = "keyword_index"
+
 
 class KeywordMatcher:
     """Match incoming messages against keyword rules."""
 
     def __init__(self, whatsapp_account=None):
         self.account = whatsapp_account
-        self.rules = self.load_rules()
+        self.index = get_keyword_index(whatsapp_account)
+        self.rules = self.index.rules
 
     def load_rules(self):
-        """Load active keyword rules sorted by priority."""
-        try:
-            rules = frappe.get_all(
-                "WhatsApp Keyword Reply",
-                filters={"enabled": 1},
-                fields=["*"],
-                order_by="priority desc"
-            )
-
-            # Filter by account and date range
-            now = datetime.now()
-            valid_rules = []
-
-            for rule in rules:
-                # Check account filter
-                if rule.whatsapp_account and rule.whatsapp_account != self.account:
-                    continue
-
-                # Check date range
-                if rule.active_from and now < rule.active_from:
-                    continue
-                if rule.active_until and now > rule.active_until:
-                    continue
-
-                valid_rules.append(rule)
-
-            return valid_rules
-
-        except Exception as e:
-            frappe.log_error(f"KeywordMatcher load_rules error: {str(e)}")
-            return []
+        """Load enabled keyword rules for this account sorted by priority."""
+        return load_keyword_rules(self.account)
 
     def match(self, message_text):
         """Find matching keyword rule for message."""
         if not message_text:
             return None
 
-        for rule in self.rules:
-            if self.rule_matches(rule, message_text):
-                # Check additional conditions
-                if rule.conditions:
-                    if not self.evaluate_conditions(rule.conditions, message_text):
-                        continue
-                return frappe.get_doc("WhatsApp Keyword Reply", rule.name)
+        for rule in self.index.candidates(message_text):
+            if not self.is_active(rule):
+                continue
+            # Check additional conditions
+            if rule.conditions:
+                if not self.evaluate_conditions(rule.conditions, message_text):
+                    continue
+            return frappe._dict(rule)
 
         return None
 
-    def rule_matches(self, rule, message_text):
-        """Check if a rule matches the message."""
-        if not rule.keywords:
+    def is_active(self, rule):
+        """Check the rule's active date range."""
+        now = datetime.now()
+        if rule.active_from and now < rule.active_from:
             return False
-
-        keywords = [k.strip() for k in rule.keywords.split(",") if k.strip()]
-
-        text = message_text if rule.case_sensitive else message_text.lower()
-
-        for keyword in keywords:
-            kw = keyword if rule.case_sensitive else keyword.lower()
-
-            if rule.match_type == "Exact":
-                if text == kw:
-                    return True
-
-            elif rule.match_type == "Contains":
-                if kw in text:
-                    return True
-
-            elif rule.match_type == "Starts With":
-                if text.startswith(kw):
-                    return True
-
-            elif rule.match_type == "Regex":
-                try:
-                    flags = 0 if rule.case_sensitive else re.IGNORECASE
-                    if re.search(kw, message_text, flags):
-                        return True
-                except re.error as e:
-                    frappe.log_error(
-                        f"Invalid regex in keyword rule '{rule.name}': {str(e)}"
-                    )
-
-        return False
+        if rule.active_until and now > rule.active_until:
+            return False
+        return True
 
     def evaluate_conditions(self, conditions, message_text):
         """Evaluate Python conditions for rule."""
@@ -115,3 +67,47 @@ class KeywordMatcher:
         except Exception as e:
             frappe.log_error(f"Condition evaluation error: {str(e)}")
             return False
+
+
+def get_keyword_index(whatsapp_account=None):
+    """Get the compiled keyword index for an account.
+
+    Rules are shared through Redis and compiled once per worker; both are
+    rebuilt only after a WhatsApp Keyword Reply is saved or deleted.
+    """
+    try:
+        return get_cached(
+            KEYWORD_INDEX_CACHE,
+            whatsapp_account or "",
+            loader=lambda: load_keyword_rules(whatsapp_account),
+            compiler=KeywordIndex
+        )
+    except Exception as e:
+        frappe.log_error(f"get_keyword_index error: {str(e)}")
+        return KeywordIndex(load_keyword_rules(whatsapp_account))
+
+
+def load_keyword_rules(whatsapp_account=None):
+    """Load enabled keyword rules for an account sorted by priority."""
+    try:
+        rules = frappe.get_all(
+            "WhatsApp Keyword Reply",
+            filters={"enabled": 1},
+            fields=["*"],
+            order_by="priority desc"
+        )
+
+        # Date ranges are checked at match time, the index outlives them
+        return [
+            rule for rule in rules
+            if not rule.whatsapp_account or rule.whatsapp_account == whatsapp_account
+        ]
+
+    except Exception as e:
+        frappe.log_error(f"load_keyword_rules error: {str(e)}")
+        return []
+
+
+def clear_keyword_index():
+    """Invalidate compiled keyword indexes in all workers."""
+    bump_version(KEYWORD_INDEX_CACHE)
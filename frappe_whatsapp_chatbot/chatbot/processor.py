@@ -1,38 +1,10 @@
 import frappe
 from frappe import _
-from frappe.utils import cint
-from datetime import datetime
 
-# Flag to prevent recursive processing
-_processing_messages = set()
-
-
-def _check_chatbot_rate_limit(phone_number: str, limit_per_minute: int = 10) -> bool:
-    """
-    Check if a phone number has exceeded chatbot response rate limit.
-    
-    Security: Prevents abuse of chatbot by limiting responses per phone number.
-    
-    Args:
-        phone_number: The sender's phone number
-        limit_per_minute: Maximum chatbot responses per minute (default 10)
-        
-    Returns:
-        True if within limit, False if exceeded
-    """
-    cache_key = f"chatbot_rate_limit:{phone_number}"
-    current_count = cint(frappe.cache.get(cache_key) or 0)
-    
-    if current_count >= limit_per_minute:
-        frappe.log_error(
-            f"Chatbot rate limit exceeded for phone: {phone_number} ({current_count} messages)",
-            "Chatbot Rate Limit"
-        )
-        return False
-    
-    # Increment counter with 60 second expiry
-    frappe.cache.set(cache_key, current_count + 1, expires_in_sec=60)
-    return True
+from frappe_whatsapp_chatbot.chatbot.conversation_queue import enqueue_message
+from frappe_whatsapp_chatbot.chatbot.gating import is_transferred, should_handle
+from frappe_whatsapp_chatbot.chatbot.settings import get_settings
+from frappe_whatsapp_chatbot.chatbot.unit_of_work import UnitOfWork
 
 
 class ChatbotProcessor:
@@ -73,17 +45,19 @@ class ChatbotProcessor:
 
         self.settings = None
 
+        # Writes outside a processing stage are committed right away
+        self.uow = UnitOfWork(immediate=True)
+
     def get_chatbot_settings(self):
         """Get chatbot configuration."""
         if self.settings is not None:
             return self.settings
 
         try:
-            if frappe.db.exists("WhatsApp Chatbot"):
-                settings = frappe.get_single("WhatsApp Chatbot")
-                if settings.enabled:
-                    self.settings = settings
-                    return settings
+            settings = get_settings()
+            if settings.enabled:
+                self.settings = settings
+                return settings
         except Exception as e:
             frappe.log_error(f"get_chatbot_settings error: {str(e)}")
 
@@ -107,8 +81,7 @@ class ChatbotProcessor:
                 return False
 
         # Check excluded numbers
-        excluded = [row.phone_number for row in settings.excluded_numbers]
-        if self.phone_number in excluded:
+        if settings.is_excluded(self.phone_number):
             return False
 
         # Check if transferred to agent
@@ -120,39 +93,62 @@ class ChatbotProcessor:
     def is_transferred_to_agent(self):
         """Check if this conversation has been transferred to a human agent."""
         try:
-            return frappe.db.exists("WhatsApp Agent Transfer", {
-                "phone_number": self.phone_number,
-                "status": "Active"
-            })
+            return is_transferred(self.phone_number)
         except Exception:
             # If doctype doesn't exist yet, don't block processing
             return False
 
     def process(self):
-        """Process the incoming message."""
+        """Process the incoming message through all stages."""
+        if not self.process_fast_path():
+            self.process_fallback()
+
+    def process_fast_path(self):
+        """Run the gating, session, keyword and flow stages.
+
+        Returns:
+            True if the message was handled (or dropped), False if it falls
+            through to the AI/default response stage
+        """
+        return self.run_stage(self._process_fast_path)
+
+    def process_fallback(self):
+        """Run the AI fallback (if enabled) and default response stages."""
+        self.run_stage(self._process_fallback)
+
+    def run_stage(self, stage):
+        """Run a stage with all its writes flushed in one transaction."""
+        self.uow = UnitOfWork()
+        try:
+            with self.uow:
+                return stage()
+        finally:
+            self.uow = UnitOfWork(immediate=True)
+
+    def _process_fast_path(self):
         settings = self.get_chatbot_settings()
 
         if not settings:
-            return
+            return True
 
         if not self.should_process():
-            return
+            return True
 
         # Check business hours (send out of hours message if needed)
         if settings.business_hours_only:
             if not self.is_business_hours():
                 if settings.out_of_hours_message:
                     self.send_response(settings.out_of_hours_message)
-                return
+                return True
 
         from frappe_whatsapp_chatbot.chatbot.session_manager import SessionManager
         from frappe_whatsapp_chatbot.chatbot.keyword_matcher import KeywordMatcher
         from frappe_whatsapp_chatbot.chatbot.flow_engine import FlowEngine
 
         # Initialize managers
-        session_mgr = SessionManager(self.phone_number, self.account)
+        session_mgr = SessionManager(self.phone_number, self.account, self.uow)
         keyword_matcher = KeywordMatcher(self.account)
-        flow_engine = FlowEngine(self.phone_number, self.account)
+        flow_engine = FlowEngine(self.phone_number, self.account, self.uow)
 
         response = None
 
@@ -173,7 +169,7 @@ class ChatbotProcessor:
                 )
             if response:
                 self.send_response(response)
-                return
+                return True
 
         # 2. Check keyword matches
         keyword_match = keyword_matcher.match(self.message_text)
@@ -186,7 +182,7 @@ class ChatbotProcessor:
 
             if response:
                 self.send_response(response)
-                return
+                return True
 
         # 3. Check if message triggers a flow directly
         flow_trigger = flow_engine.check_flow_trigger(self.message_text, self.button_payload)
@@ -194,17 +190,28 @@ class ChatbotProcessor:
             response = flow_engine.start_flow(flow_trigger)
             if response:
                 self.send_response(response)
-                return
+                return True
+
+        return False
+
+    def _process_fallback(self):
+        settings = self.get_chatbot_settings()
+
+        if not settings:
+            return
 
         # 4. AI Fallback (if enabled)
         if settings.enable_ai:
             try:
                 from frappe_whatsapp_chatbot.chatbot.ai_responder import AIResponder
+                from frappe_whatsapp_chatbot.chatbot.session_manager import SessionManager
+                session_mgr = SessionManager(self.phone_number, self.account)
                 ai_responder = AIResponder(settings, phone_number=self.phone_number)
-                response = ai_responder.generate_response(
-                    self.message_text,
-                    session_mgr.get_conversation_history()
-                )
+                history = None
+                if settings.ai_include_history:
+                    # Older messages are sent as a rolling summary
+                    history = session_mgr.get_conversation_summary(settings.ai_history_limit or 4)
+                response = ai_responder.generate_response(self.message_text, history)
                 if response:
                     self.send_response(response)
                     return
@@ -218,40 +225,33 @@ class ChatbotProcessor:
             self.send_response(settings.default_response)
 
     def send_response(self, response):
-        """Send response message."""
-        try:
-            # Use flags to prevent the after_insert hook from processing our outgoing message
-            flags = frappe._dict(ignore_chatbot=True)
-
-            if isinstance(response, str):
-                # Simple text response
-                msg = frappe.get_doc({
-                    "doctype": "WhatsApp Message",
-                    "type": "Outgoing",
-                    "to": self.phone_number,
-                    "message": response,
-                    "content_type": "text",
-                    "whatsapp_account": self.account
-                })
-                msg.flags.ignore_chatbot = True
-                msg.insert(ignore_permissions=True)
-                frappe.db.commit()
-
-            elif isinstance(response, dict):
-                # Complex response (template, media, buttons, etc.)
-                msg_data = {
-                    "doctype": "WhatsApp Message",
-                    "type": "Outgoing",
-                    "to": self.phone_number,
-                    "whatsapp_account": self.account
-                }
-                msg_data.update(response)
+        """Queue the response message, sent when the current stage is flushed."""
+        if isinstance(response, str):
+            # Simple text response
+            msg_data = {
+                "doctype": "WhatsApp Message",
+                "type": "Outgoing",
+                "to": self.phone_number,
+                "message": response,
+                "content_type": "text",
+                "whatsapp_account": self.account
+            }
+
+        elif isinstance(response, dict):
+            # Complex response (template, media, buttons, etc.)
+            msg_data = {
+                "doctype": "WhatsApp Message",
+                "type": "Outgoing",
+                "to": self.phone_number,
+                "whatsapp_account": self.account
+            }
+            msg_data.update(response)
 
-                msg = frappe.get_doc(msg_data)
-                msg.flags.ignore_chatbot = True
-                msg.insert(ignore_permissions=True)
-                frappe.db.commit()
+        else:
+            return
 
+        try:
+            self.uow.send(frappe.get_doc(msg_data))
         except Exception as e:
             frappe.log_error(
                 f"Chatbot send_response error: {str(e)}",
@@ -269,16 +269,13 @@ class ChatbotProcessor:
             Response message to send
         """
         import json
+        from frappe_whatsapp_chatbot.chatbot.flow_graph import get_compiled_flow
 
         try:
-            flow = frappe.get_doc("WhatsApp Chatbot Flow", session.current_flow)
+            flow = get_compiled_flow(session.current_flow)
 
             # Find current step
-            current_step = None
-            for step in flow.steps:
-                if step.step_name == session.current_step:
-                    current_step = step
-                    break
+            current_step = flow.get_step(session.current_step)
 
             if not current_step:
                 return flow_engine.complete_flow(session, flow)
@@ -407,59 +404,18 @@ class ChatbotProcessor:
             if not settings:
                 return True
 
-            if not settings.business_hours:
-                return True  # No business hours configured
-
-            now = datetime.now()
-            current_time = now.time()
-            day_name = now.strftime("%A")  # Monday, Tuesday, etc.
-
-            # Find the business hours entry for today
-            for row in settings.business_hours:
-                if row.day == day_name:
-                    # Check if this day is enabled (open)
-                    if not row.enabled:
-                        return False  # Closed on this day
-
-                    # Check time range
-                    start = self._parse_time(row.start_time)
-                    end = self._parse_time(row.end_time)
-
-                    if start and end:
-                        return start <= current_time <= end
-                    return True  # Day is enabled but no specific times set
-
-            # No entry for this day - default to closed
-            return False
+            return settings.is_business_hours()
 
         except Exception as e:
             frappe.log_error(f"is_business_hours error: {str(e)}")
         return True  # Default to open if there's an error
 
-    def _parse_time(self, time_value):
-        """Parse time value to time object."""
-        if not time_value:
-            return None
-
-        if isinstance(time_value, str):
-            from datetime import time
-            try:
-                parts = time_value.split(":")
-                return time(int(parts[0]), int(parts[1]), int(parts[2]) if len(parts) > 2 else 0)
-            except (ValueError, IndexError):
-                return None
-
-        # Already a time object
-        return time_value
-
 
 def process_incoming_message(doc, method=None):
     """
     Hook function called when WhatsApp Message is created.
     Process synchronously but safely - never raise exceptions.
     """
-    global _processing_messages
-
     try:
         # Skip if this is an outgoing message
         if getattr(doc, "type", None) != "Incoming":
@@ -469,9 +425,8 @@ def process_incoming_message(doc, method=None):
         if getattr(doc.flags, "ignore_chatbot", False):
             return
 
-        # Skip if already being processed (prevent infinite loops)
         doc_name = getattr(doc, "name", None)
-        if not doc_name or doc_name in _processing_messages:
+        if not doc_name:
             return
 
         # Only process text, button, and flow content types
@@ -479,26 +434,24 @@ def process_incoming_message(doc, method=None):
         if content_type not in ["text", "button", "flow"]:
             return
 
-        # Quick check if chatbot is enabled (without full initialization)
-        try:
-            if not frappe.db.exists("WhatsApp Chatbot"):
-                return
-            enabled = frappe.db.get_single_value("WhatsApp Chatbot", "enabled")
-            if not enabled:
-                return
-        except Exception:
+        # Gating: enabled, account, exclusions, agent transfer and rate limit
+        # (security: prevents abuse) in one Redis round trip, so dropped
+        # messages never touch the database or enqueue a job
+        phone_number = getattr(doc, "from", None) or getattr(doc, "from_", None)
+        if not phone_number:
             return
 
-        # Security: Check rate limit to prevent abuse
-        phone_number = getattr(doc, "from", None) or getattr(doc, "from_", None)
-        if phone_number and not _check_chatbot_rate_limit(phone_number):
-            # Rate limit exceeded, skip processing silently
+        try:
+            if not should_handle(phone_number, getattr(doc, "whatsapp_account", None)):
+                return
+        except Exception as e:
+            frappe.log_error(f"Chatbot gating error: {str(e)}", "WhatsApp Chatbot Error")
             return
 
         # Extract message data
         message_data = {
             "name": doc_name,
-            "from": getattr(doc, "from", None) or getattr(doc, "from_", None),
+            "from": phone_number,
             "message": getattr(doc, "message", "") or "",
             "content_type": content_type or "text",
             "whatsapp_account": getattr(doc, "whatsapp_account", None),
@@ -506,22 +459,10 @@ def process_incoming_message(doc, method=None):
             "flow_response": getattr(doc, "flow_response", None)
         }
 
-        # Mark as being processed to prevent loops
-        _processing_messages.add(doc_name)
-
-        try:
-            # Process using background job to prevent blocking the message save
-            # This is critical for v16 scalability and handling AI latencies
-            frappe.enqueue(
-                "frappe_whatsapp_chatbot.chatbot.processor.run_processor",
-                message_data=message_data,
-                queue="default",
-                now=frappe.flags.in_test
-            )
-        finally:
-            # Note: We don't discard here because the background job will do it
-            # This keeps the message locked until the background job finishes
-            pass
+        # Process in a background job to prevent blocking the message save.
+        # Messages of one conversation are queued and processed strictly in
+        # order by one worker at a time, other conversations run in parallel
+        enqueue_message(message_data)
 
     except Exception as e:
         # Log error but NEVER re-raise - we must not break the incoming message save
@@ -535,9 +476,7 @@ def process_incoming_message(doc, method=None):
 
 
 def run_processor(message_data):
-    """Background job to process message (kept for compatibility)."""
-    global _processing_messages
-
+    """Process one message through all stages (kept as a job entry point for compatibility)."""
     message_name = message_data.get("name", "unknown")
 
     try:
@@ -548,6 +487,44 @@ def run_processor(message_data):
             f"run_processor error for {message_name}: {str(e)}",
             "WhatsApp Chatbot Error"
         )
-    finally:
-        # Clean up processing flag
-        _processing_messages.discard(message_name)
+
+
+def run_fast_path(message_data):
+    """Process one message up to the AI stage.
+
+    Returns:
+        True if the message still needs the AI fallback, which the caller
+        runs on the AI queue
+    """
+    message_name = message_data.get("name", "unknown")
+
+    try:
+        processor = ChatbotProcessor(message_data)
+        if processor.process_fast_path():
+            return False
+
+        settings = processor.get_chatbot_settings()
+        if settings and settings.enable_ai:
+            return True
+
+        # Only the default response left, no need for the AI queue
+        processor.process_fallback()
+    except Exception as e:
+        frappe.log_error(
+            f"run_fast_path error for {message_name}: {str(e)}",
+            "WhatsApp Chatbot Error"
+        )
+    return False
+
+
+def run_fallback(message_data):
+    """Run the AI fallback and default response stages for one message."""
+    message_name = message_data.get("name", "unknown")
+
+    try:
+        ChatbotProcessor(message_data).process_fallback()
+    except Exception as e:
+        frappe.log_error(
+            f"run_fallback error for {message_name}: {str(e)}",
+            "WhatsApp Chatbot Error"
+        )
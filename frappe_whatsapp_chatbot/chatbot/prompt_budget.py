@@ -0,0 +1,201 @@
+"""
+Token-budgeted assembly of AI prompts.
+
+The system prompt, the context, the conversation summary, the recent history
+and the customer's message are packed into the AI Prompt Budget (in tokens),
+most important first:
+
+1. The system prompt and the customer's message, always in full
+2. The last PRIORITY_HISTORY_MESSAGES messages of the recent history
+3. The context parts, in rank order (AI Contexts by priority, then the
+   Knowledge Base entries by relevance)
+4. The conversation summary
+5. The rest of the recent history, newest first
+
+A context part or summary that doesn't fit is cut to the space left if that
+is at least MIN_CUT_TOKENS, and dropped otherwise; history messages are kept
+or dropped whole. Tokens are counted with tiktoken for OpenAI models when it
+is installed, and estimated from the text length otherwise.
+"""
+import functools
+import math
+
+# Estimated characters per token, by provider (English text)
+CHARS_PER_TOKEN = {
+    "OpenAI": 4,
+    "Anthropic": 3.5,
+    "Google": 4
+}
+DEFAULT_CHARS_PER_TOKEN = 3.5
+
+# Tokens added by the chat format for each message or context part
+PART_OVERHEAD = 4
+
+# History messages longer than this are cut before packing
+HISTORY_MESSAGE_CHARS = 200
+
+# The customer's last exchange outranks the context
+PRIORITY_HISTORY_MESSAGES = 2
+
+# Parts are not cut to less than this, they are dropped instead
+MIN_CUT_TOKENS = 20
+
+CUT_MARKER = " [...]"
+
+
+class Tokenizer:
+    """Counts and cuts text in a provider's (estimated) tokens."""
+
+    def __init__(self, provider=None, model=None):
+        self.encoding = _get_encoding(model) if provider == "OpenAI" else None
+        self.chars_per_token = CHARS_PER_TOKEN.get(provider, DEFAULT_CHARS_PER_TOKEN)
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.encoding:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def cut(self, text, tokens):
+        """Cut text to at most tokens tokens, marking the cut."""
+        if self.count(text) <= tokens:
+            return text
+
+        tokens -= self.count(CUT_MARKER)
+        if self.encoding:
+            text = self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:tokens])
+        else:
+            text = text[:int(tokens * self.chars_per_token)]
+        return text.rstrip() + CUT_MARKER
+
+
+@functools.lru_cache(maxsize=16)
+def _get_encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+
+    try:
+        return tiktoken.encoding_for_model(model or "")
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")  # Newer models
+
+
+class Prompt:
+    """
+    An assembled prompt.
+
+    Attributes:
+        system: System prompt
+        message: The customer's message
+        context_parts: list of (title, text) that fit, best first
+        summary: Conversation summary ("" if none or dropped)
+        history: Recent messages that fit, oldest first
+        tokens: Tokens per section, and "total" and "budget"
+        dropped: Number of context parts, summaries and messages left out
+        cut: Number of context parts and summaries that were shortened
+    """
+
+    def __init__(self, system, message):
+        self.system = system
+        self.message = message
+        self.context_parts = []
+        self.summary = ""
+        self.history = []
+        self.tokens = {}
+        self.dropped = 0
+        self.cut = 0
+
+    @property
+    def context(self):
+        """The context parts as text, consecutive parts of a title grouped."""
+        sections = []
+        for title, text in self.context_parts:
+            if sections and sections[-1][0] == title:
+                sections[-1][1].append(text)
+            else:
+                sections.append((title, [text]))
+        return "\n\n".join(f"[{title}]\n" + "\n---\n".join(texts) for title, texts in sections)
+
+
+def assemble_prompt(tokenizer, budget, system, message, context_parts=(), summary="", history=()):
+    """Pack a prompt into a token budget.
+
+    Args:
+        tokenizer: Tokenizer of the provider the prompt is for
+        budget: Maximum prompt tokens, 0 for no limit
+        system: System prompt
+        message: The customer's message
+        context_parts: list of (title, text), best first
+        summary: Summary of the earlier conversation
+        history: Recent messages (dicts with direction and message), oldest first
+
+    Returns:
+        Prompt
+    """
+    prompt = Prompt(system, message)
+    remaining = (budget or math.inf) - tokenizer.count(system) - tokenizer.count(message) - 2 * PART_OVERHEAD
+
+    def fit(text, header="", can_cut=True):
+        """Get text as it fits in the remaining budget (None if it doesn't)."""
+        nonlocal remaining
+        cost = tokenizer.count(header) + tokenizer.count(text) + PART_OVERHEAD
+        if cost <= remaining:
+            remaining -= cost
+            return text
+
+        room = remaining - tokenizer.count(header) - PART_OVERHEAD
+        if not can_cut or room < MIN_CUT_TOKENS:
+            return None
+
+        text = tokenizer.cut(text, room)
+        remaining -= tokenizer.count(header) + tokenizer.count(text) + PART_OVERHEAD
+        prompt.cut += 1
+        return text
+
+    history = [
+        dict(msg, message=(msg.get("message") or "")[:HISTORY_MESSAGE_CHARS])
+        for msg in history
+    ]
+    newest_first = history[::-1]
+    kept = []
+
+    def fit_history(messages):
+        for msg in messages:
+            if fit(msg["message"], can_cut=False) is None:
+                return False
+            kept.append(msg)
+        return True
+
+    # Older messages are only kept while every newer one fits
+    history_fits = fit_history(newest_first[:PRIORITY_HISTORY_MESSAGES])
+
+    for title, text in context_parts:
+        text = fit(text, header=f"[{title}]\n")
+        if text is None:
+            prompt.dropped += 1
+        else:
+            prompt.context_parts.append((title, text))
+
+    if summary:
+        prompt.summary = fit(summary) or ""
+        if not prompt.summary:
+            prompt.dropped += 1
+
+    if history_fits:
+        fit_history(newest_first[PRIORITY_HISTORY_MESSAGES:])
+    prompt.dropped += len(history) - len(kept)
+    prompt.history = kept[::-1]
+
+    prompt.tokens = {
+        "system": tokenizer.count(system),
+        "context": tokenizer.count(prompt.context),
+        "summary": tokenizer.count(prompt.summary),
+        "history": sum(tokenizer.count(msg["message"]) for msg in prompt.history),
+        "message": tokenizer.count(message)
+    }
+    prompt.tokens["total"] = sum(prompt.tokens.values())
+    prompt.tokens["budget"] = budget or 0
+    return prompt
@@ -0,0 +1,274 @@
+"""
+Cache of AI replies, shared across customers where possible.
+
+Replies are cached under the normalized question (casefolded, punctuation and
+whitespace collapsed), so "What are your hours?" and "what are your  hours"
+are one entry. A reply is shared by all customers unless it was built from
+customer-specific data (a user specific AI Context, or the conversation
+history), in which case only that customer gets it back.
+
+Entries are stamped with a version that is bumped whenever the Knowledge
+Base, the AI Contexts or the settings change, so replies built from stale
+context are never served.
+
+Optionally, a question that misses can reuse the reply to a near-duplicate
+question: shared questions are embedded (see kb_vectors) and appended to a
+per-version Redis list that each worker mirrors incrementally.
+
+Concurrent misses of the same question are coalesced: the first caller takes
+a short lease and asks the AI provider, the others wait for its reply to be
+cached instead of all asking the provider at once (e.g. replies to a
+broadcast).
+"""
+import hashlib
+import re
+import time
+
+import frappe
+
+from frappe_whatsapp_chatbot.chatbot.cache import bump_version, get_version, run_script
+
+# Cache namespace whose version stamps all cached replies
+AI_RESPONSE_CACHE = "ai_response"
+
+# Customer-specific replies depend on a conversation that moves on quickly
+USER_CACHE_TTL = 300
+
+# Shared questions kept for near-duplicate matching, per version
+MAX_SIMILAR_ENTRIES = 1000
+SIMILAR_TTL = 24 * 60 * 60
+
+# Near-duplicate candidates whose reply is looked up before giving up
+SIMILAR_CANDIDATES = 3
+
+# Length of an entry digest (sha1 hex), entries of the vector list are
+# digest + vector bytes
+DIGEST_LENGTH = 40
+
+# Waiting for the lease holder's reply polls the cache, backing off from
+# POLL_INTERVAL to MAX_POLL_INTERVAL seconds
+POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 1
+
+# A lease outlives the reply deadline by this much, in case its holder dies
+LEASE_MARGIN = 5
+
+# KEYS: lease
+# ARGV: token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: vector list
+# ARGV: entry, max entries, ttl
+APPEND_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Worker-local mirror of the vector list: {site: (list name, digests, matrix)}
+_local_vectors = {}
+
+
+def normalize(text):
+    """Casefold text and collapse punctuation and whitespace."""
+    return " ".join(re.sub(r"[^\w\s]|_", " ", (text or "").casefold()).split())
+
+
+def clear_response_cache():
+    """Invalidate all cached AI replies."""
+    bump_version(AI_RESPONSE_CACHE)
+
+
+class CachedQuestion:
+    """
+    A question's entry in the reply cache.
+
+    The version is read once, when the question is looked up, so a reply
+    generated while the Knowledge Base changed is stored under the old
+    version and never served.
+    """
+
+    def __init__(self, message, phone_number=None, similarity=0):
+        """
+        Args:
+            message: The customer's message
+            phone_number: Customer the reply is specific to, None to share it
+            similarity: Minimum cosine similarity for reusing the reply to a
+                near-duplicate shared question, 0 to disable
+        """
+        self.normalized = normalize(message)
+        self.phone_number = phone_number
+        self.similarity = similarity if not phone_number else 0
+        self.version = get_version(AI_RESPONSE_CACHE)
+        self.digest = hashlib.sha1(f"{phone_number or ''}\0{self.normalized}".encode()).hexdigest()
+        self.lease_token = None
+
+    def get(self):
+        """Get the cached reply, or None."""
+        if not self.normalized:
+            return None
+
+        response = _get_reply(_entry_name(self.version, self.digest))
+        if response or not self.similarity:
+            return response
+
+        try:
+            return self.get_similar()
+        except Exception as e:
+            frappe.log_error(f"AI response cache similarity error: {str(e)}")
+            return None
+
+    def set(self, response, ttl):
+        """Cache a reply for ttl seconds."""
+        if not (self.normalized and response and ttl):
+            return
+
+        frappe.cache.set_value(_entry_name(self.version, self.digest), response, expires_in_sec=ttl)
+        if self.similarity:
+            try:
+                self.add_vector()
+            except Exception as e:
+                frappe.log_error(f"AI response cache similarity error: {str(e)}")
+
+    def lead_or_wait(self, timeout):
+        """Take the lease to generate the reply, or wait for its holder's reply.
+
+        Args:
+            timeout: Seconds to wait at most (the reply deadline)
+
+        Returns:
+            The reply cached meanwhile, or None if this caller should generate
+            it: it holds the lease (release() it when done), or the wait
+            timed out
+        """
+        if not self.normalized:
+            return None
+
+        lease_key = frappe.cache.make_key(_lease_name(self.version, self.digest))
+        token = frappe.generate_hash(length=12)
+        deadline = time.monotonic() + timeout
+        delay = POLL_INTERVAL
+
+        while True:
+            if frappe.cache.set(lease_key, token, nx=True, ex=int(timeout) + LEASE_MARGIN):
+                self.lease_token = token
+                return None
+
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+            response = _get_reply(_entry_name(self.version, self.digest))
+            if response:
+                return response
+            if time.monotonic() >= deadline:
+                return None
+            # Lease released without a reply (the provider failed): the next
+            # loop takes it over
+
+    def release(self):
+        """Release the lease taken by lead_or_wait, if held."""
+        if not self.lease_token:
+            return
+
+        try:
+            run_script(
+                RELEASE_SCRIPT,
+                keys=[frappe.cache.make_key(_lease_name(self.version, self.digest))],
+                args=[self.lease_token]
+            )
+        except Exception as e:
+            # The lease expires on its own
+            frappe.log_error(f"AI response cache lease error: {str(e)}")
+        self.lease_token = None
+
+    def get_similar(self):
+        """Get the reply to the closest cached shared question above the threshold."""
+        import numpy as np
+
+        from frappe_whatsapp_chatbot.chatbot.kb_vectors import get_embedder
+
+        embedder = get_embedder()
+        digests, matrix = _get_vectors(_vectors_name(self.version, embedder))
+        if not digests:
+            return None
+
+        scores = matrix @ embedder.embed([self.normalized])[0]
+        for row in np.argsort(-scores)[:SIMILAR_CANDIDATES]:
+            if scores[row] < self.similarity:
+                break
+            response = _get_reply(_entry_name(self.version, digests[row]))
+            if response:
+                return response
+        return None
+
+    def add_vector(self):
+        import numpy as np
+
+        from frappe_whatsapp_chatbot.chatbot.kb_vectors import get_embedder
+
+        embedder = get_embedder()
+        vector = embedder.embed([self.normalized])[0].astype(np.float16)
+        run_script(
+            APPEND_SCRIPT,
+            keys=[frappe.cache.make_key(_vectors_name(self.version, embedder))],
+            args=[self.digest.encode() + vector.tobytes(), MAX_SIMILAR_ENTRIES, SIMILAR_TTL]
+        )
+
+
+def _get_reply(name):
+    # Straight from Redis: get_value would remember a miss in the job's local
+    # cache, and a waiter would never see the lease holder's reply
+    return frappe.cache.get_value(name, expires=True)
+
+
+def _entry_name(version, digest):
+    return f"wa_chatbot_ai_response:{version}:{digest}"
+
+
+def _lease_name(version, digest):
+    return f"wa_chatbot_ai_response_lease:{version}:{digest}"
+
+
+def _vectors_name(version, embedder):
+    return f"wa_chatbot_ai_response_vectors:{version}:{embedder.id}"
+
+
+def _get_vectors(name):
+    """Get this worker's mirror of a vector list, with the entries appended since.
+
+    Returns:
+        (digests, float32 matrix with a row per digest)
+    """
+    import numpy as np
+
+    site = getattr(frappe.local, "site", None)
+    local = _local_vectors.get(site)
+    if not local or local[0] != name:
+        local = (name, [], None)  # New version or embedder, start over
+
+    pipeline = frappe.cache.pipeline()
+    pipeline.llen(frappe.cache.make_key(name))
+    pipeline.lrange(frappe.cache.make_key(name), len(local[1]), -1)
+    length, entries = pipeline.execute()
+    if length < len(local[1]):
+        # The list expired and was started again
+        local = (name, [], None)
+        entries = frappe.cache.lrange(name, 0, -1)  # Prefixes the key itself
+    if entries:
+        digests = local[1] + [entry[:DIGEST_LENGTH].decode() for entry in entries]
+        rows = np.stack([
+            np.frombuffer(entry[DIGEST_LENGTH:], dtype=np.float16) for entry in entries
+        ]).astype(np.float32)
+        matrix = rows if local[2] is None else np.vstack([local[2], rows])
+        local = (name, digests, matrix)
+
+    _local_vectors[site] = local
+    return local[1], local[2]
@@ -1,124 +1,84 @@
 import frappe
+import time
+from frappe.utils import get_datetime, now_datetime
 from datetime import datetime, timedelta
 
+from frappe_whatsapp_chatbot.chatbot.conversation_history import get_history
+from frappe_whatsapp_chatbot.chatbot.session_store import (
+    drop_session_states,
+    get_recently_active,
+    get_session_state,
+    load_session_state
+)
+from frappe_whatsapp_chatbot.chatbot.settings import get_settings
+from frappe_whatsapp_chatbot.chatbot.unit_of_work import UnitOfWork
+
+# Redis sorted set of active sessions scored by last_activity timestamp
+SESSION_EXPIRY_KEY = "wa_chatbot_session_expiry"
+
+# Last session name handled by cleanup_expired_sessions, to resume after it
+CLEANUP_CURSOR_KEY = "wa_chatbot_cleanup_cursor"
+
+# Timeout messages are sent at most this fast, so a backlog of expired
+# sessions doesn't burst against the WhatsApp API
+TIMEOUT_MESSAGES_PER_SECOND = 10
+
 
 class SessionManager:
     """Manage chatbot conversation sessions."""
 
-    def __init__(self, phone_number, whatsapp_account):
+    def __init__(self, phone_number, whatsapp_account, unit_of_work=None):
+        """
+        Args:
+            phone_number: The customer's phone number
+            whatsapp_account: WhatsApp account of the conversation
+            unit_of_work: UnitOfWork collecting this message's writes; without
+                one, every change is committed right away
+        """
         self.phone_number = phone_number
         self.account = whatsapp_account
+        self.uow = unit_of_work or UnitOfWork(immediate=True)
         self.timeout_minutes = self.get_timeout()
 
     def get_timeout(self):
         """Get session timeout from settings."""
         try:
-            if frappe.db.exists("WhatsApp Chatbot"):
-                settings = frappe.get_single("WhatsApp Chatbot")
-                return settings.session_timeout_minutes or 30
+            return get_settings().session_timeout_minutes or 30
         except Exception:
             pass
         return 30
 
     def get_active_session(self):
-        """Get active session for this phone number."""
+        """Get active session state for this phone number (from Redis if cached)."""
         try:
-            # Check for expired sessions first
-            self.expire_old_sessions()
+            session = get_session_state(self.account, self.phone_number)
 
-            session = frappe.db.get_value(
-                "WhatsApp Chatbot Session",
-                {
-                    "phone_number": self.phone_number,
-                    "whatsapp_account": self.account,
-                    "status": "Active"
-                },
-                "name"
-            )
+            if not session:
+                return None
 
-            if session:
-                return frappe.get_doc("WhatsApp Chatbot Session", session)
+            # Only this caller's deadline is checked here, other sessions
+            # are timed out by the expire_sessions scheduler job
+            if self.is_expired(session.last_activity):
+                expire_session(session, self.uow)
+                return None
 
-            return None
+            return session
 
         except Exception as e:
             frappe.log_error(f"SessionManager get_active_session error: {str(e)}")
             return None
 
-    def expire_old_sessions(self):
-        """Mark old sessions as timed out."""
-        try:
-            timeout_threshold = datetime.now() - timedelta(minutes=self.timeout_minutes)
-
-            expired = frappe.get_all(
-                "WhatsApp Chatbot Session",
-                filters={
-                    "status": "Active",
-                    "last_activity": ["<", timeout_threshold]
-                },
-                pluck="name"
-            )
-
-            for session_name in expired:
-                session = frappe.get_doc("WhatsApp Chatbot Session", session_name)
-                session.status = "Timeout"
-                session.completed_at = datetime.now()
-                session.save(ignore_permissions=True)
-
-                # Send timeout message
-                if session.current_flow:
-                    flow = frappe.get_doc("WhatsApp Chatbot Flow", session.current_flow)
-                    if flow.timeout_message:
-                        self.send_timeout_message(session, flow.timeout_message)
-
-            if expired:
-                frappe.db.commit()
-
-        except Exception as e:
-            frappe.log_error(f"SessionManager expire_old_sessions error: {str(e)}")
-
-    def send_timeout_message(self, session, message):
-        """Send session timeout message."""
-        try:
-            frappe.get_doc({
-                "doctype": "WhatsApp Message",
-                "type": "Outgoing",
-                "to": session.phone_number,
-                "message": message,
-                "content_type": "text",
-                "whatsapp_account": session.whatsapp_account
-            }).insert(ignore_permissions=True)
-        except Exception as e:
-            frappe.log_error(f"SessionManager send_timeout_message error: {str(e)}")
+    def is_expired(self, last_activity):
+        """Check if a session with this last activity has passed its deadline."""
+        if not last_activity:
+            return False
+        timeout_threshold = datetime.now() - timedelta(minutes=self.timeout_minutes)
+        return get_datetime(last_activity) < timeout_threshold
 
     def get_conversation_history(self, limit=20):
         """Get recent conversation history for AI context."""
         try:
-            messages = frappe.get_all(
-                "WhatsApp Message",
-                filters={
-                    "whatsapp_account": self.account,
-                    "content_type": "text"
-                },
-                or_filters=[
-                    ["from", "=", self.phone_number],
-                    ["to", "=", self.phone_number]
-                ],
-                fields=["type", "message", "creation"],
-                order_by="creation desc",
-                limit=limit
-            )
-
-            # Convert to standardized format
-            history = []
-            for msg in reversed(messages):
-                history.append({
-                    "direction": "Incoming" if msg.type == "Incoming" else "Outgoing",
-                    "message": msg.message,
-                    "timestamp": msg.creation
-                })
-
-            return history
+            return get_history(self.account, self.phone_number, limit)
 
         except Exception as e:
             frappe.log_error(f"SessionManager get_conversation_history error: {str(e)}")
@@ -126,123 +86,289 @@ class SessionManager:
 
     def get_conversation_summary(self, max_messages=10):
         """
-        Get a summarized context for long conversations.
-        Returns last N messages with older ones summarized.
+        Get a compact context for long conversations.
+        Returns the last N messages, preceded by a rolling summary of older ones.
         """
         try:
-            # Check cache first
-            cache_key = f"wa_session_summary:{self.phone_number}:{self.account}"
-            cached = frappe.cache.get(cache_key)
-            if cached:
-                return cached
-            
-            # Get all recent messages (more than we need for summary)
-            messages = frappe.get_all(
-                "WhatsApp Message",
-                filters={
-                    "whatsapp_account": self.account,
-                    "content_type": "text"
-                },
-                or_filters=[
-                    ["from", "=", self.phone_number],
-                    ["to", "=", self.phone_number]
-                ],
-                fields=["type", "message", "creation"],
-                order_by="creation desc",
-                limit=50
-            )
-            
-            if len(messages) <= max_messages:
-                # Not enough messages to summarize, return as-is
-                return self.get_conversation_history(max_messages)
-            
-            # Split: recent messages (detailed) + older messages (summarized)
-            recent = messages[:max_messages]
-            older = messages[max_messages:30]  # Summarize next 20
-            
-            # Build simple summary of older messages
-            summary_parts = []
-            user_topics = set()
-            
-            for msg in older:
-                # Extract key topics (simple approach)
-                words = msg.message.lower().split()[:5]
-                user_topics.update(words)
-            
-            if user_topics:
-                summary = f"[Earlier context: User discussed topics including: {', '.join(list(user_topics)[:10])}]"
-                summary_parts.append({"direction": "System", "message": summary, "timestamp": None})
-            
-            # Add recent messages
-            history = summary_parts
-            for msg in reversed(recent):
-                history.append({
-                    "direction": "Incoming" if msg.type == "Incoming" else "Outgoing",
-                    "message": msg.message,
-                    "timestamp": msg.creation
-                })
-            
-            # Cache for 5 minutes
-            frappe.cache.set(cache_key, history, expires_in_sec=300)
-            
-            return history
-            
+            from frappe_whatsapp_chatbot.chatbot.conversation_summary import get_summarized_history
+            return get_summarized_history(self.account, self.phone_number, max_messages)
+
         except Exception as e:
             frappe.log_error(f"SessionManager get_conversation_summary error: {str(e)}")
             return self.get_conversation_history(max_messages)
 
 
-def cleanup_expired_sessions():
-    """Scheduled job to clean up expired sessions."""
+def log_session_messages(session_name, messages):
+    """Append messages to a session's message log in one bulk insert.
+
+    Args:
+        session_name: WhatsApp Chatbot Session name
+        messages: list of dicts with direction, message, timestamp, step_name
+    """
+    now = now_datetime()
+    user = frappe.session.user
+    fields = [
+        "name", "creation", "modified", "owner", "modified_by",
+        "session", "direction", "message", "timestamp", "step_name"
+    ]
+
+    values = []
+    for i, message in enumerate(messages):
+        # Distinct creation times keep the order of messages added together
+        creation = now + timedelta(microseconds=i)
+        values.append((
+            frappe.generate_hash(length=10), creation, creation, user, user,
+            session_name, message.get("direction"), message.get("message"),
+            message.get("timestamp"), message.get("step_name")
+        ))
+
+    frappe.db.bulk_insert("WhatsApp Session Message", fields, values)
+
+
+def get_session_messages(session_name, start=0, page_length=20):
+    """Get one page of a session's message log, newest first."""
+    return frappe.get_all(
+        "WhatsApp Session Message",
+        filters={"session": session_name},
+        fields=["direction", "message", "timestamp", "step_name"],
+        order_by="creation desc",
+        start=start,
+        page_length=page_length
+    )
+
+
+def delete_session_messages(session_name):
+    """Delete a session's message log."""
+    frappe.db.delete("WhatsApp Session Message", {"session": session_name})
+
+
+def _expiry_index_key():
+    return frappe.cache.make_key(SESSION_EXPIRY_KEY)
+
+
+def track_session_activity(session):
+    """Keep a session's entry in the expiry index in sync with its status."""
     try:
-        # Get settings
-        if not frappe.db.exists("WhatsApp Chatbot"):
-            return
+        if session.status == "Active":
+            last_activity = get_datetime(session.last_activity or datetime.now())
+            frappe.cache.zadd(_expiry_index_key(), {session.name: last_activity.timestamp()})
+        else:
+            untrack_session(session.name)
+    except Exception as e:
+        frappe.log_error(f"track_session_activity error for {session.name}: {str(e)}")
+
+
+def untrack_session(session_name):
+    """Remove a session from the expiry index."""
+    frappe.cache.zrem(_expiry_index_key(), session_name)
+
+
+def _timeout_message_doc(session, message):
+    return frappe.get_doc({
+        "doctype": "WhatsApp Message",
+        "type": "Outgoing",
+        "to": session.phone_number,
+        "message": message,
+        "content_type": "text",
+        "whatsapp_account": session.whatsapp_account
+    })
+
 
-        settings = frappe.get_single("WhatsApp Chatbot")
+def send_timeout_message(session, message):
+    """Send session timeout message."""
+    try:
+        _timeout_message_doc(session, message).insert(ignore_permissions=True)
+    except Exception as e:
+        frappe.log_error(f"send_timeout_message error: {str(e)}")
+
+
+def expire_session(session, unit_of_work=None):
+    """Mark a session as timed out and send its flow's timeout message.
+
+    Args:
+        session: Session state to time out
+        unit_of_work: UnitOfWork of the message being processed, to write the
+            timeout in its transaction; without one, the caller commits
+    """
+    session.status = "Timeout"
+    session.completed_at = datetime.now()
+    if unit_of_work:
+        unit_of_work.save(session)
+    else:
+        session.save(ignore_permissions=True)
+
+    if session.current_flow:
+        from frappe_whatsapp_chatbot.chatbot.flow_graph import get_compiled_flow
+
+        timeout_message = get_compiled_flow(session.current_flow).timeout_message
+        if timeout_message:
+            if unit_of_work:
+                unit_of_work.send(_timeout_message_doc(session, timeout_message))
+            else:
+                send_timeout_message(session, timeout_message)
+
+
+def expire_sessions(batch_size=500):
+    """Scheduled job draining the expiry index of sessions past their deadline."""
+    try:
+        settings = get_settings()
         if not settings.enabled:
             return
 
         timeout_minutes = settings.session_timeout_minutes or 30
         timeout_threshold = datetime.now() - timedelta(minutes=timeout_minutes)
 
-        # Find all expired active sessions
-        expired_sessions = frappe.get_all(
-            "WhatsApp Chatbot Session",
-            filters={
-                "status": "Active",
-                "last_activity": ["<", timeout_threshold]
-            },
-            fields=["name", "phone_number", "whatsapp_account", "current_flow"]
+        expired = frappe.cache.zrangebyscore(
+            _expiry_index_key(), "-inf", timeout_threshold.timestamp(),
+            start=0, num=batch_size
         )
 
-        for session_data in expired_sessions:
-            try:
-                session = frappe.get_doc("WhatsApp Chatbot Session", session_data.name)
-                session.status = "Timeout"
-                session.completed_at = datetime.now()
-                session.save(ignore_permissions=True)
-
-                # Send timeout message
-                if session_data.current_flow:
-                    flow = frappe.get_doc("WhatsApp Chatbot Flow", session_data.current_flow)
-                    if flow.timeout_message:
-                        frappe.get_doc({
-                            "doctype": "WhatsApp Message",
-                            "type": "Outgoing",
-                            "to": session_data.phone_number,
-                            "message": flow.timeout_message,
-                            "content_type": "text",
-                            "whatsapp_account": session_data.whatsapp_account
-                        }).insert(ignore_permissions=True)
+        for session_name in expired:
+            session_name = frappe.safe_decode(session_name)
+            session = load_session_state(session_name)
+            if not session:
+                untrack_session(session_name)
+                continue
 
+            try:
+                if session.status != "Active":
+                    untrack_session(session_name)
+                elif get_datetime(session.last_activity) >= timeout_threshold:
+                    # Stale score, the session was active since it was indexed
+                    track_session_activity(session)
+                else:
+                    expire_session(session)
             except Exception as e:
-                frappe.log_error(
-                    f"cleanup_expired_sessions error for {session_data.name}: {str(e)}"
-                )
+                frappe.log_error(f"expire_sessions error for {session_name}: {str(e)}")
 
-        if expired_sessions:
+        if expired:
             frappe.db.commit()
 
     except Exception as e:
+        frappe.log_error(f"expire_sessions error: {str(e)}")
+
+
+def cleanup_expired_sessions(chunk_size=500):
+    """Scheduled job to clean up expired sessions.
+
+    Backstop for sessions missing from the expiry index (e.g. created before
+    it existed or after a Redis flush). Sessions are timed out in chunks with
+    one UPDATE and one commit each, walking the table by name from a cursor
+    kept in Redis, so a run that is interrupted resumes where it stopped.
+
+    Returns:
+        dict with the number of sessions "processed" and "expired"
+    """
+    stats = {"processed": 0, "expired": 0}
+
+    try:
+        settings = get_settings()
+        if not settings.enabled:
+            return stats
+
+        timeout_minutes = settings.session_timeout_minutes or 30
+        timeout_threshold = datetime.now() - timedelta(minutes=timeout_minutes)
+        timeout_messages = {}  # flow -> timeout message, loaded once per flow
+
+        cursor = frappe.cache.get_value(CLEANUP_CURSOR_KEY) or ""
+        while True:
+            sessions = frappe.get_all(
+                "WhatsApp Chatbot Session",
+                filters={
+                    "status": "Active",
+                    "last_activity": ["<", timeout_threshold],
+                    "name": [">", cursor]
+                },
+                fields=["name", "phone_number", "whatsapp_account", "current_flow"],
+                order_by="name asc",
+                limit=chunk_size
+            )
+            if not sessions:
+                break
+
+            expired = _expire_chunk(sessions, timeout_threshold, timeout_messages)
+
+            cursor = sessions[-1].name
+            frappe.cache.set_value(CLEANUP_CURSOR_KEY, cursor)
+            stats["processed"] += len(sessions)
+            stats["expired"] += expired
+
+        # Full pass done, the next run starts from the beginning
+        frappe.cache.delete_value(CLEANUP_CURSOR_KEY)
+
+        if stats["processed"]:
+            frappe.logger("frappe_whatsapp_chatbot").info(
+                f"cleanup_expired_sessions: processed {stats['processed']}, expired {stats['expired']}"
+            )
+
+    except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(f"cleanup_expired_sessions error: {str(e)}")
+
+    return stats
+
+
+def _expire_chunk(sessions, timeout_threshold, timeout_messages):
+    """Time out one chunk of sessions and queue their timeout messages."""
+    # The database may lag behind the Redis state by one flush
+    active = get_recently_active(sessions, timeout_threshold)
+    sessions = [s for s in sessions if s.name not in active]
+    if not sessions:
+        return 0
+
+    now = now_datetime()
+    Session = frappe.qb.DocType("WhatsApp Chatbot Session")
+    (
+        frappe.qb.update(Session)
+        .set(Session.status, "Timeout")
+        .set(Session.completed_at, now)
+        .set(Session.modified, now)
+        .where(Session.name.isin([s.name for s in sessions]))
+        .where(Session.status == "Active")
+    ).run()
+    frappe.db.commit()
+
+    drop_session_states(sessions)
+    frappe.cache.zrem(_expiry_index_key(), *[s.name for s in sessions])
+
+    messages = []
+    for session in sessions:
+        if not session.current_flow:
+            continue
+        if session.current_flow not in timeout_messages:
+            timeout_messages[session.current_flow] = _get_timeout_message(session.current_flow)
+        if timeout_messages[session.current_flow]:
+            messages.append({
+                "phone_number": session.phone_number,
+                "whatsapp_account": session.whatsapp_account,
+                "message": timeout_messages[session.current_flow]
+            })
+
+    if messages:
+        frappe.enqueue(
+            "frappe_whatsapp_chatbot.chatbot.session_manager.send_timeout_messages",
+            queue="long",
+            messages=messages
+        )
+
+    return len(sessions)
+
+
+def _get_timeout_message(flow_name):
+    from frappe_whatsapp_chatbot.chatbot.flow_graph import get_compiled_flow
+
+    try:
+        return get_compiled_flow(flow_name).timeout_message
+    except frappe.DoesNotExistError:
+        return None
+
+
+def send_timeout_messages(messages, commit_every=50):
+    """Background job sending a batch of timeout messages at a throttled rate."""
+    for i, message in enumerate(messages, start=1):
+        send_timeout_message(frappe._dict(message), message["message"])
+        if i % commit_every == 0:
+            frappe.db.commit()
+        time.sleep(1 / TIMEOUT_MESSAGES_PER_SECOND)
+
+    frappe.db.commit()
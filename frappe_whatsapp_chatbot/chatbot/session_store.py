@@ -0,0 +1,334 @@
+"""
+Redis-backed hot state of active chatbot sessions.
+
+The state of a conversation's active session (flow, step, retries, session
+data and last activity) lives in a Redis hash keyed by (account, phone
+number), so a turn needs no database reads or writes. Changed sessions are
+marked dirty and written to WhatsApp Chatbot Session in batches by the
+flush_sessions job; the dirty set lives in Redis, so no flush is lost when a
+worker restarts. Ending a session (completed, cancelled, timed out, handed
+over) is written to the database right away.
+"""
+import frappe
+import json
+from frappe.utils import get_datetime, now_datetime
+
+from frappe_whatsapp_chatbot.chatbot.cache import run_script
+from frappe_whatsapp_chatbot.chatbot.conversation_queue import get_conversation_id
+
+SESSION_DOCTYPE = "WhatsApp Chatbot Session"
+
+# Conversations whose Redis state is newer than the database
+DIRTY_SESSIONS_KEY = "wa_chatbot_dirty_sessions"
+
+# Cached state outlives any session timeout; flushes happen every minute
+STATE_TTL = 7 * 24 * 60 * 60
+
+# "No active session" is cached briefly: sessions saved as documents replace
+# it (on_update), but ones written by raw SQL or db.set_value (patches,
+# scripts) only show up once it expires
+NO_SESSION_TTL = 60
+
+STATE_FIELDS = (
+    "name", "phone_number", "whatsapp_account", "status", "current_flow",
+    "current_step", "step_retries", "session_data", "started_at",
+    "last_activity", "completed_at"
+)
+
+# Fields written by the batched flush, the rest never change while active
+HOT_FIELDS = ("current_flow", "current_step", "step_retries", "session_data", "last_activity")
+
+# KEYS: state hash, message list, dirty set
+# ARGV: session name, state json, conversation id, ttl, new messages...
+SAVE_SCRIPT = """
+redis.call('HSET', KEYS[1], 'name', ARGV[1], 'data', ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if #ARGV > 4 then
+    for i = 5, #ARGV do
+        redis.call('RPUSH', KEYS[2], ARGV[i])
+    end
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+end
+redis.call('SADD', KEYS[3], ARGV[3])
+"""
+
+# KEYS: state hash, message list, dirty set
+# ARGV: conversation id, flushed version, number of flushed messages
+# Only clears the dirty flag if the state has not changed since it was read
+FLUSHED_SCRIPT = """
+if tonumber(ARGV[3]) > 0 then
+    redis.call('LTRIM', KEYS[2], ARGV[3], -1)
+end
+if tonumber(redis.call('HGET', KEYS[1], 'version') or 0) == tonumber(ARGV[2]) then
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+"""
+
+
+class SessionState:
+    """
+    Active session state with the attributes and save API of the document.
+
+    FlowEngine and the processor use it in place of a WhatsApp Chatbot
+    Session document; save() and insert() are called by the UnitOfWork.
+    """
+
+    def __init__(self, data):
+        for field in STATE_FIELDS:
+            setattr(self, field, data.get(field))
+        self._new_messages = []
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in STATE_FIELDS}
+
+    def is_new(self):
+        return not self.name
+
+    def add_message(self, direction, message, step_name=None):
+        """Add a message to the session history, logged with the state."""
+        self._new_messages.append({
+            "direction": direction,
+            "message": message,
+            "timestamp": str(now_datetime()),
+            "step_name": step_name
+        })
+
+    def insert(self, ignore_permissions=True):
+        """Create the session document, then cache its state."""
+        doc = frappe.get_doc({"doctype": SESSION_DOCTYPE, **self.as_dict()})
+        doc._new_messages, self._new_messages = self._new_messages, []
+        doc.insert(ignore_permissions=ignore_permissions)
+
+        self.name = doc.name
+        self.last_activity = doc.last_activity
+        if self.status == "Active":
+            frappe.db.after_commit.add(lambda: cache_session_state(self))
+
+    def save(self, ignore_permissions=True):
+        """Save the state to Redis, or to the database once the session ends."""
+        if self.status != "Active":
+            _write_through(self)
+            return
+
+        from frappe_whatsapp_chatbot.chatbot.session_manager import track_session_activity
+
+        self.last_activity = now_datetime()
+        conversation_id = get_conversation_id(self.whatsapp_account, self.phone_number)
+        run_script(
+            SAVE_SCRIPT,
+            keys=_keys(conversation_id),
+            args=[
+                self.name,
+                _dumps(self.as_dict()),
+                conversation_id,
+                STATE_TTL,
+                *[json.dumps(message) for message in self._new_messages]
+            ]
+        )
+        self._new_messages = []
+        track_session_activity(self)
+
+
+def _names(conversation_id):
+    return [
+        f"wa_chatbot_session:{conversation_id}",
+        f"wa_chatbot_session_messages:{conversation_id}",
+        DIRTY_SESSIONS_KEY
+    ]
+
+
+def _keys(conversation_id):
+    """Prefixed keys, for scripts, pipelines and raw commands."""
+    return [frappe.cache.make_key(name) for name in _names(conversation_id)]
+
+
+def _dumps(data):
+    return json.dumps(data, default=str)
+
+
+def _loads(data):
+    data = json.loads(data)
+    for field in ("started_at", "last_activity", "completed_at"):
+        if data.get(field):
+            data[field] = get_datetime(data[field])
+    return data
+
+
+def get_session_state(whatsapp_account, phone_number):
+    """Get the active session of a conversation, from Redis if possible.
+
+    Returns:
+        SessionState or None if the conversation has no active session
+    """
+    state_key = _keys(get_conversation_id(whatsapp_account, phone_number))[0]
+    cached = frappe.cache.hmget(state_key, ["name", "data"])
+    if cached[0] is not None:
+        if not cached[0]:
+            return None  # Cached "no active session"
+        return SessionState(_loads(cached[1]))
+
+    session = frappe.db.get_value(
+        SESSION_DOCTYPE,
+        {
+            "phone_number": phone_number,
+            "whatsapp_account": whatsapp_account,
+            "status": "Active"
+        },
+        STATE_FIELDS,
+        as_dict=True
+    )
+    if not session:
+        pipeline = frappe.cache.pipeline()
+        pipeline.hset(state_key, "name", "")
+        pipeline.expire(state_key, NO_SESSION_TTL)
+        pipeline.execute()
+        return None
+
+    state = SessionState(session)
+    cache_session_state(state)
+    return state
+
+
+def load_session_state(session_name):
+    """Get a session's current state by name (Redis state if it is cached)."""
+    session = frappe.db.get_value(SESSION_DOCTYPE, session_name, STATE_FIELDS, as_dict=True)
+    if not session:
+        return None
+
+    state_key = _keys(get_conversation_id(session.whatsapp_account, session.phone_number))[0]
+    cached = frappe.cache.hmget(state_key, ["name", "data"])
+    if cached[0] and frappe.safe_decode(cached[0]) == session_name:
+        return SessionState(_loads(cached[1]))
+    return SessionState(session)
+
+
+def cache_session_state(state):
+    """Cache the state of a session that is up to date in the database."""
+    state_key = _keys(get_conversation_id(state.whatsapp_account, state.phone_number))[0]
+    pipeline = frappe.cache.pipeline()
+    pipeline.hset(state_key, mapping={"name": state.name, "data": _dumps(state.as_dict())})
+    pipeline.expire(state_key, STATE_TTL)
+    pipeline.execute()
+
+
+def drop_session_state(whatsapp_account, phone_number):
+    """Forget a conversation's cached state, the next lookup reads the database."""
+    conversation_id = get_conversation_id(whatsapp_account, phone_number)
+    state_key, messages_key, dirty_key = _keys(conversation_id)
+    pipeline = frappe.cache.pipeline()
+    pipeline.delete(state_key, messages_key)
+    pipeline.srem(dirty_key, conversation_id)
+    pipeline.execute()
+
+
+def get_recently_active(sessions, since):
+    """Get the sessions whose Redis state shows activity the database lacks.
+
+    Args:
+        sessions: rows with name, whatsapp_account and phone_number
+        since: datetime, activity at or after it counts
+
+    Returns:
+        set of session names that are dirty or were active since then
+    """
+    pipeline = frappe.cache.pipeline()
+    for session in sessions:
+        conversation_id = get_conversation_id(session.whatsapp_account, session.phone_number)
+        state_key, _, dirty_key = _keys(conversation_id)
+        pipeline.hmget(state_key, ["name", "data"])
+        pipeline.sismember(dirty_key, conversation_id)
+    results = pipeline.execute()
+
+    active = set()
+    for i, session in enumerate(sessions):
+        (name, data), dirty = results[2 * i], results[2 * i + 1]
+        if not name or frappe.safe_decode(name) != session.name:
+            continue
+        if dirty or get_datetime(_loads(data).get("last_activity")) >= since:
+            active.add(session.name)
+    return active
+
+
+def drop_session_states(sessions):
+    """Forget the cached state of several conversations in one round trip."""
+    pipeline = frappe.cache.pipeline()
+    for session in sessions:
+        conversation_id = get_conversation_id(session.whatsapp_account, session.phone_number)
+        state_key, messages_key, dirty_key = _keys(conversation_id)
+        pipeline.delete(state_key, messages_key)
+        pipeline.srem(dirty_key, conversation_id)
+    pipeline.execute()
+
+
+def _pending_messages(state):
+    # lrange prefixes the key itself
+    messages_name = _names(get_conversation_id(state.whatsapp_account, state.phone_number))[1]
+    return [json.loads(message) for message in frappe.cache.lrange(messages_name, 0, -1)]
+
+
+def _write_through(state):
+    """Write an ended session, with its unflushed state, to the database."""
+    doc = frappe.get_doc(SESSION_DOCTYPE, state.name)
+    doc.update({field: getattr(state, field) for field in STATE_FIELDS if field != "name"})
+    doc._new_messages = _pending_messages(state) + state._new_messages
+    state._new_messages = []
+
+    # The document's on_update drops the cached state after the commit
+    doc.save(ignore_permissions=True)
+
+
+def flush_sessions(batch_size=200, max_batches=20):
+    """Scheduled job writing changed session states to the database in batches."""
+    from frappe_whatsapp_chatbot.chatbot.session_manager import log_session_messages
+
+    try:
+        for _ in range(max_batches):
+            conversation_ids = [
+                frappe.safe_decode(c)
+                for c in frappe.cache.srandmember(DIRTY_SESSIONS_KEY, batch_size) or []
+            ]
+            if not conversation_ids:
+                return
+
+            pipeline = frappe.cache.pipeline()
+            for conversation_id in conversation_ids:
+                state_key, messages_key, _ = _keys(conversation_id)
+                pipeline.hmget(state_key, ["name", "data", "version"])
+                pipeline.lrange(messages_key, 0, -1)
+            results = pipeline.execute()
+
+            flushed = []
+            for i, conversation_id in enumerate(conversation_ids):
+                (name, data, version), messages = results[2 * i], results[2 * i + 1]
+                if not name:
+                    # Session ended or state dropped, nothing left to write
+                    flushed.append((conversation_id, version, 0))
+                    continue
+
+                name = frappe.safe_decode(name)
+                state = _loads(data)
+                frappe.db.set_value(
+                    SESSION_DOCTYPE,
+                    {"name": name, "status": "Active"},
+                    {field: state.get(field) for field in HOT_FIELDS}
+                )
+                if messages:
+                    log_session_messages(name, [json.loads(m) for m in messages])
+                flushed.append((conversation_id, version, len(messages)))
+
+            frappe.db.commit()
+
+            for conversation_id, version, message_count in flushed:
+                run_script(
+                    FLUSHED_SCRIPT,
+                    keys=_keys(conversation_id),
+                    args=[conversation_id, version or 0, message_count]
+                )
+
+            if len(conversation_ids) < batch_size:
+                return
+
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(f"flush_sessions error: {str(e)}")
@@ -0,0 +1,164 @@
+import frappe
+from datetime import datetime, time, timedelta
+from types import MappingProxyType
+
+from frappe_whatsapp_chatbot.chatbot.cache import ReadOnlyDoc, bump_version, get_cached
+
+# Cache namespace for the WhatsApp Chatbot settings snapshot
+SETTINGS_CACHE = "settings"
+
+
+def parse_time(time_value):
+    """Parse a Time field value (str, time or MariaDB timedelta) to a time object."""
+    if not time_value:
+        return None
+
+    if isinstance(time_value, time):
+        return time_value
+
+    if isinstance(time_value, timedelta):
+        return (datetime.min + time_value).time()
+
+    if isinstance(time_value, str):
+        try:
+            parts = time_value.split(":")
+            return time(int(parts[0]), int(parts[1]), int(float(parts[2])) if len(parts) > 2 else 0)
+        except (ValueError, IndexError):
+            return None
+
+    return None
+
+
+class ChatbotSettings(ReadOnlyDoc):
+    """
+    Frozen snapshot of the WhatsApp Chatbot single.
+
+    Excluded numbers are a set and business hours are pre-parsed per day,
+    so per-message gating needs no further lookups.
+    """
+
+    def __init__(self, data, api_key=None, fallback_api_keys=None):
+        super().__init__({
+            k: v for k, v in data.items()
+            if k not in ("excluded_numbers", "business_hours", "ai_fallback_providers")
+        })
+
+        self._set("excluded_numbers", frozenset(
+            row.get("phone_number") for row in data.get("excluded_numbers") or []
+            if row.get("phone_number")
+        ))
+
+        # {day: (enabled, start_time, end_time)}
+        self._set("business_hours", MappingProxyType({
+            row.get("day"): (
+                bool(row.get("enabled")),
+                parse_time(row.get("start_time")),
+                parse_time(row.get("end_time"))
+            )
+            for row in data.get("business_hours") or []
+        }))
+
+        # AI providers tried after the primary one, with decrypted keys
+        fallback_api_keys = fallback_api_keys or {}
+        self._set("ai_fallback_chain", tuple(
+            ReadOnlyDoc({
+                "provider": row.get("provider"),
+                "model": row.get("model"),
+                "api_key": fallback_api_keys.get(row.get("name"))
+            })
+            for row in data.get("ai_fallback_providers") or []
+            if row.get("provider")
+        ))
+
+        self._set("_api_key", api_key)
+
+    def get_password(self, fieldname="ai_api_key", raise_exception=True):
+        """Get the decrypted AI API key (the only password field)."""
+        if fieldname != "ai_api_key":
+            raise AttributeError(f"Unknown password field: {fieldname}")
+        return self._api_key
+
+    def is_excluded(self, phone_number):
+        """Check if a phone number is excluded from automated responses."""
+        return phone_number in self.excluded_numbers
+
+    def is_business_hours(self, now=None):
+        """Check if a time (default: now) is within business hours."""
+        if not self.business_hours:
+            return True  # No business hours configured
+
+        now = now or datetime.now()
+        day = self.business_hours.get(now.strftime("%A"))
+
+        # No entry for this day - default to closed
+        if not day:
+            return False
+
+        enabled, start, end = day
+        if not enabled:
+            return False  # Closed on this day
+
+        if start and end:
+            return start <= now.time() <= end
+        return True  # Day is enabled but no specific times set
+
+
+def get_settings(version=None):
+    """Get the cached WhatsApp Chatbot settings snapshot.
+
+    The snapshot lives in worker memory and is validated against a Redis
+    version stamp that is bumped whenever the settings are saved.
+
+    Args:
+        version: Version stamp already read by the caller, if any
+    """
+    return get_cached(
+        SETTINGS_CACHE,
+        "",
+        loader=lambda: frappe.get_single("WhatsApp Chatbot").as_dict(),
+        compiler=_build_snapshot,
+        version=version
+    )
+
+
+def _build_snapshot(data):
+    from frappe.utils.password import get_decrypted_password
+
+    # The decrypted keys are only kept in worker memory, never in Redis
+    api_key = None
+    fallback_api_keys = {}
+    if data.get("enable_ai"):
+        if data.get("ai_api_key"):
+            api_key = get_decrypted_password(
+                "WhatsApp Chatbot", "WhatsApp Chatbot", "ai_api_key", raise_exception=False
+            )
+        for row in data.get("ai_fallback_providers") or []:
+            if row.get("api_key"):
+                fallback_api_keys[row.get("name")] = get_decrypted_password(
+                    "WhatsApp AI Fallback Provider", row.get("name"), "api_key", raise_exception=False
+                )
+    return ChatbotSettings(data, api_key=api_key, fallback_api_keys=fallback_api_keys)
+
+
+def clear_settings_cache():
+    """Invalidate the settings snapshot in all workers."""
+    bump_version(SETTINGS_CACHE)
+
+
+def backfill_defaults(fieldnames):
+    """Write the defaults of settings fields the saved single has no value for.
+
+    For patches: fields added after the settings were last saved read None,
+    not their default, until someone saves the settings again.
+    """
+    meta = frappe.get_meta("WhatsApp Chatbot")
+    saved = frappe.db.get_singles_dict("WhatsApp Chatbot")
+    if not saved:
+        return  # Never saved, the defaults apply as for a new document
+
+    for fieldname in fieldnames:
+        default = meta.get_field(fieldname).default
+        if saved.get(fieldname) is None and default is not None:
+            frappe.db.set_single_value("WhatsApp Chatbot", fieldname, default)
+
+    clear_settings_cache()
@@ -0,0 +1,116 @@
+"""
+Unit of work for processing one incoming message.
+
+Session changes, outgoing messages and external side effects collected while
+a message is processed are written in one transaction at the end, instead of
+a save and commit after every step.
+"""
+import frappe
+
+
+class UnitOfWork:
+    """
+    Collect the writes of one message and flush them in one transaction.
+
+    Documents registered with save() are saved once each, however often they
+    were changed. Outgoing messages are inserted after them, and after_commit
+    callbacks (e.g. external API calls) only run once everything is committed.
+
+    Usage:
+        with UnitOfWork() as uow:
+            uow.save(session)
+            uow.send(message_doc)
+    """
+
+    def __init__(self, immediate=False):
+        """
+        Args:
+            immediate: Write and commit every change right away (for callers
+                that use the flow engine outside a message's processing)
+        """
+        self.immediate = immediate
+        self._docs = {}
+        self._messages = []
+        self._callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.discard()
+        else:
+            self.flush()
+
+    def save(self, doc):
+        """Save (or insert, if new) a document when the unit of work is flushed."""
+        if self.immediate:
+            _save(doc)
+            frappe.db.commit()
+        else:
+            self._docs[id(doc)] = doc
+
+    def send(self, message):
+        """Insert an outgoing WhatsApp Message when the unit of work is flushed."""
+        if self.immediate:
+            _send(message)
+            frappe.db.commit()
+        else:
+            self._messages.append(message)
+
+    def after_commit(self, callback):
+        """Run a callback once the unit of work has been committed."""
+        if self.immediate:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def flush(self):
+        """Write all collected changes and commit them together."""
+        if not (self._docs or self._messages or self._callbacks):
+            return
+
+        try:
+            for doc in self._docs.values():
+                _save(doc)
+        except Exception:
+            self.discard()
+            raise
+
+        # Each message is sent on insert, one failed send must not undo the
+        # session update or hold back the other replies
+        for message in self._messages:
+            _send(message)
+
+        frappe.db.commit()
+
+        callbacks = self._callbacks
+        self._docs, self._messages, self._callbacks = {}, [], []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                frappe.log_error(f"UnitOfWork after_commit error: {str(e)}")
+
+    def discard(self):
+        """Drop all collected changes and roll back the transaction."""
+        self._docs, self._messages, self._callbacks = {}, [], []
+        frappe.db.rollback()
+
+
+def _save(doc):
+    if doc.is_new():
+        doc.insert(ignore_permissions=True)
+    else:
+        doc.save(ignore_permissions=True)
+
+
+def _send(message):
+    try:
+        message.flags.ignore_chatbot = True
+        message.insert(ignore_permissions=True)
+    except Exception as e:
+        frappe.log_error(
+            f"Chatbot send_response error: {str(e)}",
+            "WhatsApp Chatbot Error"
+        )
@@ -0,0 +1,41 @@
+import json
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("chatbot-check-indexes")
+@click.option("--fix", is_flag=True, default=False, help="Create the missing indexes")
+@pass_context
+def check_indexes(context, fix=False):
+    """Report missing chatbot indexes and EXPLAIN plans of the hot queries."""
+    from frappe_whatsapp_chatbot.chatbot.db_indexes import check_indexes, ensure_indexes
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        if fix:
+            ensure_indexes()
+
+        report = check_indexes()
+        for index in report["missing"]:
+            click.secho(
+                f"Missing index {index['index']} on {index['doctype']} ({', '.join(index['columns'])})",
+                fg="red"
+            )
+        for query in report["plans"]:
+            full_scan = any(row.get("full_scan") for row in query["plan"])
+            click.secho(f"\n{query['query']}" + (" - FULL TABLE SCAN" if full_scan else ""),
+                fg="yellow" if full_scan else None)
+            for row in query["plan"]:
+                click.echo(json.dumps(row, default=str))
+
+        if not report["missing"]:
+            click.secho("\nAll chatbot indexes exist", fg="green")
+    finally:
+        frappe.destroy()
+
+
+commands = [check_indexes]
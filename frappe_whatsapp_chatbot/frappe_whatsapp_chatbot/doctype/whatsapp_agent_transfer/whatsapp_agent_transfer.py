@@ -5,6 +5,8 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import now_datetime
 
+from frappe_whatsapp_chatbot.chatbot.gating import update_transferred_number
+
 
 class WhatsAppAgentTransfer(Document):
     """
@@ -20,6 +22,13 @@ class WhatsAppAgentTransfer(Document):
             self.resumed_at = now_datetime()
             self.resumed_by = frappe.session.user
 
+    def on_update(self):
+        # Keep the gating stage's transferred numbers set in sync
+        update_transferred_number(self.phone_number)
+
+    def on_trash(self):
+        update_transferred_number(self.phone_number, ignore_transfer=self.name)
+
     @staticmethod
     def is_transferred(phone_number, whatsapp_account=None):
         """Check if a phone number is currently transferred to an agent.
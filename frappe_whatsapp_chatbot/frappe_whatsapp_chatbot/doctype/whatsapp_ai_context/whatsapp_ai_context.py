@@ -1,6 +1,8 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp_chatbot.chatbot.ai_responder import clear_ai_context_cache
+
 
 class WhatsAppAIContext(Document):
     """
@@ -24,3 +26,12 @@ class WhatsAppAIContext(Document):
                     json.loads(self.filters)
                 except json.JSONDecodeError:
                     frappe.throw("Filters must be valid JSON")
+
+            if self.cache_ttl and self.cache_ttl < 0:
+                frappe.throw("Cache TTL cannot be negative")
+
+    def on_update(self):
+        clear_ai_context_cache()
+
+    def on_trash(self):
+        clear_ai_context_cache()
@@ -0,0 +1,12 @@
+import frappe
+from frappe.model.document import Document
+
+
+class WhatsAppAIFallbackProvider(Document):
+    """
+    AI provider tried when the ones before it fail.
+
+    Rows are tried in order after the primary AI provider.
+    """
+
+    pass
@@ -1,6 +1,11 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp_chatbot.chatbot import kb_vectors
+from frappe_whatsapp_chatbot.chatbot.gating import sync_excluded_numbers
+from frappe_whatsapp_chatbot.chatbot.response_cache import clear_response_cache
+from frappe_whatsapp_chatbot.chatbot.settings import clear_settings_cache
+
 
 class WhatsAppChatbot(Document):
     """
@@ -24,6 +29,28 @@ class WhatsAppChatbot(Document):
         if self.ai_temperature and (self.ai_temperature < 0 or self.ai_temperature > 1):
             frappe.throw("AI Temperature must be between 0 and 1")
 
+        if self.ai_prompt_budget and self.ai_prompt_budget < 0:
+            frappe.throw("AI Prompt Budget cannot be negative")
+
+        if self.kb_semantic_search and not kb_vectors.is_available():
+            frappe.throw("Semantic Knowledge Base Search requires NumPy. Run: pip install numpy")
+
+        if self.ai_cache_similarity:
+            if self.ai_cache_similarity < 0 or self.ai_cache_similarity > 1:
+                frappe.throw("AI Cache Similarity must be between 0 and 1")
+            if not kb_vectors.is_available():
+                frappe.throw("AI Cache Similarity requires NumPy. Run: pip install numpy")
+
+    def on_update(self):
+        clear_settings_cache()
+        sync_excluded_numbers()
+        # Cached replies were generated with the old prompt and model
+        clear_response_cache()
+
+        # Entries saved while it was off were not embedded
+        if self.kb_semantic_search and self.has_value_changed("kb_semantic_search"):
+            kb_vectors.enqueue_rebuild()
+
     @frappe.whitelist()
     def populate_default_business_hours(self):
         """Populate business hours table with default weekday schedule."""
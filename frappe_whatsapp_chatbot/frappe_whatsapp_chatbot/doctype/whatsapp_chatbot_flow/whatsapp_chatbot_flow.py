@@ -1,6 +1,8 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp_chatbot.chatbot.flow_graph import clear_flow_cache
+
 
 class WhatsAppChatbotFlow(Document):
     """
@@ -14,6 +16,12 @@ class WhatsAppChatbotFlow(Document):
         self.validate_steps()
         self.validate_completion_action()
 
+    def on_update(self):
+        clear_flow_cache(self.name, self.modified)
+
+    def on_trash(self):
+        clear_flow_cache(self.name)
+
     def validate_steps(self):
         if not self.steps:
             frappe.throw("Please add at least one step to the flow")
@@ -1,8 +1,12 @@
 // Copyright (c) 2025, Shridhar Patil and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("WhatsApp Chatbot Session", {
-// 	refresh(frm) {
-
-// 	},
-// });
+frappe.ui.form.on("WhatsApp Chatbot Session", {
+	refresh(frm) {
+		if (!frm.is_new()) {
+			frm.add_custom_button(__("Message History"), () => {
+				frappe.set_route("List", "WhatsApp Session Message", { session: frm.doc.name });
+			});
+		}
+	},
+});
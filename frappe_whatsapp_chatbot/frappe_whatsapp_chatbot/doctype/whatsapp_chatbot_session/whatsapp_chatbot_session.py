@@ -1,6 +1,14 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp_chatbot.chatbot.session_manager import (
+    delete_session_messages,
+    log_session_messages,
+    track_session_activity,
+    untrack_session
+)
+from frappe_whatsapp_chatbot.chatbot.session_store import drop_session_state
+
 
 class WhatsAppChatbotSession(Document):
     """
@@ -15,9 +23,37 @@ class WhatsAppChatbotSession(Document):
         if self.status == "Active":
             self.last_activity = frappe.utils.now_datetime()
 
+    def on_update(self):
+        # Keep the session's deadline in the expiry index
+        track_session_activity(self)
+
+        # Append the messages added since the last save to the log
+        new_messages = getattr(self, "_new_messages", None)
+        if new_messages:
+            log_session_messages(self.name, new_messages)
+            self._new_messages = []
+
+        # The database is now ahead of the Redis state (ended session, desk
+        # edit, or a session created outside the chatbot replacing a cached
+        # "no active session"; on_update also runs on insert)
+        frappe.db.after_commit.add(
+            lambda: drop_session_state(self.whatsapp_account, self.phone_number)
+        )
+
+    def on_trash(self):
+        untrack_session(self.name)
+        delete_session_messages(self.name)
+        drop_session_state(self.whatsapp_account, self.phone_number)
+
     def add_message(self, direction, message, step_name=None):
-        """Add a message to the session history."""
-        self.append("messages", {
+        """Add a message to the session history.
+
+        Messages live in the append-only WhatsApp Session Message log and are
+        written in one bulk insert when the session is saved.
+        """
+        if getattr(self, "_new_messages", None) is None:
+            self._new_messages = []
+        self._new_messages.append({
             "direction": direction,
             "message": message,
             "timestamp": frappe.utils.now_datetime(),
@@ -1,6 +1,8 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp_chatbot.chatbot.keyword_matcher import clear_keyword_index
+
 
 class WhatsAppKeywordReply(Document):
     """
@@ -15,6 +17,12 @@ class WhatsAppKeywordReply(Document):
         self.validate_response()
         self.validate_dates()
 
+    def on_update(self):
+        clear_keyword_index()
+
+    def on_trash(self):
+        clear_keyword_index()
+
     def validate_keywords(self):
         if not self.keywords or not self.keywords.strip():
             frappe.throw("Please enter at least one keyword")
@@ -1,6 +1,10 @@
 import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp_chatbot.chatbot.kb_index import remove_kb_entry, update_kb_entry
+from frappe_whatsapp_chatbot.chatbot.kb_vectors import enqueue_kb_vector_update
+from frappe_whatsapp_chatbot.chatbot.response_cache import clear_response_cache
+
 class WhatsAppKnowledgeBase(Document):
 	"""
 	WhatsApp Knowledge Base for AI chatbot context.
@@ -9,4 +13,12 @@ class WhatsAppKnowledgeBase(Document):
 	context for AI-powered chatbot responses.
 	"""
 
-	pass
+	def on_update(self):
+		update_kb_entry(self)
+		enqueue_kb_vector_update(self.name)
+		clear_response_cache()
+
+	def on_trash(self):
+		remove_kb_entry(self.name)
+		enqueue_kb_vector_update(self.name)
+		clear_response_cache()
@@ -4,10 +4,11 @@ from frappe.model.document import Document
 
 class WhatsAppSessionMessage(Document):
     """
-    WhatsApp Session Message child table entry.
+    WhatsApp Session Message log entry.
     
-    Stores individual messages within a chatbot session
-    for conversation history and context tracking.
+    Stores individual messages of a chatbot session for conversation
+    history and context tracking. The log is append-only and written in
+    bulk, see session_manager.log_session_messages.
     """
 
     pass
@@ -32,15 +32,33 @@ setup = {
     "category": "Integrations"
 }
 
+# Installation
+after_install = "frappe_whatsapp_chatbot.chatbot.db_indexes.ensure_indexes"
+
 # Document Events
 doc_events = {
     "WhatsApp Message": {
-        "after_insert": "frappe_whatsapp_chatbot.chatbot.processor.process_incoming_message"
+        "after_insert": [
+            "frappe_whatsapp_chatbot.chatbot.processor.process_incoming_message",
+            "frappe_whatsapp_chatbot.chatbot.conversation_history.record_message"
+        ]
+    },
+    # Cached AI context query results of the changed document's DocType
+    "*": {
+        "on_change": "frappe_whatsapp_chatbot.chatbot.context_resolver.invalidate_queried_doctype",
+        "on_trash": "frappe_whatsapp_chatbot.chatbot.context_resolver.invalidate_queried_doctype"
     }
 }
 
 # Scheduler Events
 scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "frappe_whatsapp_chatbot.chatbot.session_store.flush_sessions",
+            "frappe_whatsapp_chatbot.chatbot.session_manager.expire_sessions",
+            "frappe_whatsapp_chatbot.chatbot.conversation_queue.recover_conversations"
+        ]
+    },
     "hourly": [
         "frappe_whatsapp_chatbot.chatbot.session_manager.cleanup_expired_sessions"
     ]
@@ -0,0 +1,6 @@
+from frappe_whatsapp_chatbot.chatbot.db_indexes import ensure_indexes
+
+
+def execute():
+    """Add composite indexes for the chatbot's hot-path queries."""
+    ensure_indexes()
@@ -0,0 +1,16 @@
+import frappe
+
+
+def execute():
+    """Link rows of the former Messages child table to their session."""
+    if not frappe.db.has_column("WhatsApp Session Message", "parent"):
+        return
+
+    frappe.db.sql(
+        """
+        UPDATE `tabWhatsApp Session Message`
+        SET `session` = `parent`
+        WHERE (`session` IS NULL OR `session` = '')
+            AND `parenttype` = 'WhatsApp Chatbot Session'
+        """
+    )
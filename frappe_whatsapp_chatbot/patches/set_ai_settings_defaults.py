@@ -0,0 +1,6 @@
+from frappe_whatsapp_chatbot.chatbot.settings import backfill_defaults
+
+
+def execute():
+    """Apply the defaults of AI settings added since the settings were saved."""
+    backfill_defaults(["ai_prompt_budget", "ai_cache_ttl", "kb_max_chars"])
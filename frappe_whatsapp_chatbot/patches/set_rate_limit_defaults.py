@@ -0,0 +1,11 @@
+from frappe_whatsapp_chatbot.chatbot.settings import backfill_defaults
+
+
+def execute():
+    """Keep the per-phone rate limit on for sites upgraded from the fixed limit."""
+    backfill_defaults([
+        "rate_limit_per_phone",
+        "rate_limit_per_account",
+        "rate_limit_global",
+        "rate_limit_window"
+    ])
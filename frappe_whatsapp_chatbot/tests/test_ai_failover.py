@@ -0,0 +1,31 @@
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.ai_failover import (
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+    ProviderError,
+    backoff_delay,
+    is_retryable
+)
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class TestAIFailover(FrappeTestCase):
+    def test_transient_errors_are_retried(self):
+        self.assertTrue(is_retryable(TimeoutError()))
+        self.assertTrue(is_retryable(HTTPError(429)))
+        self.assertTrue(is_retryable(HTTPError(503)))
+
+    def test_rejected_requests_are_not_retried(self):
+        self.assertFalse(is_retryable(HTTPError(401)))
+        self.assertFalse(is_retryable(HTTPError(400)))
+        self.assertFalse(is_retryable(ProviderError("not configured", retryable=False)))
+
+    def test_backoff_grows_with_jitter_and_is_capped(self):
+        for attempt in range(6):
+            delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+            self.assertTrue(delay <= backoff_delay(attempt) <= 2 * delay)
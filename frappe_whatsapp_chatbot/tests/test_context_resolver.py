@@ -0,0 +1,62 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.context_resolver import invalidate_queried_doctype, resolve_queries
+
+
+def make_context(name, user_specific=0, cache_ttl=300):
+    return frappe._dict(
+        name=name, title=name, context_type="DocType Query", query_doctype="Sales Order",
+        user_specific=user_specific, phone_field="contact_mobile" if user_specific else None,
+        cache_ttl=cache_ttl, modified="2026-10-17 12:00:00"
+    )
+
+
+class TestContextResolver(FrappeTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def query(self, ctx):
+        self.calls.append(ctx.name)
+        return [{"name": f"SO-{len(self.calls)}"}]
+
+    def test_results_cached_per_customer(self):
+        ctx = make_context("Orders", user_specific=1)
+        first = resolve_queries([ctx], "+15550100", self.query)
+        self.assertEqual(resolve_queries([ctx], "+15550100", self.query), first)
+        self.assertEqual(len(self.calls), 1)
+
+        resolve_queries([ctx], "+15550199", self.query)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_uncached_context_queried_every_time(self):
+        ctx = make_context("Stock", cache_ttl=0)
+        resolve_queries([ctx], None, self.query)
+        resolve_queries([ctx], None, self.query)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_invalidated_when_queried_doctype_changes(self):
+        ctx = make_context("Open Orders")
+        resolve_queries([ctx], None, self.query)
+
+        with patch(
+            "frappe_whatsapp_chatbot.chatbot.context_resolver.get_queried_doctypes",
+            return_value=frozenset({"Sales Order"})
+        ):
+            invalidate_queried_doctype(frappe._dict(doctype="Sales Order"))
+
+        resolve_queries([ctx], None, self.query)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_log_doctypes_are_ignored(self):
+        with patch(
+            "frappe_whatsapp_chatbot.chatbot.context_resolver.get_queried_doctypes",
+            side_effect=ConnectionError
+        ) as get_queried_doctypes, patch.object(frappe, "log_error") as log_error:
+            invalidate_queried_doctype(frappe._dict(doctype="Error Log"))
+            get_queried_doctypes.assert_not_called()
+
+            # A failing lookup must not write an Error Log, which would fire it again
+            invalidate_queried_doctype(frappe._dict(doctype="Sales Order"))
+            log_error.assert_not_called()
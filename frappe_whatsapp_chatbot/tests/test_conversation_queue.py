@@ -0,0 +1,36 @@
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.conversation_queue import group_messages
+
+
+def make_message(name, message, content_type="text"):
+    return {"name": name, "message": message, "content_type": content_type}
+
+
+class TestGroupMessages(FrappeTestCase):
+    def test_burst_of_text_is_merged(self):
+        merged = group_messages([
+            make_message("m1", "hi"),
+            make_message("m2", "I need help"),
+            make_message("m3", "with my order"),
+        ])
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0][0]["message"], "hi\nI need help\nwith my order")
+        self.assertEqual(merged[0][0]["name"], "m3")
+
+    def test_buttons_are_not_merged(self):
+        merged = [m for m, _ in group_messages([
+            make_message("m1", "hi"),
+            make_message("m2", "yes_btn", "button"),
+            make_message("m3", "thanks"),
+            make_message("m4", "bye"),
+        ])]
+        self.assertEqual([m["name"] for m in merged], ["m1", "m2", "m4"])
+        self.assertEqual(merged[2]["message"], "thanks\nbye")
+
+    def test_groups_count_queued_messages(self):
+        grouped = group_messages([
+            make_message("m1", "hi"),
+            make_message("m2", "there"),
+            make_message("m3", "yes_btn", "button"),
+        ])
+        self.assertEqual([(m["name"], count) for m, count in grouped], [("m2", 2), ("m3", 1)])
@@ -0,0 +1,25 @@
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.conversation_summary import ExtractiveSummarizer
+
+
+def make_message(message, direction="Incoming"):
+    return {"direction": direction, "message": message}
+
+
+class TestExtractiveSummarizer(FrappeTestCase):
+    def test_folds_first_sentence_of_customer_messages(self):
+        summary = ExtractiveSummarizer(None).fold("", [
+            make_message("My order 1234 is late. Can you check?"),
+            make_message("Sure, let me look.", "Outgoing"),
+            make_message("It was due on Monday"),
+        ])
+        self.assertEqual(summary, "- My order 1234 is late.\n- It was due on Monday")
+
+    def test_fold_is_incremental_and_bounded(self):
+        summarizer = ExtractiveSummarizer(None)
+        summary = summarizer.fold("", [make_message(f"question {i}") for i in range(8)])
+        summary = summarizer.fold(summary, [make_message(f"question {i}") for i in range(6, 12)])
+        lines = summary.split("\n")
+        self.assertEqual(len(lines), summarizer.max_lines)
+        self.assertEqual(lines[0], "- question 2")
+        self.assertEqual(lines[-1], "- question 11")
@@ -0,0 +1,42 @@
+import frappe
+from unittest.mock import patch
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot import gating
+
+
+def make_settings(**values):
+    return frappe._dict({
+        "enabled": 1,
+        "process_all_accounts": 0,
+        "whatsapp_account": "Main",
+        "rate_limit_per_phone": 10,
+        "rate_limit_per_account": 100,
+        "rate_limit_global": 1000,
+        "rate_limit_window": 60,
+        **values
+    })
+
+
+class TestGating(FrappeTestCase):
+    def gate(self, settings, whatsapp_account):
+        # Allowed, sets built, settings version unchanged
+        result = [None, 0, 0, 2, 0, 0]
+        with patch.object(gating, "peek_cached", return_value=settings), \
+                patch.object(gating, "get_settings", return_value=settings), \
+                patch.object(gating, "run_script", return_value=result) as run_script:
+            handled = gating.should_handle("+15550000", whatsapp_account)
+        return handled, [call.kwargs["args"][2:] for call in run_script.call_args_list]
+
+    def test_handled_messages_count_towards_limits(self):
+        handled, limits = self.gate(make_settings(), "Main")
+        self.assertTrue(handled)
+        self.assertEqual(limits, [[10, 100, 1000]])
+
+    def test_ignored_messages_are_not_counted(self):
+        handled, limits = self.gate(make_settings(), "Other")
+        self.assertFalse(handled)
+        self.assertEqual(limits, [[0, 0, 0]])
+
+        handled, limits = self.gate(make_settings(enabled=0), "Main")
+        self.assertFalse(handled)
+        self.assertEqual(limits, [[0, 0, 0]])
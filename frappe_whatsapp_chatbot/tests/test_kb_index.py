@@ -0,0 +1,35 @@
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.kb_index import BM25Index, fuse_rankings
+
+
+def make_entry(topic, keywords="", content=""):
+    return {"topic": topic, "keywords": keywords, "content": content}
+
+
+class TestBM25Index(FrappeTestCase):
+    def setUp(self):
+        self.index = BM25Index({
+            "kb1": make_entry("Refund policy", "refund, money back", "Refunds are processed within 7 days."),
+            "kb2": make_entry("Shipping times", "delivery, shipping", "Orders ship within 2 days."),
+            "kb3": make_entry("Store hours", "open, hours", "We are open 9 to 5."),
+        })
+
+    def test_ranks_best_match_first(self):
+        results = self.index.search("how long does shipping take for my orders", limit=3)
+        self.assertEqual(results[0][1], "kb2")
+        self.assertNotIn("kb3", [name for _, name, _ in results])
+
+    def test_incremental_update_and_remove(self):
+        self.index.add("kb2", make_entry("Shipping times", "delivery", "Refund shipping costs."))
+        self.assertEqual(self.index.search("money back refund")[0][1], "kb1")
+
+        self.index.remove("kb1")
+        self.assertEqual([name for _, name, _ in self.index.search("refund")], ["kb2"])
+        self.assertNotIn("kb1", self.index.lengths)
+        self.assertEqual(self.index.total_length, sum(self.index.lengths.values()))
+
+
+    def test_fuse_rankings_favours_entries_found_by_both(self):
+        lexical = [(9.0, "kb1"), (4.0, "kb2")]
+        semantic = [(0.8, "kb3"), (0.6, "kb2")]
+        self.assertEqual([name for _, name in fuse_rankings(lexical, semantic)][0], "kb2")
@@ -0,0 +1,52 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.keyword_index import KeywordIndex, AhoCorasick
+
+
+def make_rule(name, keywords, match_type, case_sensitive=0):
+    return frappe._dict(
+        name=name,
+        keywords=keywords,
+        match_type=match_type,
+        case_sensitive=case_sensitive
+    )
+
+
+class TestKeywordIndex(FrappeTestCase):
+    def setUp(self):
+        # Rules are given in priority order, as loaded by the matcher
+        self.index = KeywordIndex([
+            make_rule("greeting", "hello, hi", "Exact"),
+            make_rule("pricing", "price, cost", "Contains"),
+            make_rule("order", "Order", "Starts With", case_sensitive=1),
+            make_rule("pin", r"^\d{4}$", "Regex"),
+            make_rule("polite", "please", "Contains"),
+        ])
+
+    def match_names(self, text):
+        return [rule.name for rule in self.index.candidates(text)]
+
+    def test_exact_match_is_case_insensitive(self):
+        self.assertEqual(self.match_names("HELLO"), ["greeting"])
+        self.assertEqual(self.match_names("hello there"), [])
+
+    def test_contains_match(self):
+        self.assertEqual(self.match_names("what does it COST"), ["pricing"])
+
+    def test_starts_with_respects_case_sensitivity(self):
+        self.assertEqual(self.match_names("Order 42"), ["order"])
+        self.assertEqual(self.match_names("order 42"), [])
+
+    def test_regex_match(self):
+        self.assertEqual(self.match_names("1234"), ["pin"])
+        self.assertEqual(self.match_names("12345"), [])
+
+    def test_candidates_keep_priority_order(self):
+        self.assertEqual(self.match_names("hi"), ["greeting"])
+        self.assertEqual(self.match_names("price please"), ["pricing", "polite"])
+
+    def test_aho_corasick_finds_overlapping_keywords(self):
+        automaton = AhoCorasick([("he", 0), ("she", 1), ("his", 2), ("hers", 3)])
+        matched = set()
+        automaton.collect("ushers", matched)
+        self.assertEqual(matched, {0, 1, 3})
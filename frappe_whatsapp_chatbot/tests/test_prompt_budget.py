@@ -0,0 +1,45 @@
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.prompt_budget import CUT_MARKER, Tokenizer, assemble_prompt
+
+
+def make_history(count):
+    return [
+        {"direction": "Incoming" if i % 2 == 0 else "Outgoing", "message": f"message {i} " + "x" * 60}
+        for i in range(count)
+    ]
+
+
+class TestPromptBudget(FrappeTestCase):
+    def setUp(self):
+        self.tokenizer = Tokenizer("Anthropic")
+        self.context_parts = [
+            ("Store", "Open 9 to 5. " * 20),
+            ("Knowledge Base", "Q: Refunds\nA: Within 30 days. " * 10),
+            ("Knowledge Base", "Q: Shipping\nA: Two days. " * 10),
+        ]
+
+    def test_no_budget_keeps_everything(self):
+        prompt = assemble_prompt(
+            self.tokenizer, 0, "Be helpful.", "Hi", self.context_parts, "Earlier: asked about refunds", make_history(4)
+        )
+        self.assertEqual(len(prompt.context_parts), 3)
+        self.assertEqual(len(prompt.history), 4)
+        self.assertFalse(prompt.dropped or prompt.cut)
+        self.assertEqual(prompt.tokens["total"], sum(v for k, v in prompt.tokens.items() if k not in ("total", "budget")))
+
+    def test_budget_drops_lowest_priority_first(self):
+        prompt = assemble_prompt(
+            self.tokenizer, 150, "Be helpful.", "Hi", self.context_parts, "Earlier: asked about refunds", make_history(6)
+        )
+        self.assertLessEqual(prompt.tokens["total"], 150)
+        # The last exchange outranks the context, older history goes first
+        self.assertEqual([msg["message"][:9] for msg in prompt.history], ["message 4", "message 5"])
+        self.assertEqual(prompt.context_parts[0][0], "Store")
+        self.assertNotIn(("Knowledge Base", self.context_parts[2][1]), prompt.context_parts)
+        self.assertTrue(prompt.dropped)
+
+    def test_cut_part_is_marked(self):
+        prompt = assemble_prompt(self.tokenizer, 60, "Be helpful.", "Hi", self.context_parts)
+        self.assertEqual(prompt.cut, 1)
+        self.assertTrue(prompt.context_parts[0][1].endswith(CUT_MARKER))
+        self.assertLessEqual(prompt.tokens["total"], 60)
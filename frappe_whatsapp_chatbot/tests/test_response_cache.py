@@ -0,0 +1,74 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.response_cache import CachedQuestion, clear_response_cache, normalize
+
+
+class FakeCache:
+    """Redis, and the per-job local cache that get_value fills unless expires=True."""
+
+    def __init__(self):
+        self.redis = {}
+        self.local = {}
+
+    def get_value(self, key, expires=False):
+        if not expires and key in self.local:
+            return self.local[key]
+        value = self.redis.get(key)
+        if not expires:
+            self.local[key] = value
+        return value
+
+    def set_value(self, key, value, expires_in_sec=None):
+        self.redis[key] = self.local[key] = value
+
+
+class TestResponseCache(FrappeTestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize("  What are your HOURS?! "), "what are your hours")
+        self.assertEqual(normalize("what-are   your_hours"), "what are your hours")
+
+    def test_shared_and_customer_replies(self):
+        CachedQuestion("What are your hours?").set("9 to 5", ttl=60)
+        self.assertEqual(CachedQuestion("what are your hours").get(), "9 to 5")
+        self.assertIsNone(CachedQuestion("what are your hours", phone_number="+15550100").get())
+
+        CachedQuestion("Where is my order?", phone_number="+15550100").set("Shipped", ttl=60)
+        self.assertEqual(CachedQuestion("where is my order", phone_number="+15550100").get(), "Shipped")
+        self.assertIsNone(CachedQuestion("where is my order", phone_number="+15550199").get())
+        self.assertIsNone(CachedQuestion("where is my order").get())
+
+    def test_cleared_when_context_changes(self):
+        CachedQuestion("Refund policy?").set("30 days", ttl=60)
+        clear_response_cache()
+        self.assertIsNone(CachedQuestion("Refund policy?").get())
+
+    def test_concurrent_callers_wait_for_lease_holder(self):
+        cache = FakeCache()
+        cached = (
+            patch.object(frappe.cache, "get_value", cache.get_value),
+            patch.object(frappe.cache, "set_value", cache.set_value)
+        )
+
+        with cached[0], cached[1], patch.object(frappe.cache, "set", return_value=True):
+            leader = CachedQuestion("Do you deliver?")
+            self.assertIsNone(leader.lead_or_wait(5))
+            self.assertTrue(leader.lease_token)
+
+        # The other caller runs in another job, with its own local cache
+        leader_local, cache.local = cache.local, {}
+
+        def leader_replies(_):
+            waiter_local, cache.local = cache.local, leader_local
+            leader.set("Yes, within 5 km", ttl=60)
+            cache.local = waiter_local
+
+        with cached[0], cached[1], patch.object(frappe.cache, "set", return_value=None), patch(
+            "frappe_whatsapp_chatbot.chatbot.response_cache.time.sleep",
+            side_effect=leader_replies
+        ):
+            waiter = CachedQuestion("do you deliver")
+            # A waiter has always looked the question up before waiting
+            self.assertIsNone(waiter.get())
+            self.assertEqual(waiter.lead_or_wait(5), "Yes, within 5 km")
@@ -0,0 +1,64 @@
+import frappe
+from unittest.mock import MagicMock, patch
+from frappe.tests.utils import FrappeTestCase
+from frappe_whatsapp_chatbot.chatbot.unit_of_work import UnitOfWork
+
+
+def make_doc(new=False):
+    doc = MagicMock()
+    doc.is_new.return_value = new
+    return doc
+
+
+class TestUnitOfWork(FrappeTestCase):
+    def test_writes_are_deferred_and_committed_once(self):
+        session = make_doc()
+        message = make_doc(new=True)
+        calls = []
+
+        with patch.object(frappe.db, "commit") as commit:
+            with UnitOfWork() as uow:
+                uow.save(session)
+                uow.save(session)
+                uow.send(message)
+                uow.after_commit(lambda: calls.append(commit.call_count))
+                session.save.assert_not_called()
+
+        session.save.assert_called_once_with(ignore_permissions=True)
+        message.insert.assert_called_once_with(ignore_permissions=True)
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual(calls, [1])
+
+    def test_error_discards_changes(self):
+        session = make_doc()
+
+        with patch.object(frappe.db, "commit") as commit, patch.object(frappe.db, "rollback") as rollback:
+            with self.assertRaises(ValueError):
+                with UnitOfWork() as uow:
+                    uow.save(session)
+                    raise ValueError
+
+        session.save.assert_not_called()
+        commit.assert_not_called()
+        rollback.assert_called_once()
+
+    def test_expired_session_is_written_in_the_stage(self):
+        from datetime import datetime, timedelta
+        from frappe_whatsapp_chatbot.chatbot import session_manager
+
+        session = make_doc()
+        session.last_activity = datetime.now() - timedelta(hours=2)
+        session.current_flow = None
+
+        with patch.object(session_manager, "get_settings", return_value=frappe._dict(session_timeout_minutes=30)), \
+                patch.object(session_manager, "get_session_state", return_value=session), \
+                patch.object(frappe.db, "commit") as commit:
+            with UnitOfWork() as uow:
+                manager = session_manager.SessionManager("+15550000", "Test Account", uow)
+                self.assertIsNone(manager.get_active_session())
+                commit.assert_not_called()
+                session.save.assert_not_called()
+
+        self.assertEqual(session.status, "Timeout")
+        session.save.assert_called_once_with(ignore_permissions=True)
+        self.assertEqual(commit.call_count, 1)